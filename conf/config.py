@@ -54,14 +54,49 @@ IRC_NICK = None
 
 # ******************** Database  *********************
 
-DATABASE_DRIVER = 'mysql'	# Options: none, sqlite, postgresql or mysql
+# Options: sqlite, postgresql or mysql
+try:
+	DATABASE_DRIVER = config_file_parser.get('Database', 'DATABASE_DRIVER')
+except:
+	DATABASE_DRIVER = 'mysql'
+
 DATABASE_EXTEND = True		# False = pushpool db layout, True = pushpool + extra columns
-DB_SQLITE_FILE = 'pooldb.sqlite'
-DB_PGSQL_HOST = 'localhost'
-DB_PGSQL_DBNAME = 'pooldb'
-DB_PGSQL_USER = 'pooldb'
-DB_PGSQL_PASS = '**empty**'
-DB_PGSQL_SCHEMA = 'public'
+
+try:
+	DB_SQLITE_FILE = config_file_parser.get('Database', 'DB_SQLITE_FILE')
+except:
+	DB_SQLITE_FILE = 'pooldb.sqlite'
+
+# PostgreSQL
+try:
+	DB_PGSQL_HOST = config_file_parser.get('Database', 'DB_PGSQL_HOST')
+except:
+	DB_PGSQL_HOST = 'localhost'
+
+try:
+	DB_PGSQL_DBNAME = config_file_parser.get('Database', 'DB_PGSQL_DBNAME')
+except:
+	DB_PGSQL_DBNAME = 'pooldb'
+
+try:
+	DB_PGSQL_USER = config_file_parser.get('Database', 'DB_PGSQL_USER')
+except:
+	DB_PGSQL_USER = 'pooldb'
+
+try:
+	DB_PGSQL_PASS = config_file_parser.get('Database', 'DB_PGSQL_PASS')
+except:
+	DB_PGSQL_PASS = '**empty**'
+
+try:
+	DB_PGSQL_SCHEMA = config_file_parser.get('Database', 'DB_PGSQL_SCHEMA')
+except:
+	DB_PGSQL_SCHEMA = 'public'
+
+try:
+	DB_PGSQL_PORT = config_file_parser.getint('Database', 'DB_PGSQL_PORT')
+except:
+	DB_PGSQL_PORT = 5432
 
 # MySQL
 DB_MYSQL_HOST = config_file_parser.get('Database', 'DB_MYSQL_HOST')
@@ -72,12 +107,12 @@ DB_MYSQL_PORT = config_file_parser.getint('Database', 'DB_MYSQL_PORT')
 
 # ******************** Adv. DB Settings *********************
 #  Don't change these unless you know what you are doing
-DB_LOADER_CHECKTIME = 15	# How often we check to see if we should run the loader
-DB_LOADER_REC_MIN = 10		# Min Records before the bulk loader fires
-DB_LOADER_REC_MAX = 50		# Max Records the bulk loader will commit at a time
-DB_LOADER_FORCE_TIME = 300      # How often the cache should be flushed into the DB regardless of size.
+DB_LOADER_REC_MAX = 50		# Max Records the bulk loader will commit at a time, a batch is written as soon as this many are queued
+DB_LOADER_MAX_AGE = 2		# Max seconds a share waits in the queue before its batch is written regardless of size
+DB_LOADER_RETRY_TIME = 5	# Seconds to wait before retrying a batch that failed to import
 DB_STATS_AVG_TIME = 300		# When using the DATABASE_EXTEND option, average speed over X sec # Note: this is also how often it updates
-DB_USERCACHE_TIME = 600		# How long the usercache is good for before we refresh
+DB_USERCACHE_TIME = 600		# How long a worker stays in the usercache before it is looked up again
+DB_USERCACHE_SIZE = 100000	# Max workers in the usercache, the least recently used are dropped first
 DB_STATS_ENABLE = False		# Decides whether or not this process is responisble for updating pool statistics.
 
 # When the share queue gets large, more threads will be swaned up to this amount
@@ -89,6 +124,85 @@ try:
 except:
 	DB_MAX_IMPORT_THREADS = 3
 
+# Adaptive batching: batch size (DB_LOADER_REC_MIN to DB_LOADER_ADAPTIVE_MAX) and import threads (up to DB_MAX_IMPORT_THREADS)
+# follow the measured insert cost and share rate to keep queued shares younger than DB_LOADER_TARGET_AGE seconds
+try:
+	DB_LOADER_ADAPTIVE = config_file_parser.getboolean('Advanced', 'DB_LOADER_ADAPTIVE')
+except:
+	DB_LOADER_ADAPTIVE = False
+
+try:
+	DB_LOADER_TARGET_AGE = config_file_parser.getfloat('Advanced', 'DB_LOADER_TARGET_AGE')
+except:
+	DB_LOADER_TARGET_AGE = 5.0
+
+try:
+	DB_LOADER_REC_MIN = config_file_parser.getint('Advanced', 'DB_LOADER_REC_MIN')
+except:
+	DB_LOADER_REC_MIN = 10
+
+try:
+	DB_LOADER_ADAPTIVE_MAX = config_file_parser.getint('Advanced', 'DB_LOADER_ADAPTIVE_MAX')
+except:
+	DB_LOADER_ADAPTIVE_MAX = 5000
+
+# Import shares in this many partitions (by worker name), each with its own batch and connection, instead of
+# DB_MAX_IMPORT_THREADS writers sharing one queue.  The round stats of the partitions are written every DB_STATS_AGGREGATE_TIME seconds
+try:
+	DB_IMPORT_PARTITIONS = config_file_parser.getint('Advanced', 'DB_IMPORT_PARTITIONS')
+	if DB_IMPORT_PARTITIONS < 1:
+		DB_IMPORT_PARTITIONS = 1
+except:
+	DB_IMPORT_PARTITIONS = 1
+
+try:
+	DB_STATS_AGGREGATE_TIME = config_file_parser.getfloat('Advanced', 'DB_STATS_AGGREGATE_TIME')
+except:
+	DB_STATS_AGGREGATE_TIME = 1.0
+
+# Number of pooled database connections shared by share imports and other database writes
+try:
+	DB_POOL_SIZE = config_file_parser.getint('Advanced', 'DB_POOL_SIZE')
+	if DB_POOL_SIZE < 1:
+		DB_POOL_SIZE = 1
+except:
+	DB_POOL_SIZE = DB_MAX_IMPORT_THREADS + 2
+
+# Max number of share rows written by a single multi-row INSERT statement
+try:
+	DB_LOADER_INSERT_CHUNK = config_file_parser.getint('Advanced', 'DB_LOADER_INSERT_CHUNK')
+	if DB_LOADER_INSERT_CHUNK < 1:
+		DB_LOADER_INSERT_CHUNK = 1
+except:
+	DB_LOADER_INSERT_CHUNK = 500
+
+# How share batches are written: 'insert' (multi-row INSERT) or 'loaddata' (LOAD DATA LOCAL INFILE, falls back to INSERT if it is refused)
+try:
+	DB_SHARE_IMPORT_MODE = config_file_parser.get('Advanced', 'DB_SHARE_IMPORT_MODE')
+except:
+	DB_SHARE_IMPORT_MODE = 'insert'
+
+# Keep queued shares in an on-disk spool instead of memory so they survive database outages and restarts
+try:
+	DB_SPOOL_ENABLE = config_file_parser.getboolean('Advanced', 'DB_SPOOL_ENABLE')
+except:
+	DB_SPOOL_ENABLE = False
+
+try:
+	DB_SPOOL_DIR = config_file_parser.get('Advanced', 'DB_SPOOL_DIR')
+except:
+	DB_SPOOL_DIR = 'spool/'
+
+DB_SPOOL_SEGMENT_RECORDS = 100000	# Shares per spool segment file
+DB_SPOOL_FSYNC_RECORDS = 1000		# fsync the spool after this many shares...
+DB_SPOOL_FSYNC_TIME = 1			# ... or this many seconds, whichever comes first
+
+# Write worker checkins (last_checkin, total_shares, total_rejects) at most every N seconds per worker, 0 writes them with every batch
+try:
+	DB_CHECKIN_INTERVAL = config_file_parser.getint('Advanced', 'DB_CHECKIN_INTERVAL')
+except:
+	DB_CHECKIN_INTERVAL = 0
+
 # ******************** Adv. Pool Settings *********************
 USERS_AUTOADD = True		# Automatically add users to db when they connect.
 USERS_CHECK_PASSWORD = False	# Check the workers password? (Many pools don't)
@@ -146,6 +260,117 @@ try:
 except:
 	SAVE_SHARES = True
 
+# Seconds to wait for a connection to the database server
+try:
+	DB_CONNECT_TIMEOUT = config_file_parser.getint('Advanced', 'DB_CONNECT_TIMEOUT')
+except:
+	DB_CONNECT_TIMEOUT = 5
+
+# While the database server is down, connect attempts back off from DB_RECONNECT_MIN_DELAY to DB_RECONNECT_MAX_DELAY seconds
+try:
+	DB_RECONNECT_MIN_DELAY = config_file_parser.getfloat('Advanced', 'DB_RECONNECT_MIN_DELAY')
+except:
+	DB_RECONNECT_MIN_DELAY = 1.0
+
+try:
+	DB_RECONNECT_MAX_DELAY = config_file_parser.getfloat('Advanced', 'DB_RECONNECT_MAX_DELAY')
+except:
+	DB_RECONNECT_MAX_DELAY = 60.0
+
+# MySQL statements taking at least this many seconds are logged with their parameters (0 = off)
+try:
+	DB_SLOW_QUERY_TIME = config_file_parser.getfloat('Advanced', 'DB_SLOW_QUERY_TIME')
+except:
+	DB_SLOW_QUERY_TIME = 1.0
+
+# Failed authorizations are remembered for this many seconds, per username and password (0 = off)
+try:
+	DB_AUTH_FAIL_CACHE_TIME = config_file_parser.getint('Advanced', 'DB_AUTH_FAIL_CACHE_TIME')
+except:
+	DB_AUTH_FAIL_CACHE_TIME = 30
+
+# Each IP may fail AUTH_THROTTLE_BURST authorizations at once and AUTH_THROTTLE_RATE per second after that (0 = off, the default)
+try:
+	AUTH_THROTTLE_RATE = config_file_parser.getfloat('Advanced', 'AUTH_THROTTLE_RATE')
+except:
+	AUTH_THROTTLE_RATE = 0
+
+try:
+	AUTH_THROTTLE_BURST = config_file_parser.getint('Advanced', 'AUTH_THROTTLE_BURST')
+except:
+	AUTH_THROTTLE_BURST = 20
+
+# Worker difficulty changes are written as one bulk update every this many seconds, the latest per worker (0 = at once, the default)
+try:
+	DB_DIFF_FLUSH_TIME = config_file_parser.getint('Advanced', 'DB_DIFF_FLUSH_TIME')
+except:
+	DB_DIFF_FLUSH_TIME = 0
+
+# Hold pool_worker and its settings in memory, synced every DB_WORKER_SYNC_TIME seconds (changed rows) and DB_WORKER_FULL_SYNC_TIME seconds (all)
+try:
+	DB_WORKER_DIRECTORY = config_file_parser.getboolean('Advanced', 'DB_WORKER_DIRECTORY')
+except:
+	DB_WORKER_DIRECTORY = False
+
+try:
+	DB_WORKER_SYNC_TIME = config_file_parser.getint('Advanced', 'DB_WORKER_SYNC_TIME')
+except:
+	DB_WORKER_SYNC_TIME = 30
+
+try:
+	DB_WORKER_FULL_SYNC_TIME = config_file_parser.getint('Advanced', 'DB_WORKER_FULL_SYNC_TIME')
+except:
+	DB_WORKER_FULL_SYNC_TIME = 3600
+
+# Run share and rollup imports in a separate writer process (share_writer.py) instead of threads of this one
+try:
+	DB_WRITER_PROCESS = config_file_parser.getboolean('Advanced', 'DB_WRITER_PROCESS')
+except:
+	DB_WRITER_PROCESS = False
+
+# With SAVE_SHARES off, shares can be rolled up per worker, interval and block instead (share_rollups table)
+try:
+	SHARE_ROLLUP = config_file_parser.getboolean('Advanced', 'SHARE_ROLLUP')
+except:
+	SHARE_ROLLUP = False
+
+try:
+	SHARE_ROLLUP_INTERVAL = config_file_parser.getint('Advanced', 'SHARE_ROLLUP_INTERVAL')
+except:
+	SHARE_ROLLUP_INTERVAL = 60
+
+# MySQL only: RANGE partition the shares table on time, one partition per DB_PARTITION_INTERVAL seconds
+# Expired partitions are dropped, or moved to a shares_<partition> table with DB_PARTITION_EXPIRE = exchange
+try:
+	DB_PARTITION_SHARES = config_file_parser.getboolean('Advanced', 'DB_PARTITION_SHARES')
+except:
+	DB_PARTITION_SHARES = False
+
+try:
+	DB_PARTITION_INTERVAL = config_file_parser.getint('Advanced', 'DB_PARTITION_INTERVAL')
+except:
+	DB_PARTITION_INTERVAL = 86400
+
+try:
+	DB_PARTITION_AHEAD = config_file_parser.getint('Advanced', 'DB_PARTITION_AHEAD')
+except:
+	DB_PARTITION_AHEAD = 3
+
+try:
+	DB_PARTITION_RETENTION = config_file_parser.getint('Advanced', 'DB_PARTITION_RETENTION')
+except:
+	DB_PARTITION_RETENTION = 604800
+
+try:
+	DB_PARTITION_EXPIRE = config_file_parser.get('Advanced', 'DB_PARTITION_EXPIRE')
+except:
+	DB_PARTITION_EXPIRE = 'drop'
+
+try:
+	DB_PARTITION_CHECK_TIME = config_file_parser.getint('Advanced', 'DB_PARTITION_CHECK_TIME')
+except:
+	DB_PARTITION_CHECK_TIME = 3600
+
 # ******************** Stats Settings *********************
 
 BASIC_STATS = False		# Enable basic stats page. This has stats for ALL users. (Unessesary)
@@ -163,15 +388,48 @@ GW_DISABLE_MIDSTATE = False	# Disable midstate's (Faster but breaks some clients
 GW_SEND_REAL_TARGET = False	# Propigate >1 difficulty to Clients (breaks some clients)
 
 # ******************** Archival Settings *********************
-# Broken
 ARCHIVE_SHARES = False		# Use share archiving?
-ARCHIVE_DELAY = 86400		# Seconds after finding a share to archive all previous shares
+ARCHIVE_DELAY = 86400		# Shares older than this many seconds are archived
 ARCHIVE_MODE = 'file'		# Do we archive to a file (file) , or to a database table (db)
+ARCHIVE_INTERVAL = 3600		# Seconds between archive runs
+ARCHIVE_CHUNK = 10000		# Shares read, moved or deleted per statement
 
 # Archive file options
 ARCHIVE_FILE = 'archives/share_archive'	# Name of the archive file ( .csv extension will be appended)
-ARCHIVE_FILE_APPEND_TIME = True		# Append the Date/Time to the end of the filename (must be true for bzip2 compress)
+ARCHIVE_FILE_APPEND_TIME = True		# Append the Date/Time to the end of the filename (always done for bzip2 compress)
 ARCHIVE_FILE_COMPRESS = 'none'		# Method to compress file (none,gzip,bzip2)
+ARCHIVE_FILE_ROWS = 1000000		# Start a new file after this many shares
+
+# The defaults above are used for anything not set in the [Archive] section
+try:
+	ARCHIVE_SHARES = config_file_parser.getboolean('Archive', 'ARCHIVE_SHARES')
+except:
+	pass
+
+try:
+	ARCHIVE_DELAY = config_file_parser.getint('Archive', 'ARCHIVE_DELAY')
+except:
+	pass
+
+try:
+	ARCHIVE_MODE = config_file_parser.get('Archive', 'ARCHIVE_MODE')
+except:
+	pass
+
+try:
+	ARCHIVE_FILE = config_file_parser.get('Archive', 'ARCHIVE_FILE')
+except:
+	pass
+
+try:
+	ARCHIVE_FILE_APPEND_TIME = config_file_parser.getboolean('Archive', 'ARCHIVE_FILE_APPEND_TIME')
+except:
+	pass
+
+try:
+	ARCHIVE_FILE_COMPRESS = config_file_parser.get('Archive', 'ARCHIVE_FILE_COMPRESS')
+except:
+	pass
 
 # ******************** Worker Ban Options *********************
 # UNeeded
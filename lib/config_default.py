@@ -174,6 +174,15 @@ DATABASE_USER = 'marekp_bitcointe'
 DATABASE_PASSWORD = '**empty**'
 '''
 
+DATABASE_DRIVER = 'mysql'   # Options: sqlite, postgresql or mysql
+DB_SQLITE_FILE = 'pooldb.sqlite'
+DB_PGSQL_HOST = 'localhost'
+DB_PGSQL_DBNAME = 'pooldb'
+DB_PGSQL_USER = 'pooldb'
+DB_PGSQL_PASS = '**empty**'
+DB_PGSQL_SCHEMA = 'public'
+DB_PGSQL_PORT = 5432
+
 #VADRIFF
 # Variable Difficulty Enable
 VARIABLE_DIFF = False        # Master variable difficulty enable
@@ -198,16 +207,68 @@ SOLUTION_BLOCK_HASH = False # If enabled, send the block hash. If false send the
 # ******************** Adv. DB Settings *********************
 #  Don't change these unless you know what you are doing
 
-DB_LOADER_CHECKTIME = 15    # How often we check to see if we should run the loader
-DB_LOADER_REC_MIN = 1       # Min Records before the bulk loader fires
 DB_LOADER_REC_MAX = 50      # Max Records the bulk loader will commit at a time
-
-DB_LOADER_FORCE_TIME = 300      # How often the cache should be flushed into the DB regardless of size.
+DB_LOADER_MAX_AGE = 2       # Max seconds a share waits before being written regardless of batch size
+DB_LOADER_RETRY_TIME = 5    # Seconds to wait before retrying a batch that failed to import
 
 DB_STATS_AVG_TIME = 300     # When using the DATABASE_EXTEND option, average speed over X sec
                 #   Note: this is also how often it updates
-DB_USERCACHE_TIME = 600     # How long the usercache is good for before we refresh
+DB_USERCACHE_TIME = 600     # How long a worker stays in the usercache before it is looked up again
+DB_USERCACHE_SIZE = 100000  # Max workers in the usercache, the least recently used are dropped first
 DB_STATS_ENABLE = False		# Decides whether or not this process is responisble for updating pool statistics.
 
+DB_MAX_IMPORT_THREADS = 3   # Writers importing share batches at the same time
+DB_LOADER_ADAPTIVE = False  # Batch size and writers follow the load to keep queued shares younger than DB_LOADER_TARGET_AGE
+DB_LOADER_TARGET_AGE = 5.0  # Seconds, adaptive batching only
+DB_LOADER_REC_MIN = 10      # Smallest batch of adaptive batching
+DB_LOADER_ADAPTIVE_MAX = 5000   # Largest batch of adaptive batching
+DB_LOADER_INSERT_CHUNK = 500    # Rows per INSERT statement
+DB_SHARE_IMPORT_MODE = 'insert' # insert (multi-row INSERT) or loaddata (LOAD DATA LOCAL INFILE)
+DB_IMPORT_PARTITIONS = 1    # Hash partitions of worker names, each imported by its own writer (1 = off)
+DB_STATS_AGGREGATE_TIME = 1.0   # Seconds between round stats writes of the partitions
+DB_POOL_SIZE = 5            # Pooled database connections, DB_MAX_IMPORT_THREADS + 2 when not set
+DB_CHECKIN_INTERVAL = 0     # Write worker checkins at most every N seconds per worker, 0 writes them with every batch
+
+DB_SPOOL_ENABLE = False     # Spool queued shares to disk so a crash or restart doesn't lose them
+DB_SPOOL_DIR = 'spool/'
+DB_SPOOL_SEGMENT_RECORDS = 100000   # Shares per spool segment file
+DB_SPOOL_FSYNC_RECORDS = 1000       # fsync the spool after this many shares...
+DB_SPOOL_FSYNC_TIME = 1             # ... or this many seconds, whichever comes first
+
+DB_CONNECT_TIMEOUT = 5      # Seconds to wait for a connection to the database server
+DB_RECONNECT_MIN_DELAY = 1.0    # Connect attempts back off from this many seconds...
+DB_RECONNECT_MAX_DELAY = 60.0   # ... to this many while the database server is down
+DB_SLOW_QUERY_TIME = 1.0    # Statements slower than this many seconds are logged
+
+DB_AUTH_FAIL_CACHE_TIME = 30    # Seconds a failed authorization is remembered (0 = off)
+AUTH_THROTTLE_RATE = 0      # Failed authorizations per second an IP may make after AUTH_THROTTLE_BURST (0 = off)
+AUTH_THROTTLE_BURST = 20
+DB_DIFF_FLUSH_TIME = 0      # Seconds between bulk writes of worker difficulties (0 = at once)
+DB_WORKER_DIRECTORY = False # Hold pool_worker and its settings in memory
+DB_WORKER_SYNC_TIME = 30    # Seconds between syncs of changed workers...
+DB_WORKER_FULL_SYNC_TIME = 3600 # ... and of all workers
+
+DB_WRITER_PROCESS = False   # Run share and rollup imports in a separate writer process (share_writer.py)
+SHARE_ROLLUP = False        # With SAVE_SHARES off, roll shares up per worker, interval and block (share_rollups table)
+SHARE_ROLLUP_INTERVAL = 60
+
+DB_PARTITION_SHARES = False # MySQL only: RANGE partition the shares table on time
+DB_PARTITION_INTERVAL = 86400   # Seconds per partition
+DB_PARTITION_AHEAD = 3      # Partitions created ahead of time
+DB_PARTITION_RETENTION = 604800 # Seconds before a partition expires
+DB_PARTITION_EXPIRE = 'drop'    # drop or exchange (moved to a shares_<partition> table)
+DB_PARTITION_CHECK_TIME = 3600
+
+# Share archiving
+ARCHIVE_SHARES = False      # Use share archiving?
+ARCHIVE_DELAY = 86400       # Shares older than this many seconds are archived
+ARCHIVE_MODE = 'file'       # Do we archive to a file (file) , or to a database table (db)
+ARCHIVE_INTERVAL = 3600     # Seconds between archive runs
+ARCHIVE_CHUNK = 10000       # Shares read, moved or deleted per statement
+ARCHIVE_FILE = 'archives/share_archive' # Name of the archive file ( .csv extension will be appended)
+ARCHIVE_FILE_APPEND_TIME = True # Append the Date/Time to the end of the filename (always done for bzip2 compress)
+ARCHIVE_FILE_COMPRESS = 'none'  # Method to compress file (none,gzip,bzip2)
+ARCHIVE_FILE_ROWS = 1000000 # Start a new file after this many shares
+
 # More Options
 REJECT_STALE_SHARES = True
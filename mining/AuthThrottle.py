@@ -0,0 +1,68 @@
+import collections
+import time
+
+class AuthThrottle(object):
+	'''
+		Token bucket per IP for failed authorizations, used from the
+		reactor thread.
+
+		Every IP may fail 'burst' authorizations at once and 'rate' per
+		second after that.  Only failures take a token, so many workers
+		behind one address can still connect at the same moment.  An IP
+		without tokens left gets rejected before its worker is looked up.
+
+		At most 'max_ips' buckets are kept, the least recently used are
+		dropped first (a dropped bucket starts full again).
+	'''
+
+	def __init__(self, rate, burst, max_ips = 100000):
+		self.rate = rate
+		self.burst = max(burst, 1)
+		self.max_ips = max(max_ips, 1)
+
+		# ip -> [tokens, time of the last refill], least recently used first
+		self.buckets = collections.OrderedDict()
+
+		# Metrics
+		self.allowed = 0
+		self.throttled = 0
+		self.failures = 0
+
+	def refill(self, ip):
+		bucket = self.buckets.pop(ip, None)
+		now = time.time()
+		if bucket is None:
+			bucket = [self.burst, now]
+		else:
+			bucket[0] = min(bucket[0] + (now - bucket[1]) * self.rate, self.burst)
+			bucket[1] = now
+
+		# Back to the most recently used end
+		self.buckets[ip] = bucket
+		while len(self.buckets) > self.max_ips:
+			self.buckets.popitem(last = False)
+		return bucket
+
+	def allow(self, ip):
+		# False when 'ip' has used up its failures
+		bucket = self.buckets.get(ip)
+		if bucket is not None and self.refill(ip)[0] < 1:
+			self.throttled += 1
+			return False
+
+		self.allowed += 1
+		return True
+
+	def failed(self, ip):
+		# Lookups started together can fail after the bucket is empty, it doesn't go below empty
+		bucket = self.refill(ip)
+		bucket[0] = max(bucket[0] - 1, 0)
+		self.failures += 1
+
+	def stats(self):
+		return {
+			'ips': len(self.buckets),
+			'allowed': self.allowed,
+			'throttled': self.throttled,
+			'failures': self.failures
+		}
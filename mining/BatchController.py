@@ -0,0 +1,157 @@
+import math
+import time
+
+import lib.logger
+log = lib.logger.get_logger('BatchController')
+
+class BatchController(object):
+	'''
+		Picks the batch size and number of writers of the ShareBatcher to
+		keep the age of queued shares under 'target_age' seconds.
+
+		Every stored batch is a sample of (rows, latency).  A weighted
+		least squares fit over the samples splits the latency into a
+		fixed per-batch cost (round trips, commit) and a per-row cost.
+		From those and the measured arrival rate (with some headroom) the
+		controller works out the smallest batch one writer can keep up
+		with, and adds writers when one is not enough.
+
+		Hysteresis: increases apply at once, decreases only after they were
+		asked for SETTLE times in a row and changes of the batch size below
+		20% are ignored.  When the oldest queued share is older than the
+		target, everything goes to the maximum until the age is back under
+		half the target.
+	'''
+
+	# Throughput to have over the arrival rate
+	HEADROOM = 1.25
+	# Weight of the newest sample in the moving averages
+	SMOOTHING = 0.2
+	# Decisions in a row before a smaller batch or fewer writers are used
+	SETTLE = 5
+
+	def __init__(self, target_age, min_batch, max_batch, max_writers):
+		self.target_age = target_age
+		self.min_batch = max(min_batch, 1)
+		self.max_batch = max(max_batch, self.min_batch)
+		self.max_writers = max(max_writers, 1)
+
+		self.batch_size = self.min_batch
+		self.writers = 1
+
+		# Weighted moments of batch size (n) and latency (l): E[n], E[l], E[n*n], E[n*l]
+		self.moments = None
+
+		# Shares added since arrival_start
+		self.arrivals = 0
+		self.arrival_start = time.time()
+		self.arrival_rate = 0.0
+
+		self.draining = False
+		self.lower_votes = 0
+
+		# Metrics
+		self.decisions = 0
+		self.changes = 0
+		self.reason = 'start'
+
+	def arrived(self):
+		self.arrivals += 1
+
+	def record(self, rows, latency):
+		sample = (rows, latency, rows * rows, rows * latency)
+		if self.moments is None:
+			self.moments = sample
+		else:
+			self.moments = tuple([m + self.SMOOTHING * (s - m) for (m, s) in zip(self.moments, sample)])
+
+	def measure_rate(self):
+		now = time.time()
+		elapsed = now - self.arrival_start
+		if elapsed < 1:
+			return
+
+		rate = self.arrivals / elapsed
+		if self.arrival_rate == 0:
+			self.arrival_rate = rate
+		else:
+			self.arrival_rate += self.SMOOTHING * (rate - self.arrival_rate)
+		self.arrivals = 0
+		self.arrival_start = now
+
+	def costs(self):
+		# Returns (fixed seconds per batch, seconds per row)
+		(n, l, nn, nl) = self.moments
+		variance = nn - n * n
+		if variance > 0.01 * n * n:
+			per_row = (nl - n * l) / variance
+			fixed = l - per_row * n
+			if per_row >= 0 and fixed >= 0:
+				return (fixed, per_row)
+
+		# All batches about the same size, the split can't be told, assume half and half
+		return (l / 2.0, l / 2.0 / max(n, 1))
+
+	def decide(self, oldest_age):
+		# Returns the (batch size, writers) to use from now on
+		self.measure_rate()
+		if self.moments is None:
+			return (self.batch_size, self.writers)
+
+		self.decisions += 1
+		(fixed, per_row) = self.costs()
+		rate = self.arrival_rate * self.HEADROOM
+
+		if oldest_age > self.target_age:
+			self.draining = True
+		elif oldest_age < self.target_age / 2.0:
+			self.draining = False
+
+		if self.draining:
+			(batch_size, writers) = (self.max_batch, self.max_writers)
+			reason = "draining, oldest share %.1fs old" % oldest_age
+		else:
+			# One writer stores 'batch_size' rows every 'fixed + per_row * batch_size' seconds
+			if rate * per_row < 1:
+				batch_size = rate * fixed / (1 - rate * per_row)
+			else:
+				batch_size = self.max_batch
+			batch_size = min(max(int(math.ceil(batch_size)), self.min_batch), self.max_batch)
+
+			writers = rate * (fixed + per_row * batch_size) / batch_size
+			writers = min(max(int(math.ceil(writers)), 1), self.max_writers)
+			reason = "%.1f shares/s, %.1fms per batch + %.3fms per share" % (self.arrival_rate, fixed * 1000, per_row * 1000)
+
+		if abs(batch_size - self.batch_size) < 0.2 * self.batch_size:
+			batch_size = self.batch_size
+
+		if batch_size < self.batch_size or writers < self.writers:
+			self.lower_votes += 1
+			if self.lower_votes < self.SETTLE:
+				batch_size = max(batch_size, self.batch_size)
+				writers = max(writers, self.writers)
+		else:
+			self.lower_votes = 0
+
+		if (batch_size, writers) != (self.batch_size, self.writers):
+			log.info("Batch size %i -> %i, writers %i -> %i (%s)" % (self.batch_size, batch_size, self.writers, writers, reason))
+			(self.batch_size, self.writers) = (batch_size, writers)
+			self.lower_votes = 0
+			self.changes += 1
+			self.reason = reason
+
+		return (self.batch_size, self.writers)
+
+	def stats(self):
+		(fixed, per_row) = (0, 0) if self.moments is None else self.costs()
+		return {
+			'batch_size': self.batch_size,
+			'writers': self.writers,
+			'draining': self.draining,
+			'arrival_rate': self.arrival_rate,
+			'batch_cost': fixed,
+			'share_cost': per_row,
+			'decisions': self.decisions,
+			'changes': self.changes,
+			'reason': self.reason
+		}
@@ -0,0 +1,86 @@
+import threading
+import random
+import time
+
+class CircuitOpenError(Exception):
+	pass
+
+class CircuitBreaker(object):
+	'''
+		Decides when a database connection may be (re)opened, shared by
+		every connection of a driver.
+
+		closed:    the database is up, connecting is always allowed.
+		open:      the last connect failed, callers fail fast with
+		           CircuitOpenError until the backoff is over.
+		half-open: the backoff is over and one caller is probing the
+		           database, the others keep failing fast.
+
+		The backoff doubles with every failed attempt, from 'min_delay' up
+		to 'max_delay' seconds, with jitter so the connections of several
+		pool processes don't all come back at the same moment.  Nothing
+		sleeps, the next caller after the backoff makes the next attempt.
+	'''
+
+	def __init__(self, name, min_delay, max_delay):
+		self.name = name
+		self.min_delay = min_delay
+		self.max_delay = max_delay
+		self.lock = threading.Lock()
+
+		self.state = 'closed'
+		self.failures = 0
+		self.retry_at = 0
+
+		# Totals since startup
+		self.trips = 0
+		self.rejected = 0
+
+	def allow(self):
+		# True when the caller may try to connect, it must report the outcome with success() or failure()
+		with self.lock:
+			if self.state == 'closed':
+				return True
+
+			now = time.time()
+			if now < self.retry_at:
+				self.rejected += 1
+				return False
+
+			# This caller is the probe, the others wait for the next backoff in case it hangs
+			self.state = 'half-open'
+			self.retry_at = now + self.backoff()
+			return True
+
+	def check(self):
+		if not self.allow():
+			raise CircuitOpenError("%s is down, next connect attempt in %.1f seconds" % (self.name, max(self.retry_at - time.time(), 0)))
+
+	def success(self):
+		with self.lock:
+			self.state = 'closed'
+			self.failures = 0
+
+	def failure(self):
+		with self.lock:
+			if self.state == 'closed':
+				self.trips += 1
+
+			self.failures += 1
+			self.state = 'open'
+			self.retry_at = time.time() + self.backoff()
+			return self.retry_at
+
+	def backoff(self):
+		delay = min(self.min_delay * 2 ** min(max(self.failures - 1, 0), 16), self.max_delay)
+		return random.uniform(delay / 2.0, delay)
+
+	def stats(self):
+		with self.lock:
+			return {
+				'state': self.state,
+				'failures': self.failures,
+				'retry_in': max(self.retry_at - time.time(), 0) if self.state != 'closed' else 0,
+				'trips': self.trips,
+				'rejected': self.rejected
+			}
@@ -1,47 +1,255 @@
 from twisted.internet import reactor, defer
 import time
+import os
+import functools
 from datetime import datetime
-import Queue
 import signal
-import DB_Mysql
+import hashlib
+import DBPool
+import ShareBatcher
+import BatchController
+import ShareSpool
+import ShareRollup
+import ShareArchiver
+import ShareWriter
+import StatsAggregator
+import UserCache
+import AuthThrottle
+import WorkerDirectory
+import DifficultyWriter
+import conf.ConfigLoader as ConfigLoader
 import lib.settings as settings
 import lib.logger
 
 log = lib.logger.get_logger('DBInterface')
 
+# Seconds a block candidate waits for its found_block() (submitblock result) before it is forgotten
+BLOCK_CANDIDATE_TIMEOUT = 600
+
 class DBInterface():
 	def __init__(self):
-		# Initialize the MySQL database driver and put it in self.DATABASE
-		log.debug('DB_Mysql INIT')
-		self.DATABASE = DB_Mysql.DB_Mysql()
+		# Initialize the database driver and put it in self.DATABASE
+		self.driver = self.get_driver()
+		self.DATABASE = self.driver()
+
+	def get_driver(self):
+		# Drivers are imported on demand so only the client library of the selected one has to be installed
+		if settings.DATABASE_DRIVER == 'sqlite':
+			log.debug('DB_Sqlite INIT')
+			import DB_Sqlite
+			return DB_Sqlite.DB_Sqlite
+		elif settings.DATABASE_DRIVER == 'postgresql':
+			log.debug('DB_Postgresql INIT')
+			import DB_Postgresql
+			return DB_Postgresql.DB_Postgresql
+		elif settings.DATABASE_DRIVER == 'mysql':
+			log.debug('DB_Mysql INIT')
+			import DB_Mysql
+			return DB_Mysql.DB_Mysql
+
+		raise ValueError("Unsupported DATABASE_DRIVER '%s', use sqlite, postgresql or mysql" % settings.DATABASE_DRIVER)
 
 	def init_main(self):
 		self.DATABASE.check_tables()
+
+		# Share, block and checkin writers look up worker ids in memory
+		self.DATABASE.preload_worker_ids()
+
+		# Imports and other writes run on pooled connections, off the reactor thread
+		self.pool = DBPool.DBPool(self.driver, settings.DB_POOL_SIZE)
  
-		self.QUEUE = Queue.Queue()
-		self.QUEUE_OVERLOADED = False
-		self.OVERLOADED_QUEUE_BATCH_SIZE = settings.DB_LOADER_REC_MAX
-		self.queueclock = None
+		# Share and rollup imports can run in a separate writer process, off this process' GIL
+		self.writer = None
+		if settings.DB_WRITER_PROCESS:
+			script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'share_writer.py')
+			self.writer = ShareWriter.ShareWriter(script, ConfigLoader.CONFIG_FILE, settings.DB_LOADER_RETRY_TIME)
+			# After the batcher has stopped ('before'), the writer finishes its calls and writes its checkins
+			reactor.addSystemEventTrigger('during', 'shutdown', self.writer.close)
+
+		# Height of the last block found by the pool, shares mined up to it still in the batcher when the round
+		# was reset belong to the round that is over and are left out of the round totals (see current_round())
+		self.round_height = None
+
+		# Shares are written in batches by size or age, whichever comes first
+		self.aggregator = None
+		if settings.DB_IMPORT_PARTITIONS > 1:
+			# One batcher per hash partition of worker names, each with its own connection
+			log.info("Importing shares in %i worker partitions" % settings.DB_IMPORT_PARTITIONS)
+			self.aggregator = StatsAggregator.StatsAggregator(self.write_round_stats, settings.DB_STATS_AGGREGATE_TIME)
+
+			spool_dirs = [os.path.join(settings.DB_SPOOL_DIR, str(partition)) for partition in range(settings.DB_IMPORT_PARTITIONS)]
+			buffers = [self.share_buffer(path) for path in spool_dirs]
+			self.migrate_spools(spool_dirs, buffers)
+
+			batchers = []
+			for buffer in buffers:
+				pool = DBPool.DBPool(self.driver, 1) if self.writer is None else None
+				batchers.append(ShareBatcher.ShareBatcher(functools.partial(self.write_partition, pool),
+										settings.DB_LOADER_REC_MAX,
+										settings.DB_LOADER_MAX_AGE,
+										1,
+										settings.DB_LOADER_RETRY_TIME,
+										buffer,
+										self.batch_controller(1)))
+			self.batcher = ShareBatcher.PartitionedBatcher(batchers)
+		else:
+			buffer = self.share_buffer(settings.DB_SPOOL_DIR)
+			self.migrate_spools([settings.DB_SPOOL_DIR], [buffer])
+
+			self.batcher = ShareBatcher.ShareBatcher(self.write_shares,
+									settings.DB_LOADER_REC_MAX,
+									settings.DB_LOADER_MAX_AGE,
+									settings.DB_MAX_IMPORT_THREADS,
+									settings.DB_LOADER_RETRY_TIME,
+									buffer,
+									self.batch_controller(settings.DB_MAX_IMPORT_THREADS))
+		reactor.addSystemEventTrigger('before', 'shutdown', self.batcher.close)
+
+		# Without per-share rows, shares can be stored as per-worker rollups
+		self.rollup = None
+		if not settings.SAVE_SHARES and settings.SHARE_ROLLUP:
+			log.info("Storing share rollups every %i seconds" % settings.SHARE_ROLLUP_INTERVAL)
+			self.rollup = ShareRollup.ShareRollup(self.write_rollups, settings.SHARE_ROLLUP_INTERVAL)
+
+		# Authorized workers, entries expire one by one after about DB_USERCACHE_TIME seconds
+		self.usercache = UserCache.UserCache(settings.DB_USERCACHE_TIME, settings.DB_USERCACHE_SIZE)
+
+		# Failed authorizations, so repeated bad credentials don't query the database (DB_AUTH_FAIL_CACHE_TIME 0 = off)
+		self.failcache = None
+		if settings.DB_AUTH_FAIL_CACHE_TIME > 0:
+			self.failcache = UserCache.UserCache(settings.DB_AUTH_FAIL_CACHE_TIME, settings.DB_USERCACHE_SIZE)
+
+		# Failed authorizations per IP are limited by mining.authorize (AUTH_THROTTLE_RATE 0 = off)
+		self.auth_throttle = None
+		if settings.AUTH_THROTTLE_RATE > 0:
+			self.auth_throttle = AuthThrottle.AuthThrottle(settings.AUTH_THROTTLE_RATE, settings.AUTH_THROTTLE_BURST)
+
+		# Workers and their settings are loaded once and then synced, lookups don't query the database
+		self.workers = None
+		if settings.DB_WORKER_DIRECTORY:
+			self.workers = WorkerDirectory.WorkerDirectory(self.pool, settings.DB_WORKER_SYNC_TIME, settings.DB_WORKER_FULL_SYNC_TIME)
+			self.workers.start(self.DATABASE)
+
+		# Old shares are moved out of the shares table in the background
+		self.archiver = None
+		if settings.ARCHIVE_SHARES:
+			log.info("Archiving shares older than %i seconds (%s)" % (settings.ARCHIVE_DELAY, settings.ARCHIVE_MODE))
+			self.archiver = ShareArchiver.ShareArchiver(self.pool)
+
+		# Share partitions are created ahead of time and expired by a maintenance task (MySQL only)
+		self.partitionclock = None
+		if settings.DB_PARTITION_SHARES:
+			if hasattr(self.DATABASE, 'maintain_partitions'):
+				self.partitionclock = reactor.callLater(0, self.maintain_partitions)
+			else:
+				log.warning("DB_PARTITION_SHARES is not supported by the %s driver" % settings.DATABASE_DRIVER)
 
-		self.usercache = {}
-		self.clearusercache()
+		# Vardiff changes are collected and written as one bulk update every DB_DIFF_FLUSH_TIME seconds (0 = at once)
+		self.diffwriter = None
+		if settings.DB_DIFF_FLUSH_TIME > 0:
+			self.diffwriter = DifficultyWriter.DifficultyWriter(self.write_worker_diffs, settings.DB_DIFF_FLUSH_TIME)
+
+		# Block candidates being written, solution hash -> Deferred firing the shares.id of the row
+		self.block_candidates = {}
+
+		# Authorization lookups in progress, wid -> list of waiting Deferreds
+		self.auth_lookups = {}
+
+		# Checkins held back by DB_CHECKIN_INTERVAL are written even when a worker stops submitting
+		self.checkinclock = None
+		if settings.DB_CHECKIN_INTERVAL > 0:
+			self.scheduleCheckins()
 
 		self.statsclock = None
 		self.nextStatsUpdate = 0
 
-		self.scheduleImport()
 		self.scheduleStats()
 
-		self.next_force_import_time = time.time() + settings.DB_LOADER_FORCE_TIME
+		signal.signal(signal.SIGINT, self.signal_handler)
 
-		self.CURRENT_NUMBEROF_IMPORT_THREADS = 0
+	def share_buffer(self, path):
+		# Queued shares are kept on disk when spooling is enabled, in memory otherwise
+		if settings.DB_SPOOL_ENABLE:
+			log.info("Spooling shares to %s" % path)
+			return ShareSpool.ShareSpool(path,
+							settings.DB_SPOOL_SEGMENT_RECORDS,
+							settings.DB_SPOOL_FSYNC_RECORDS,
+							settings.DB_SPOOL_FSYNC_TIME)
+
+		return ShareBatcher.MemoryBuffer()
+
+	def migrate_spools(self, spool_dirs, buffers):
+		# Spools of an earlier DB_IMPORT_PARTITIONS (DB_SPOOL_DIR itself or its numbered subdirectories)
+		# would never be replayed, their shares are moved into 'buffers' by worker partition
+		if not settings.DB_SPOOL_ENABLE or not os.path.isdir(settings.DB_SPOOL_DIR):
+			return
 
-		signal.signal(signal.SIGINT, self.signal_handler)
+		candidates = [settings.DB_SPOOL_DIR] + [os.path.join(settings.DB_SPOOL_DIR, name) for name in sorted(os.listdir(settings.DB_SPOOL_DIR))
+								if name.isdigit() and os.path.isdir(os.path.join(settings.DB_SPOOL_DIR, name))]
+
+		for path in candidates:
+			if path in spool_dirs:
+				continue
+
+			spool = ShareSpool.ShareSpool(path,
+							settings.DB_SPOOL_SEGMENT_RECORDS,
+							settings.DB_SPOOL_FSYNC_RECORDS,
+							settings.DB_SPOOL_FSYNC_TIME)
+			moved = 0
+			while spool.depth() > 0:
+				(token, batch) = spool.take(settings.DB_SPOOL_SEGMENT_RECORDS)
+				if not batch:
+					break
+
+				for item in batch:
+					buffers[ShareBatcher.worker_partition(item[0], len(buffers))].put(item)
+
+				# On disk in the new spools before they are gone from the old one, a crash may replay them twice but never loses them
+				for buffer in buffers:
+					buffer.sync()
+				spool.ack(token)
+				moved += len(batch)
+
+			spool.close()
+			if moved > 0:
+				log.warning("Moved %i spooled share(s) from %s to the spools of %i import partition(s)" % (moved, path, len(buffers)))
+
+	def batch_controller(self, max_writers):
+		# Batch size and writers follow the load to keep the queue age under DB_LOADER_TARGET_AGE
+		if not settings.DB_LOADER_ADAPTIVE:
+			return None
+
+		return BatchController.BatchController(settings.DB_LOADER_TARGET_AGE,
+							settings.DB_LOADER_REC_MIN,
+							settings.DB_LOADER_ADAPTIVE_MAX,
+							max_writers)
 
 	def signal_handler(self, signal, frame):
 		log.warning("SIGINT Detected, shutting down")
 		log.info("Flushing shares into database")
-		self.do_import(self.DATABASE, True)
+		try:
+			self.batcher.drain(lambda data: self.DATABASE.import_shares(data, False, True, self.round_height))
+		except Exception as e:
+			log.error("Flushing shares failed: %s" % e.args[0])
+		if self.rollup is not None:
+			try:
+				self.rollup.drain(lambda data: self.DATABASE.import_rollups(data, self.round_height))
+			except Exception as e:
+				log.error("Flushing share rollups failed: %s" % e.args[0])
+		if self.aggregator is not None:
+			try:
+				self.aggregator.drain(self.DATABASE.add_round_stats)
+			except Exception as e:
+				log.error("Flushing round stats failed: %s" % e.args[0])
+		try:
+			self.DATABASE.flush_worker_checkins()
+		except Exception as e:
+			log.error("Flushing worker checkins failed: %s" % e.args[0])
+		if self.diffwriter is not None:
+			try:
+				self.diffwriter.drain(self.DATABASE.update_worker_diffs)
+			except Exception as e:
+				log.error("Flushing worker difficulties failed: %s" % e.args[0])
 		reactor.stop()
 
 	def set_bitcoinrpc(self, bitcoinrpc):
@@ -49,57 +257,86 @@ class DBInterface():
 
 	def clearusercache(self):
 		log.debug("DBInterface.clearusercache called")
-		self.usercache = {}
-		self.usercacheclock = reactor.callLater(settings.DB_USERCACHE_TIME , self.clearusercache)
-
-	def scheduleImport(self):
-		log.debug("Scheduling next queue run check %s seconds from now." % settings.DB_LOADER_CHECKTIME)
-		self.queueclock = reactor.callLater(settings.DB_LOADER_CHECKTIME , self.run_import_thread)
+		self.usercache.clear()
+		if self.failcache is not None:
+			self.failcache.clear()
 
 	def scheduleStats(self):
 		self.statsclock = reactor.callLater(settings.DB_STATS_AVG_TIME , self.stats_thread)
 
-	def run_import_thread(self):
-		log.debug("Share queue has %d item(s)", self.QUEUE.qsize())
-
-		# Don't incur thread overhead if we're not going to run
-		# 1. Queue must not be empty
-		# 2. If queue is not empty, then at least one of these two conditions are met
-		# 	a. Queue has at least DB_LOADER_REC_MIN number of items
-		# 	b. It's time to force an import
-		if self.QUEUE.qsize() > 0 and (self.QUEUE.qsize() >= settings.DB_LOADER_REC_MIN or time.time() >= self.next_force_import_time):
-			# Import thread will run, next runtime will be scheduled from within the import_thread function
-			log.debug("Shares queue: import will run at this time.")
-			reactor.callInThread(self.import_thread)
-			log.debug("Shares queue: import process has been requested.")
+	def scheduleCheckins(self):
+		self.checkinclock = reactor.callLater(settings.DB_CHECKIN_INTERVAL, self.flush_checkins)
+
+	def flush_checkins(self):
+		d = self.pool.runMethod('flush_worker_checkins')
+		d.addErrback(self.log_failure, "Writing worker checkins failed")
+		if self.writer is not None:
+			d = self.writer.call('flush_worker_checkins')
+			d.addErrback(self.log_failure, "Writing worker checkins failed")
+		self.scheduleCheckins()
+
+	def maintain_partitions(self):
+		self.partitionclock = reactor.callLater(settings.DB_PARTITION_CHECK_TIME, self.maintain_partitions)
+		d = self.pool.runMethod('maintain_partitions')
+		d.addErrback(self.log_failure, "Share partition maintenance failed")
+
+	def write_shares(self, data):
+		# Called by the batcher, the import runs on a pooled connection or in the writer process
+		if not data:
+			return defer.succeed(None)
+
+		if self.writer is None:
+			return self.pool.runMethod('import_shares', data, False, True, self.round_height)
+
+		d = self.writer.call('import_shares', data, False, True, self.round_height)
+		rows = self.current_round(data, 7)
+		d.addCallback(self.add_round_stats, sum([v[3] for v in rows]), max([v[10] for v in rows] + [0]))
+		return d
+
+	def write_partition(self, pool, data):
+		# Called by the batcher of a worker partition, the round totals are published by the aggregator
+		if not data:
+			return defer.succeed(None)
+
+		if self.writer is None:
+			d = pool.runMethod('import_shares', data, False, False)
 		else:
-			# Import thread will not run, we should schedule next runtime
-			log.debug("Shares queue: import not nessecary at this time.")
-			self.scheduleImport()
+			d = self.writer.call('import_shares', data, False, False)
 
-	def import_thread(self, onetime = False):
-		# Update number of running threads
-		self.CURRENT_NUMBEROF_IMPORT_THREADS = self.CURRENT_NUMBEROF_IMPORT_THREADS + 1
+		rows = self.current_round(data, 7)
+		d.addCallback(self.aggregate_round_stats, sum([v[3] for v in rows]), max([v[10] for v in rows] + [0]))
+		return d
 
-		log.info("Shares import thread has started running...")
-		# Create a new database connection for use in this thread
-		# Since this is called Asyncronosly
-		try:
-			database = DB_Mysql.DB_Mysql()
-		except Exception as e:
-			log.error("Import thread failed: %s" % e.args[0])
-			return
+	def aggregate_round_stats(self, result, total_shares, best_diff):
+		self.aggregator.add(total_shares, best_diff)
+		return result
 
-		# Do the deed
-		self.do_import(database, False)
-		database.close()
+	def write_round_stats(self, total_shares, best_diff):
+		return self.pool.runMethod('add_round_stats', total_shares, best_diff)
+
+	def write_rollups(self, data):
+		# Called by the rollup timer, the import runs on a pooled connection or in the writer process
+		if self.writer is None:
+			return self.pool.runMethod('import_rollups', data, self.round_height)
+
+		d = self.writer.call('import_rollups', data, self.round_height)
+		rows = self.current_round(data, 2)
+		d.addCallback(self.add_round_stats, sum([v[4] + v[6] for v in rows]), max([v[7] for v in rows] + [0]))
+		return d
 
-		# Update number of running threads, never drops below 0
-		self.CURRENT_NUMBEROF_IMPORT_THREADS = max(self.CURRENT_NUMBEROF_IMPORT_THREADS -1, 0)
+	def current_round(self, data, height):
+		# The rows of 'data' whose block height (at index 'height') is past the last found block
+		if self.round_height is None:
+			return data
+		return [v for v in data if v[height] > self.round_height]
 
-		# Schedule next runtime unless this was requested as a single run time
-		if not onetime:
-			self.scheduleImport()
+	def add_round_stats(self, result, total_shares, best_diff):
+		# The writer process keeps its own round totals, these are the ones reported by get_stats()
+		self.DATABASE.ROUND_STATS.add(total_shares, best_diff)
+		return result
+
+	def log_failure(self, failure, message):
+		log.error("%s: %s" % (message, failure.getErrorMessage()))
 
 	# Statistics are no longer handled by the startum service.  Now done by Backoffice.
 	def stats_thread(self):
@@ -119,158 +356,185 @@ class DBInterface():
 			except:
 				log.error("Stats update failed: %s", e.args[0])
 
-	def do_import(self, dbi, force):
-		log.debug("DBInterface.do_import called. force: %s, queue size: %s", 'yes' if force == True else 'no', self.QUEUE.qsize())
-		
-		# Flush the whole queue on force
-		forcesize = 0
-		if force == True:
-			forcesize = self.QUEUE.qsize()
-
-		# To help us determine how long it takes to import a batch of shares
-		start_time = None
-		avg_batch_processing_time_seconds = 0
-		queue_processing_time_seconds = 0
-		total_runs = 0
-
-		# Only run if we have data
-		while self.QUEUE.empty() == False and (force == True or self.QUEUE.qsize() >= settings.DB_LOADER_REC_MIN or time.time() >= self.next_force_import_time or forcesize > 0):
-			log.debug("Share queue size is %i" % self.QUEUE.qsize())
-			self.next_force_import_time = time.time() + settings.DB_LOADER_FORCE_TIME
-
-			# Time this import run has started
-			start_time = time.time()
-
-			force = False
-			# Put together the data we want to import
-			sqldata = []
-			datacnt = 0
-
-			if self.QUEUE_OVERLOADED:
-				# Increased batch size
-				batch_size = self.OVERLOADED_QUEUE_BATCH_SIZE
-			else:
-				# Normal size batches
-				batch_size = settings.DB_LOADER_REC_MAX 
-
-			log.debug("Loading Share Records from queue")
-			while self.QUEUE.empty() == False and datacnt < batch_size:
-				datacnt += 1
-				try:
-					data = self.QUEUE.get(timeout=1)
-					sqldata.append(data)
-					self.QUEUE.task_done()
-				except Queue.Empty:
-					log.warning("Share Records Queue is empty!")
-
-			log.info("%i share records loaded, %i share records remain in queue." % (datacnt, self.QUEUE.qsize()))
-			forcesize -= datacnt
-
-			# try to do the import, if we fail, log the error and put the data back in the queue
-			try:
-				log.debug("Inserting %i Share Records", datacnt)
-				dbi.import_shares(sqldata)
-			except Exception as e:
-				log.error("Insert Share Records Failed.  Error: %s", e.args[0])
-				for k, v in enumerate(sqldata):
-					self.QUEUE.put(v)
-				break  # Allows us to sleep a little
-
-			# Total time in seconds it took to import a batch of shares in the current run
-			batch_processing_time_seconds = max(time.time() - start_time, 0)
-
-			# Lets keep track of how long the whole thing could take
-			queue_processing_time_seconds = queue_processing_time_seconds + batch_processing_time_seconds
-			# Keep a running average
-			total_runs = total_runs + 1
-			avg_batch_processing_time_seconds = queue_processing_time_seconds / total_runs
-			log.debug("Took %i seconds(s) to import %i shares, AVG: %s." % (batch_processing_time_seconds, datacnt, avg_batch_processing_time_seconds))
-
-			# Lets get an estimate of how long it will take this thread to finsh importing the queue based on it's
-			# current size (self.QUEUE.qsize()), the batch size (DB_LOADER_REC_MAX), 
-			# and the wait time (DB_LOADER_FORCE_TIME).
-
-			# Lets take a snapshot of the current size of the queue
-			current_queue_size = self.QUEUE.qsize()
-
-			# Number of batches that need to be processed
-			number_of_batches = (current_queue_size + (batch_size - 1)) // batch_size
-			log.debug("Aproximatly %i batche(s) remain." % number_of_batches)
-
-			# Total seconds needed to process all batches
-			# 1 batch is done every 'avg_batch_processing_time_seconds' 
-			total_time_seconds = (avg_batch_processing_time_seconds * number_of_batches) / max(self.CURRENT_NUMBEROF_IMPORT_THREADS, 1)
-			log.debug("Aproximatly %i seconds(s) needed to process entire queue." % total_time_seconds)
-
-			# Remove overload if the queue time is less than 20 minutes
-			if self.QUEUE_OVERLOADED and total_time_seconds <= 1200:
-				self.QUEUE_OVERLOADED = False
-
-			# Issue a warning if the time is more that 30 minutes
-			if total_time_seconds >= 1800:
-				log.warning("Large share queue detected (%s items), aproximatly %s hours(s) needed to process entire queue." % (current_queue_size, (total_time_seconds / 60 / 60)))
-
-			# Take some action if it's more than 1 hour, increase the batch size to 15% of the number of batches plus current batch size
-			if total_time_seconds >= 3600:
-				self.QUEUE_OVERLOADED = True
-				self.OVERLOADED_QUEUE_BATCH_SIZE = abs((0.15 * number_of_batches) + batch_size)
-				log.warning("Temporaroly increased batch size to: %i" % self.OVERLOADED_QUEUE_BATCH_SIZE)
-
-			# Start another thread if the overload coninues beyond 3 hours estimate
-			if (total_time_seconds) >= 10800 and self.CURRENT_NUMBEROF_IMPORT_THREADS < settings.DB_MAX_IMPORT_THREADS:
-				# Start anew one time thread (True means it's single use, won't get rescheduled)
-				reactor.callInThread(self.import_thread, True)
-				log.warning("Spawned new import thread")
-
-		log.debug("Import took %i seconds(s)" % (queue_processing_time_seconds))
+	def get_stats(self):
+		stats = {
+			'share_queue': self.batcher.stats(),
+			'round': self.DATABASE.ROUND_STATS.stats()
+		}
+
+		# Drivers of database servers have a circuit breaker
+		if hasattr(self.DATABASE, 'BREAKER'):
+			stats['connection'] = self.DATABASE.BREAKER.stats()
+
+		# Statement timings of this process, the writer process (DB_WRITER_PROCESS) keeps its own
+		if hasattr(self.DATABASE, 'QUERY_STATS'):
+			stats['queries'] = self.DATABASE.QUERY_STATS.stats()
+
+		if self.archiver is not None:
+			stats['archive'] = self.archiver.stats()
+
+		if self.writer is not None:
+			stats['writer'] = self.writer.stats()
+
+		if self.aggregator is not None:
+			stats['round_aggregator'] = self.aggregator.stats()
+
+		stats['usercache'] = self.usercache.stats()
+
+		if self.failcache is not None:
+			stats['failcache'] = self.failcache.stats()
+
+		if self.auth_throttle is not None:
+			stats['auth_throttle'] = self.auth_throttle.stats()
+
+		if self.workers is not None:
+			stats['workers'] = self.workers.stats()
+
+		if self.diffwriter is not None:
+			stats['difficulty_writes'] = self.diffwriter.stats()
+
+		return stats
 
 	def queue_share(self, data):
 		if settings.SAVE_SHARES:
-			self.QUEUE.put(data)
+			self.batcher.add(data)
+		elif self.rollup is not None:
+			self.rollup.add(data)
 		else:
 			log.info("Doing somthing else with shares")
 
+	def queue_block_candidate(self, data):
+		# Block candidates skip the batcher and are written at once, found_block() then updates the row by id
+		if not settings.SAVE_SHARES:
+			return self.queue_share(data)
+
+		d = self.pool.runMethod('import_block_candidate', data)
+		d.addErrback(self.block_candidate_failed, data)
+		self.block_candidates[data[2]] = d
+		# found_block() may never come, the share row is looked up then (see update_found_block())
+		reactor.callLater(BLOCK_CANDIDATE_TIMEOUT, self.block_candidates.pop, data[2], None)
+
+	def block_candidate_failed(self, failure, data):
+		# The share is not lost, it goes through the batcher like any other
+		log.error("Writing block candidate failed, queueing it instead: %s" % failure.getErrorMessage())
+		self.batcher.add(data)
+		return None
+
 	def found_block(self, data):
-		try:
-			if settings.SAVE_SHARES:
-				log.info("Updating Found Block Share Record")
-				# We can't Update if the record is not there.
-				# Forcable make the database import waiting shares
-				self.do_import(self.DATABASE, True)  
-				self.DATABASE.found_block(data)
-			else:
-				log.info("Inserting found block")
-				# There is no cncept of 'shares' stored in the database, we insert the information as new
+		# The round ends with this block, shares of its height or below that are still queued don't count for the next one
+		if self.DATABASE.database_extend and data[5] == True and (self.round_height is None or data[7] > self.round_height):
+			self.round_height = data[7]
 
-		except Exception as e:
-			log.error("Update Found Block Share Record Failed: %s", e.args[0])
+		if settings.SAVE_SHARES:
+			log.info("Updating Found Block Share Record")
+			d = self.block_candidates.pop(data[2], None)
+			if d is None:
+				d = defer.succeed(None)
+			d.addCallback(self.update_found_block, data)
+		else:
+			log.info("Inserting found block")
+			# There is no cncept of 'shares' stored in the database, we insert the information as new
+			d = self.pool.runMethod('insert_block_share', data)
+
+		d.addErrback(self.log_failure, "Update Found Block Share Record Failed")
+		return d
+
+	def update_found_block(self, share_id, data):
+		if share_id is not None:
+			return self.pool.runMethod('found_block', data, share_id)
+
+		# The candidate went through the batcher (or was forgotten), its row is looked up once it is stored
+		d = self.pool.runMethod('get_block_share_id', data)
+		d.addCallback(self.block_share_found, data)
+		return d
+
+	def block_share_found(self, share_id, data):
+		if share_id is not None:
+			return self.pool.runMethod('found_block', data, share_id)
+
+		# We can't Update if the record is not there, look again after the next flush while shares are waiting
+		stats = self.batcher.stats()
+		if stats['queue_depth'] > 0 or stats['writers'] > 0:
+			d = defer.Deferred()
+			reactor.callLater(settings.DB_LOADER_MAX_AGE, d.callback, None)
+			d.addCallback(self.update_found_block, data)
+			return d
+
+		# Nothing is waiting, the share never made it: the block gets a row of its own
+		log.warning("Share of found block %s not stored, inserting it" % data[2])
+		return self.pool.runMethod('insert_block_share', data)
 
 	def check_password(self, username, password):
+		# Returns a Deferred firing True or False, cache misses are looked up on a pooled connection
+		# It fails with the error of the lookup when the database could not be asked
 		if username == "":
 			log.info("Rejected worker for blank username")
-			return False
+			return defer.succeed(False)
 
 		# Force username and password to be strings
 		username = str(username)
 		password = str(password)
 		wid = username + ":-:" + password
 
-		if wid in self.usercache:
-			return True
-		elif not settings.USERS_CHECK_PASSWORD and self.user_exists(username): 
-			self.usercache[wid] = 1
+		if self.usercache.get(wid):
+			return defer.succeed(True)
+
+		# Recently failed, the password is kept as a digest only
+		fid = username + ":-:" + hashlib.sha1(password).hexdigest()
+		if self.failcache is not None and self.failcache.get(fid):
+			return defer.succeed(False)
+
+		# Known workers are checked in memory, the others may have been added since the last sync or are added now
+		if self.workers is not None and self.workers.check_password(username, self.DATABASE.hash_pass(password), settings.USERS_CHECK_PASSWORD):
+			self.usercache.add(wid, username)
+			return defer.succeed(True)
+
+		# A lookup started before the worker is invalidated must not cache its result
+		generation = self.usercache.generation(username)
+
+		# Concurrent lookups for the same worker share one query
+		if wid not in self.auth_lookups:
+			self.auth_lookups[wid] = []
+			d = self.pool.runInteraction(self.authorize_worker, username, password)
+			d.addCallbacks(self.authorize_done, self.authorize_failed, callbackArgs=(wid, fid, username, generation), errbackArgs=(wid, username))
+
+		waiting = defer.Deferred()
+		self.auth_lookups[wid].append(waiting)
+		return waiting
+
+	def authorize_worker(self, database, username, password):
+		# Runs in a pool thread
+		if not settings.USERS_CHECK_PASSWORD and database.get_user(username) is not None:
 			return True
-		elif self.DATABASE.check_password(username, password):
-			self.usercache[wid] = 1
+		elif database.check_password(username, password):
 			return True
 		elif settings.USERS_AUTOADD == True:
-			self.insert_user(username, password)
-			self.usercache[wid] = 1
+			database.insert_user(username, password)
 			return True
 
-		log.info("Authentication for %s failed" % username)
 		return False
 
+	def authorize_done(self, result, wid, fid, username, generation):
+		if not result:
+			log.info("Authentication for %s failed" % username)
+
+		# Results of lookups started before the worker was changed are not cached
+		if self.usercache.generation(username) == generation:
+			if result:
+				self.usercache.add(wid, username)
+			elif self.failcache is not None:
+				self.failcache.add(fid, username)
+
+		for waiting in self.auth_lookups.pop(wid, []):
+			waiting.callback(result)
+
+	def authorize_failed(self, failure, wid, username):
+		log.error("Authentication lookup for %s failed: %s" % (username, failure.getErrorMessage()))
+
+		# Not a wrong password, nothing is cached and the callers can tell (see MiningService.authorize)
+		for waiting in self.auth_lookups.pop(wid, []):
+			waiting.errback(failure)
+
 	def list_users(self):
 		return self.DATABASE.list_users()
 
@@ -280,26 +544,114 @@ class DBInterface():
 	def get_user_settings(self, id):
 		return self.DATABASE.get_user_settings(id)
 
+	def get_worker(self, username):
+		# Returns a Deferred firing the pool_worker row of 'username' with its custom_diff_enable setting, or None
+		# Without DB_WORKER_DIRECTORY the row is looked up on a pooled connection
+		if self.workers is not None:
+			return defer.succeed(self.with_pending_difficulty(self.workers.get(username)))
+
+		d = self.pool.runInteraction(self.lookup_worker, username)
+		d.addCallback(self.with_pending_difficulty)
+		return d
+
+	def lookup_worker(self, database, username):
+		# Runs in a pool thread
+		worker = database.get_user(username)
+		if worker is None or 'difficulty' not in worker:
+			return None
+
+		worker_settings = database.get_user_settings(worker['id'])
+		worker['custom_diff_enable'] = worker_settings['custom_diff_enable'] if worker_settings is not None else 0
+		return worker
+
+	def with_pending_difficulty(self, worker):
+		# The database, and the worker directory synced from it, may not have the latest difficulty yet
+		if worker is None or self.diffwriter is None:
+			return worker
+
+		difficulty = self.diffwriter.get(worker['username'])
+		if difficulty is None:
+			return worker
+
+		# Rows of the worker directory are shared, the copy gets the pending difficulty
+		return dict(worker, difficulty = difficulty)
+
 	def user_exists(self, username):
 		user = self.DATABASE.get_user(username)
 		return user is not None 
 
 	def insert_user(self, username, password):
+		self.uncache_user(username)
 		return self.DATABASE.insert_user(username, password)
 
 	def delete_user(self, username):
-		self.usercache = {}
+		self.uncache_user(username)
 		return self.DATABASE.delete_user(username)
 
 	def update_user(self, username, password):
-		self.usercache = {}
+		self.uncache_user(username)
 		return self.DATABASE.update_user(username, password)
 
+	def auth_generation(self, username):
+		# Changes when the authorizations of 'username' are revoked, see UserCache
+		return self.usercache.generation(username)
+
+	def uncache_user(self, id_or_username):
+		# The caches are filed by username.  The drivers take digit strings as an id or a username,
+		# both are dropped, a user whose id can't be resolved takes the whole caches with it.
+		usernames = []
+		if isinstance(id_or_username, basestring):
+			usernames.append(str(id_or_username))
+
+		if isinstance(id_or_username, (int, long)) or str(id_or_username).isdigit():
+			username = self.username_of(int(id_or_username))
+			if username is None:
+				log.info("Worker id %s not found, clearing the authorization caches" % id_or_username)
+				self.clearusercache()
+				if self.workers is not None:
+					self.workers.reload()
+				return
+			usernames.append(username)
+
+		for username in usernames:
+			self.usercache.invalidate(username)
+			if self.failcache is not None:
+				self.failcache.invalidate(username)
+			# Looked up again after the next sync
+			if self.workers is not None:
+				self.workers.remove(username)
+
+	def username_of(self, worker_id):
+		# Returns the username of 'worker_id' or None
+		try:
+			worker = self.DATABASE.get_user(str(worker_id))
+		except Exception as e:
+			log.error("Looking up worker id %s failed: %s" % (worker_id, e))
+			return None
+
+		if worker is None or int(worker['id']) != worker_id:
+			return None
+		return str(worker['username'])
+
 	def update_worker_diff(self, username, diff):
-		return self.DATABASE.update_worker_diff(username, diff)
+		if self.workers is not None:
+			self.workers.set_difficulty(username, diff)
+
+		if self.diffwriter is not None:
+			self.diffwriter.add(username, diff)
+			return
+
+		d = self.pool.runMethod('update_worker_diff', username, diff)
+		d.addErrback(self.log_failure, "Updating difficulty for %s failed" % username)
+		return d
+
+	def write_worker_diffs(self, diffs):
+		return self.pool.runMethod('update_worker_diffs', diffs)
 
 	def get_worker_diff(self,username):
-	  return self.DATABASE.get_worker_diff(username)
+		if self.diffwriter is not None and self.diffwriter.get(username) is not None:
+			return self.diffwriter.get(username)
+		return self.DATABASE.get_worker_diff(username)
 
 	def clear_worker_diff(self):
 		return self.DATABASE.clear_worker_diff()
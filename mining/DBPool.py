@@ -0,0 +1,62 @@
+from twisted.internet import reactor, threads
+from twisted.python import threadpool
+import threading
+
+import lib.logger
+log = lib.logger.get_logger('DBPool')
+
+class DBPool(object):
+	'''
+		Fixed-size database connection pool, along the lines of
+		twisted.enterprise.adbapi but around our own database drivers.
+
+		Every thread of a dedicated thread pool owns one driver instance
+		(a DB_Mysql or DB_Sqlite connection), opened on first use and kept until shutdown.
+		Calls return a Deferred that fires in the reactor thread.
+	'''
+
+	def __init__(self, connection_factory, size):
+		self.connection_factory = connection_factory
+		self.size = size
+		self.local = threading.local()
+		self.connections = []
+		self.lock = threading.Lock()
+
+		self.threadpool = threadpool.ThreadPool(size, size, 'DBPool')
+		reactor.callWhenRunning(self.threadpool.start)
+		reactor.addSystemEventTrigger('during', 'shutdown', self.close)
+
+	def connection(self):
+		# Returns the connection owned by the calling thread
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			log.debug("Opening pooled database connection")
+			connection = self.connection_factory()
+			self.local.connection = connection
+			with self.lock:
+				self.connections.append(connection)
+
+		return connection
+
+	def _run_interaction(self, interaction, *args, **kwargs):
+		return interaction(self.connection(), *args, **kwargs)
+
+	def _run_method(self, name, *args, **kwargs):
+		return getattr(self.connection(), name)(*args, **kwargs)
+
+	def runInteraction(self, interaction, *args, **kwargs):
+		'''Calls interaction(connection, *args, **kwargs) in a pool thread'''
+		return threads.deferToThreadPool(reactor, self.threadpool, self._run_interaction, interaction, *args, **kwargs)
+
+	def runMethod(self, name, *args, **kwargs):
+		'''Calls connection.<name>(*args, **kwargs) in a pool thread'''
+		return threads.deferToThreadPool(reactor, self.threadpool, self._run_method, name, *args, **kwargs)
+
+	def close(self):
+		log.info("Closing database connection pool")
+		self.threadpool.stop()
+
+		with self.lock:
+			for connection in self.connections:
+				connection.close()
+			self.connections = []
@@ -1,13 +1,43 @@
 import time
 import gc
 import hashlib
+import threading
+import tempfile
+import RoundStats
+import CircuitBreaker
+import QueryStats
 import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('DB_Mysql')
 
 import MySQLdb
 
+# Client errors meaning the connection is gone: server gone away, lost connection, can't connect, server lost
+CONNECTION_ERRORS = (2006, 2013, 2003, 2002, 2055)
+
+# Errors meaning LOAD DATA LOCAL INFILE can't be used: command not allowed, local files disabled (server), rejected (client)
+LOAD_DATA_ERRORS = (1148, 3948, 2068)
+
 class DB_Mysql():
+	# username -> pool_worker.id, shared by every connection (import threads open their own)
+	WORKER_IDS = {}
+	WORKER_IDS_LOCK = threading.Lock()
+
+	# Totals of the current round published by this process, shared by every connection
+	ROUND_STATS = RoundStats.RoundStats()
+
+	# Worker checkins not written yet when DB_CHECKIN_INTERVAL is set, worker id -> [time, shares, rejects]
+	CHECKINS = {}
+	# Worker id -> time its checkin was last written, entries older than DB_CHECKIN_INTERVAL are pruned by flush_worker_checkins()
+	CHECKINS_WRITTEN = {}
+	CHECKINS_LOCK = threading.Lock()
+
+	# Connects of every connection go through the breaker, see reconnect()
+	BREAKER = CircuitBreaker.CircuitBreaker('MySQL', settings.DB_RECONNECT_MIN_DELAY, settings.DB_RECONNECT_MAX_DELAY)
+
+	# Statement timings of every connection
+	QUERY_STATS = QueryStats.QueryStats()
+
 	def __init__(self):
 		# DB Connection Handle
 		self.MYSQL_CONNECTION = None
@@ -15,6 +45,10 @@ class DB_Mysql():
 		self.MYSQL_CURSOR = None
 		# Connection in progress
 		self.CONNECTING = False
+		# Inside an explicit transaction (see begin())
+		self.IN_TRANSACTION = False
+		# Checkins held back by update_worker_checkins() until the transaction is over
+		self.deferred_checkins = []
 
 		log.debug("MySQL Database Initialization")
 
@@ -30,7 +64,10 @@ class DB_Mysql():
 		self.salt = getattr(settings, 'PASSWORD_SALT')
 		self.database_extend = hasattr(settings, 'DATABASE_EXTEND') and getattr(settings, 'DATABASE_EXTEND') is True
 
-		self.connect()
+		# Bulk load shares with LOAD DATA LOCAL INFILE, turned off for this connection if it fails
+		self.load_data = getattr(settings, 'DB_SHARE_IMPORT_MODE', 'insert') == 'loaddata'
+
+		self.reconnect()
 
 # -------------------------- BEGIN MySQL Operational Functions ---------------------------------------
 
@@ -45,7 +82,10 @@ class DB_Mysql():
 				getattr(settings, 'DB_MYSQL_USER'),
 				getattr(settings, 'DB_MYSQL_PASS'), 
 				getattr(settings, 'DB_MYSQL_DBNAME'),
-				getattr(settings, 'DB_MYSQL_PORT')
+				getattr(settings, 'DB_MYSQL_PORT'),
+				local_infile = 1 if self.load_data else 0,
+				# Don't hang for the TCP timeout when the server is unreachable
+				connect_timeout = settings.DB_CONNECT_TIMEOUT
 			)
 
 			# Setup the connection options
@@ -81,39 +121,59 @@ class DB_Mysql():
 		# All is good
 		return True
 
-	def reconnect(self, retries = 0):
-		# Lets check the connection since it's state may have changed before we got here
+	def reconnect(self):
+		# Makes one connect attempt if the circuit breaker allows it, raises CircuitOpenError or the connect error otherwise
+		# Nothing waits here, while the server is down callers fail fast and retry later (the batcher, the next lookup)
 		try:
 			self.check_connection()
-			# If all is good, then our work is done here
 			return
-		except:
-			# It's still no good, let's proceed with execution of this reconnect function
-			log.warning("MySQL connection still down.")
+		except MySQLdb.OperationalError:
+			# The statements of the transaction so far went with the old session, a new connection
+			# would commit the rest one by one.  The caller rolls back and retries all of it.
+			if self.IN_TRANSACTION:
+				log.warning("MySQL connection lost during a transaction")
+				DB_Mysql.QUERY_STATS.connection_lost()
+				self.close()
+				raise
 
-		# Maximum # of attempts
-		if retries > 500:
-			raise Exception('Maximum retry attempts exhausted while reconnecting to MySQL')
+		DB_Mysql.BREAKER.check()
 
 		try:
-			# If a connection is already in process, lets just wait by throwing an excepton
-			if self.CONNECTING:
-				raise Exception("Database connection aready in process.")
-
-			log.debug("Attempting Reconnect to MySQL database server.")
 			# Close any existing connection and clean up remaining garbage
 			self.close()
-
-			# Atttmpt connection
 			self.connect()
-		except Exception as e:
-			# Connection failed
-			# Wait 5 seconds minium, 60 seconds maximum before retry
-			retries = retries + 1
-			waitime = (5 * retries) % 60
-			log.error("MySQL database server reconnect attempt #%i failed: %s.  Waiting %i seconds" % (retries, e.args[0], waitime))
-			time.sleep(waitime)
-			self.reconnect(retries)
+		except MySQLdb.Error as e:
+			DB_Mysql.QUERY_STATS.connected(True)
+			retry_at = DB_Mysql.BREAKER.failure()
+			log.error("MySQL database server connect failed: %s.  Next attempt in %.1f seconds" % (e, retry_at - time.time()))
+			raise
+
+		DB_Mysql.QUERY_STATS.connected()
+		DB_Mysql.BREAKER.success()
+
+	def connection_lost(self, e):
+		# The statement failed, was it the connection?
+		if e.args and e.args[0] in CONNECTION_ERRORS:
+			log.warning("MySQL connection lost: %s" % (e,))
+			DB_Mysql.QUERY_STATS.connection_lost()
+			self.close()
+
+		# IN_TRANSACTION stays set until rollback(), the next statements of the transaction must not reconnect
+
+	def query_done(self, query, args, start_time, rows, failed = False):
+		# Statement timings, statements slower than DB_SLOW_QUERY_TIME seconds are logged with their parameters
+		seconds = time.time() - start_time
+		slow = settings.DB_SLOW_QUERY_TIME > 0 and seconds >= settings.DB_SLOW_QUERY_TIME
+		DB_Mysql.QUERY_STATS.record(query, seconds, rows, failed, slow)
+
+		if slow:
+			log.warning("Slow query (%.3f seconds, %i rows%s): %s -- %s" % (seconds, rows, ", failed" if failed else "",
+					" ".join(query.split())[:1000], repr(args)[:1000]))
+
+	def query_failed(self, e, query, args, start_time):
+		self.query_done(query, args, start_time, 0, True)
+		if isinstance(e, MySQLdb.OperationalError):
+			self.connection_lost(e)
 
 	def execute(self, query, args = None):
 		log.debug("Executing Basic Query")
@@ -121,52 +181,71 @@ class DB_Mysql():
 		if not args == None:
 			log.debug("DB Values: %s" % args)
 
+		self.reconnect()
+		start_time = time.time()
 		try:
-			# Ensure all is good
-			self.check_connection()
 			# Run the SQL
 			self.MYSQL_CURSOR.execute(query, args)
-		except MySQLdb.OperationalError:
-			log.warning("MySQL connection lost during execute.")
-			self.reconnect()
-			# Recall thyself
-			self.execute(query, args)
+		except MySQLdb.Error as e:
+			self.query_failed(e, query, args, start_time)
+			raise
+
+		self.query_done(query, args, start_time, self.MYSQL_CURSOR.rowcount)
 
 	def executefetch(self, query, args=None, cursor = None):
 		log.debug("Execute Fetch Operation")
 		log.debug("DB Query: %s" % query)
 		log.debug("DB Values: %s" % args)
 
-		try:
-			# Ensure all is good
-			self.check_connection()
+		self.reconnect()
 
-			# Local cursor
-			if cursor is None:
-				cursor = self.MYSQL_CONNECTION.cursor(MySQLdb.cursors.DictCursor)
+		# Local cursor
+		if cursor is None:
+			cursor = self.MYSQL_CONNECTION.cursor(MySQLdb.cursors.DictCursor)
 
+		start_time = time.time()
+		try:
 			# Run the SQL
 			cursor.execute(query, args)
-		except MySQLdb.OperationalError:
-			log.warning("MySQL connection lost during ExecuteFetch.")
-			self.reconnect()
-			# Recall thyself
-			cursor = self.executefetch(query, args, cursor)
+		except MySQLdb.Error as e:
+			self.query_failed(e, query, args, start_time)
+			raise
+
+		self.query_done(query, args, start_time, cursor.rowcount)
 
 		return cursor
 
 	def executemany(self, query, args=None):
 		log.debug("Execute Many Operation")
+		self.reconnect()
+		start_time = time.time()
 		try:
-			# Ensure all is good
-			self.check_connection()
 			# Run the SQL
 			self.MYSQL_CURSOR.executemany(query, args)
-		except MySQLdb.OperationalError:
-			log.warning("MySQL connection lost during Executemany.")
-			self.reconnect()
-			# Recall thyself
-			self.executemany(query, args)
+		except MySQLdb.Error as e:
+			self.query_failed(e, query, args, start_time)
+			raise
+
+		self.query_done(query, args, start_time, self.MYSQL_CURSOR.rowcount)
+
+	def begin(self):
+		# Starts a transaction, everything up to commit() or rollback() is written as a whole
+		self.execute("START TRANSACTION")
+		self.IN_TRANSACTION = True
+
+	def commit(self):
+		self.MYSQL_CONNECTION.commit()
+		self.IN_TRANSACTION = False
+		self.settle_checkins(True)
+
+	def rollback(self):
+		self.IN_TRANSACTION = False
+		self.settle_checkins(False)
+		try:
+			self.MYSQL_CONNECTION.rollback()
+		except:
+			# The connection may be gone, the server rolls back for us then
+			log.debug("Rollback failed, connection already closed.")
 
 # -------------------------- END MySQL Operational Functions ---------------------------------------
 
@@ -177,7 +256,93 @@ class DB_Mysql():
 
 		return m.hexdigest()
 
-	def import_shares(self, data):
+	def preload_worker_ids(self):
+		# Fills the username -> id map with every known worker
+		log.info("Preloading worker ids")
+
+		self.execute(
+			"""
+			SELECT `id`, `username`
+			FROM `pool_worker`
+			ORDER BY `id`
+			"""
+		)
+
+		worker_ids = {}
+		for row in self.MYSQL_CURSOR.fetchall():
+			# Keep the lowest id, same as the old per-share subquery did
+			worker_ids.setdefault(row[1], row[0])
+
+		with DB_Mysql.WORKER_IDS_LOCK:
+			DB_Mysql.WORKER_IDS.clear()
+			DB_Mysql.WORKER_IDS.update(worker_ids)
+
+		log.info("Loaded %i worker ids" % len(worker_ids))
+
+	def invalidate_worker_id(self, id_or_username = None):
+		# Drops a single worker (by id or username) from the username -> id map, or all of them
+		with DB_Mysql.WORKER_IDS_LOCK:
+			if id_or_username is None:
+				DB_Mysql.WORKER_IDS.clear()
+				return
+
+			id_or_username = str(id_or_username)
+			DB_Mysql.WORKER_IDS.pop(id_or_username, None)
+
+			if id_or_username.isdigit():
+				for username, worker_id in DB_Mysql.WORKER_IDS.items():
+					if worker_id == int(id_or_username):
+						del DB_Mysql.WORKER_IDS[username]
+
+	def get_worker_id(self, username):
+		# Returns the pool_worker id of a username, or None if it does not exist
+		return self.get_worker_ids([username]).get(username)
+
+	def get_worker_ids(self, usernames):
+		# Resolves a list of usernames to their pool_worker id
+		# Known ids come from memory, the rest is fetched with a single query and remembered
+		# Unknown usernames are not included in the result
+		worker_ids = {}
+		missing = []
+
+		for username in set(usernames):
+			worker_id = DB_Mysql.WORKER_IDS.get(username)
+			if worker_id is None:
+				missing.append(username)
+			else:
+				worker_ids[username] = worker_id
+
+		for i in range(0, len(missing), settings.DB_LOADER_INSERT_CHUNK):
+			chunk = missing[i:i + settings.DB_LOADER_INSERT_CHUNK]
+			self.execute(
+				"""
+				SELECT `id`, `username`
+				FROM `pool_worker`
+				WHERE `username` IN (%s)
+				ORDER BY `id`
+				""" % ", ".join(["%s"] * len(chunk)),
+				chunk
+			)
+
+			found = {}
+			for row in self.MYSQL_CURSOR.fetchall():
+				# Keep the lowest id, same as the old per-share subquery did
+				found.setdefault(row[1], row[0])
+
+			with DB_Mysql.WORKER_IDS_LOCK:
+				DB_Mysql.WORKER_IDS.update(found)
+
+			worker_ids.update(found)
+
+		return worker_ids
+
+	def import_block_candidate(self, data):
+		# Writes a block candidate share right away, returns its shares.id for found_block()
+		return self.import_shares([data], True)
+
+	def import_shares(self, data, keep_id = False, round_stats = True, round_height = None):
+		# With keep_id, data holds a single share and the id of its row is returned
+		# Shares up to round_height (the last found block) belong to a round that is over, they are stored but left out of the round totals
 		# Data layout
 		# 0: worker_name, 
 		# 1: block_header, 
@@ -196,13 +361,25 @@ class DB_Mysql():
 		total_shares = 0
 		best_diff = 0
 
+		# Look up the worker ids once for the whole batch
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		# Shares from unknown workers are credited to the placeholder worker (id 0)
+		for username in set([v[0] for v in data]) - set(worker_ids.keys()):
+			log.warning("Worker '%s' not found, saving shares under worker id 0" % username)
+
+		# Rows for the multi-row insert, kept in the same order as the shares
+		rows = []
+
 		# Analyzes every share one by one - Remember, we are looping through 'shares' (not workers)
 		log.debug("Enumarating shares...")
 		for k, v in enumerate(data):
 			log.debug("Item: %s" % k)
 
-			# Keep a running total (in difficulty)
-			total_shares += v[3]
+			# Keep a running total (in difficulty) of the current round
+			in_round = round_height is None or v[7] > round_height
+			if in_round:
+				total_shares += v[3]
 
 			# Keeps the 'Last Check-in' field of each worker up to date with the timestamp of the 'most recent' share
 			if v[0] in checkin_times:
@@ -225,10 +402,236 @@ class DB_Mysql():
 				checkin_times[v[0]]["rejects"] += v[3]
 
 			# Determines the best share (the one with the hieghest 'difficulty'
-			if v[10] > best_diff:
+			if in_round and v[10] > best_diff:
 				best_diff = v[10]
 
-			# Save the share to the database
+			rows.append((v[4], v[6], worker_ids.get(v[0], 0), v[5], v[9], v[2], v[7], v[8], v[3]))
+
+		# Shares and the stats derived from them are written in one transaction
+		self.begin()
+		try:
+			# Save the shares to the database
+			share_id = None
+			try:
+				if keep_id:
+					share_id = self.insert_share(rows[0])
+				else:
+					self.insert_shares(rows)
+			except MySQLdb.IntegrityError:
+				# A worker may have been removed behind our back, forget the ids so the next try looks them up again
+				log.warning("Share insert rejected, clearing cached worker ids")
+				self.invalidate_worker_id()
+				raise
+
+			# Updating some stats
+			# Without round_stats the caller publishes the round totals (see StatsAggregator)
+			if round_stats:
+				self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+
+			log.info("Commiting Data")
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if round_stats:
+			DB_Mysql.ROUND_STATS.add(total_shares, best_diff)
+		return share_id
+
+	def add_round_stats(self, total_shares, best_diff):
+		# Publishes round totals collected from several imports at once
+		self.begin()
+		try:
+			self.update_round_stats(total_shares, best_diff)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Mysql.ROUND_STATS.add(total_shares, best_diff)
+
+	def update_round_stats(self, total_shares, best_diff):
+		# Adds total_shares (in difficulty) to the round and keeps the best share
+		# Only deltas are written, so concurrent imports never overwrite each other's totals
+		# There may be instances where these values are empty and python will not properly convert them
+		# The work around is to have MySQL do the string to float conversion for us by adding '0'.
+		log.info("Updating Round Stats")
+		self.execute(
+			"""
+			UPDATE `pool`
+			SET `value` = `value` + %(shares)s
+			WHERE `parameter` = 'round_shares'
+			""",
+			{
+				"shares": total_shares
+			}
+		)
+
+		if best_diff > 0:
+			self.execute(
+				"""
+				UPDATE `pool`
+				SET `value` = GREATEST(`value` + 0, %(best)s)
+				WHERE `parameter` = 'round_best_share'
+				""",
+				{
+					"best": best_diff
+				}
+			)
+
+		self.execute(
+			"""
+			UPDATE `pool` AS `progress`
+			  JOIN `pool` AS `shares` ON `shares`.`parameter` = 'round_shares'
+			  JOIN `pool` AS `difficulty` ON `difficulty`.`parameter` = 'bitcoin_difficulty'
+			SET `progress`.`value` = IF(`difficulty`.`value` + 0 = 0, 0, (`shares`.`value` + 0) / (`difficulty`.`value` + 0) * 100)
+			WHERE `progress`.`parameter` = 'round_progress'
+			"""
+		)
+
+	def update_worker_checkins(self, checkin_times, worker_ids):
+		# checkin_times: username -> {"time": last share time, "shares": accepted difficulty, "rejects": rejected difficulty}
+		log.info("Updating worker checkin times")
+		checkins = {}
+		for k, v in checkin_times.items():
+			# Nothing to update for unknown workers
+			if k not in worker_ids:
+				continue
+
+			log.debug("Worker %s last_checkin time %s.  (total shares: %s) (total rejects: %s)" % (k, v["time"], v["shares"], v["rejects"]))
+			self.merge_checkin(checkins, worker_ids[k], [v["time"], v["shares"], v["rejects"]])
+
+		interval = getattr(settings, 'DB_CHECKIN_INTERVAL', 0)
+		if interval <= 0:
+			self.write_checkins(checkins)
+			return
+
+		# Only workers not written for 'interval' seconds are written, with everything they saved up since
+		# The rest is kept in memory once the transaction has been committed
+		now = time.time()
+		due = {}
+		claimed = {}
+		with DB_Mysql.CHECKINS_LOCK:
+			for worker_id in set(checkins.keys()) | set(DB_Mysql.CHECKINS.keys()):
+				if now - DB_Mysql.CHECKINS_WRITTEN.get(worker_id, 0) < interval:
+					continue
+
+				if worker_id in DB_Mysql.CHECKINS:
+					claimed[worker_id] = DB_Mysql.CHECKINS.pop(worker_id)
+					self.merge_checkin(due, worker_id, claimed[worker_id])
+				if worker_id in checkins:
+					self.merge_checkin(due, worker_id, checkins.pop(worker_id))
+				DB_Mysql.CHECKINS_WRITTEN[worker_id] = now
+
+		try:
+			self.write_checkins(due)
+		except:
+			self.release_checkins(claimed)
+			raise
+
+		self.deferred_checkins.append((claimed, checkins))
+
+	def merge_checkin(self, checkins, worker_id, checkin):
+		# Adds [time, shares, rejects] to the checkin of worker_id in 'checkins'
+		if worker_id in checkins:
+			current = checkins[worker_id]
+			checkins[worker_id] = [max(current[0], checkin[0]), current[1] + checkin[1], current[2] + checkin[2]]
+		else:
+			checkins[worker_id] = list(checkin)
+
+	def release_checkins(self, checkins):
+		# Puts checkins back in the pending map
+		with DB_Mysql.CHECKINS_LOCK:
+			for worker_id, checkin in checkins.items():
+				self.merge_checkin(DB_Mysql.CHECKINS, worker_id, checkin)
+
+	def settle_checkins(self, stored):
+		# Called once the batch transaction is over, saves the deferred checkins or undoes the claims
+		for (claimed, deferred) in self.deferred_checkins:
+			self.release_checkins(deferred if stored else claimed)
+		self.deferred_checkins = []
+
+	def flush_worker_checkins(self):
+		# Writes every pending checkin, used on shutdown and by the periodic flush
+		with DB_Mysql.CHECKINS_LOCK:
+			(checkins, DB_Mysql.CHECKINS) = (DB_Mysql.CHECKINS, {})
+			now = time.time()
+
+			# A worker not written for the interval is due with its next share anyway, forgetting it keeps the map to the active workers
+			interval = getattr(settings, 'DB_CHECKIN_INTERVAL', 0)
+			for (worker_id, written) in DB_Mysql.CHECKINS_WRITTEN.items():
+				if now - written >= interval:
+					del DB_Mysql.CHECKINS_WRITTEN[worker_id]
+
+			for worker_id in checkins.keys():
+				DB_Mysql.CHECKINS_WRITTEN[worker_id] = now
+
+		if not checkins:
+			return
+
+		log.info("Writing %i pending worker checkin(s)" % len(checkins))
+		try:
+			self.write_checkins(checkins)
+			self.MYSQL_CONNECTION.commit()
+		except:
+			self.release_checkins(checkins)
+			raise
+
+	def write_checkins(self, checkins):
+		# One UPDATE per DB_LOADER_INSERT_CHUNK workers, checkins: worker id -> [time, shares, rejects]
+		# Ids are sorted so parallel imports lock the rows in the same order
+		# last_update is kept, checkins are not a change for the worker sync (get_workers())
+		worker_ids = sorted(checkins.keys())
+		for i in range(0, len(worker_ids), settings.DB_LOADER_INSERT_CHUNK):
+			chunk = worker_ids[i:i + settings.DB_LOADER_INSERT_CHUNK]
+			log.debug("Updating checkins of %i worker(s)" % len(chunk))
+
+			args = []
+			for column in range(3):
+				for worker_id in chunk:
+					args.extend((worker_id, checkins[worker_id][column]))
+			args.extend(chunk)
+
+			self.execute(
+				"""
+				UPDATE `pool_worker`
+				SET `last_checkin` = CASE `id` %s END,
+				  `total_shares` = `total_shares` + CASE `id` %s END,
+				  `total_rejects` = `total_rejects` + CASE `id` %s END,
+				  `last_update` = `last_update`
+				WHERE `id` IN (%s)
+				""" % (
+					" ".join(["WHEN %s THEN FROM_UNIXTIME(%s)"] * len(chunk)),
+					" ".join(["WHEN %s THEN %s"] * len(chunk)),
+					" ".join(["WHEN %s THEN %s"] * len(chunk)),
+					", ".join(["%s"] * len(chunk))
+				),
+				args
+			)
+
+	def insert_shares(self, rows):
+		# Writes share rows with multi-row INSERT statements of at most DB_LOADER_INSERT_CHUNK rows
+		# Row layout: time, rem_host, worker id, our_result, reason, solution, block_num, prev_block_hash, difficulty
+		if self.load_data:
+			try:
+				self.load_shares(rows)
+				return
+			except MySQLdb.Error as e:
+				# Other errors fail the import, the batch is retried with LOAD DATA
+				if not (e.args and e.args[0] in LOAD_DATA_ERRORS):
+					raise
+				log.warning("Bulk loading shares not supported, using INSERT for this connection from now on.  Error: %s" % str(e))
+				self.load_data = False
+
+		for i in range(0, len(rows), settings.DB_LOADER_INSERT_CHUNK):
+			chunk = rows[i:i + settings.DB_LOADER_INSERT_CHUNK]
+			log.debug("Inserting %i share rows" % len(chunk))
+
+			args = []
+			for row in chunk:
+				args.extend(row)
+
 			self.execute(
 				"""
 				INSERT INTO `shares` 
@@ -236,175 +639,581 @@ class DB_Mysql():
 				  reason, solution, block_num, prev_block_hash, 
 				  useragent, difficulty) 
 				VALUES
-				(FROM_UNIXTIME(%(time)s), %(host)s, 
-				  (SELECT `id` FROM `pool_worker` WHERE `username` = %(uname)s ORDER by `id` LIMIT 1), 
-				  %(lres)s, 0, %(reason)s, %(solution)s, 
-				  %(blocknum)s, %(hash)s, '', %(difficulty)s)
-				""",
-				{
-					"time": v[4],
-					"host": v[6],
-					"uname": v[0],
-					"lres": v[5],
-					"solution": v[2],
-					"reason": v[9],
-					"blocknum": v[7],
-					"hash": v[8],
-					"difficulty": v[3]
-				}
+				%s
+				""" % ", ".join(["(FROM_UNIXTIME(%s), %s, %s, %s, 0, %s, %s, %s, %s, '', %s)"] * len(chunk)),
+				args
 			)
 
-		# Updating some stats
-		log.info("Updating Round Stats")
-		# There may be instances where these values are empty and python will not properly convert them
-		# The work around is to have MySQL do the string to float conversion for us by adding '0'.
+	def insert_share(self, row):
+		# Writes a single share row (same layout as insert_shares) and returns its id
 		self.execute(
 			"""
-			SELECT `parameter`, `value` + 0 as `value`
-			FROM `pool` 
-			WHERE `parameter` = 'round_best_share'
-			  OR `parameter` = 'round_shares'
-			  OR `parameter` = 'bitcoin_difficulty'
-			  OR `parameter` = 'round_progress'
-			"""
+			INSERT INTO `shares` 
+			(time, rem_host, worker, our_result, upstream_result, 
+			  reason, solution, block_num, prev_block_hash, 
+			  useragent, difficulty) 
+			VALUES
+			(FROM_UNIXTIME(%s), %s, %s, %s, 0, %s, %s, %s, %s, '', %s)
+			""",
+			row
 		)
 
-		current_parameters = {}
+		return self.MYSQL_CURSOR.lastrowid
 
-		log.info("Fetching current stats")
-		for pool_stats in self.MYSQL_CURSOR.fetchall():
-			log.debug("Extracting: %s => %s" % (pool_stats[0], pool_stats[1]))
-			current_parameters[pool_stats[0]] = pool_stats[1]
+	def csv_value(self, value):
+		# Formats a value for LOAD DATA with the field options used in load_shares()
+		if value is None:
+			return '\\N'
 
-		# Convert these values into a floating point number
-		round_best_share = float(current_parameters['round_best_share'])
-		difficulty = float(current_parameters['bitcoin_difficulty'])
-		round_shares = float(current_parameters['round_shares']) + total_shares
-		log.debug("round_best_share = %s, difficulty = %s, round_shares = %s" % (round_best_share, difficulty, round_shares))
+		if isinstance(value, bool):
+			return '1' if value else '0'
 
-		updates = [
-			{
-				"param": "round_shares",
-				"value": round_shares
-			},
+		if isinstance(value, float):
+			return repr(value)
+
+		if isinstance(value, (int, long)):
+			return str(value)
+
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+
+		value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+		return '"%s"' % value
+
+	def load_shares(self, rows):
+		# Streams share rows into the shares table through a temporary CSV file
+		log.debug("Bulk loading %i share rows" % len(rows))
+
+		with tempfile.NamedTemporaryFile(prefix='shares', suffix='.csv') as csv_file:
+			for row in rows:
+				csv_file.write(",".join([self.csv_value(value) for value in row]) + "\n")
+			csv_file.flush()
+
+			# Errors go straight to the caller (no reconnect and retry), insert_shares() falls back to INSERT if LOAD DATA is refused
+			self.check_connection()
+			start_time = time.time()
+			self.MYSQL_CURSOR.execute(
+				"""
+				LOAD DATA LOCAL INFILE %s
+				INTO TABLE `shares`
+				FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\'
+				LINES TERMINATED BY '\\n'
+				(@time, rem_host, worker, our_result, reason, solution, 
+				  block_num, prev_block_hash, difficulty)
+				SET `time` = FROM_UNIXTIME(@time),
+				  `upstream_result` = 0,
+				  `useragent` = ''
+				""",
+				(csv_file.name,)
+			)
+			self.query_done("LOAD DATA INTO `shares`", None, start_time, self.MYSQL_CURSOR.rowcount)
+
+	def found_block(self, data, share_id = None):
+		# Note: difficulty = -1 here
+		# share_id is the row written by import_block_candidate(), without it the share is looked up by time and worker
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			if share_id is not None:
+				self.execute(
+					"""
+					UPDATE `shares`
+					SET `upstream_result` = %(result)s,
+					  `solution` = %(solution)s
+					WHERE `id` = %(id)s
+					""",
+					{
+						"result": data[5], 
+						"solution": data[2], 
+						"id": share_id
+					}
+				)
+			else:
+				self.execute(
+					"""
+					UPDATE `shares`
+					SET `upstream_result` = %(result)s,
+					  `solution` = %(solution)s
+					WHERE `time` = FROM_UNIXTIME(%(time)s)
+					  AND `worker` = %(worker)s
+					LIMIT 1
+					""",
+					{
+						"result": data[5], 
+						"solution": data[2], 
+						"time": data[4], 
+						"worker": worker_id
+					}
+				)
+		
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Mysql.ROUND_STATS.reset()
+
+	def get_block_share_id(self, data):
+		# Returns the shares.id of the stored block candidate 'data', or None while it is not stored
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		result = self.executefetch(
+			"""
+			SELECT `id`
+			FROM `shares`
+			WHERE `time` = FROM_UNIXTIME(%(time)s)
+			  AND `worker` = %(worker)s
+			  AND `solution` = %(solution)s
+			LIMIT 1
+			""",
 			{
-				"param": "round_progress",
-				"value": 0 if difficulty == 0 else (round_shares / difficulty) * 100
+				"time": data[4],
+				"worker": worker_id,
+				"solution": data[2]
 			}
-		]
+		)
 
-		if best_diff > round_best_share:
-			log.debug("Setting new round_best_share to: %s" % best_diff)
-			updates.append({
-				"param": "round_best_share",
-				"value": best_diff
-			})
+		share = result.fetchone()
+		result.close()
+		return share['id'] if share is not None else None
+
+	def record_found_block(self, worker_id):
+		# Credits the worker with the block and starts a new round
+		self.execute(
+			"""
+			UPDATE `pool_worker`
+			SET `total_found` = `total_found` + 1
+			WHERE `id` = %(id)s
+			""",
+			{
+				"id": worker_id
+			}
+		)
+		self.execute(
+			"""
+			UPDATE `pool`
+			SET `value` = `value` + 1
+			WHERE `parameter` = 'pool_total_found'
+			"""
+		)
 
 		self.executemany(
 			"""
-			UPDATE `pool` 
+			UPDATE `pool`
 			SET `value` = %(value)s
 			WHERE `parameter` = %(param)s
 			""",
-			updates
+			[
+				{
+					"param": "round_shares",
+					"value": "0"
+				},
+				{
+					"param": "round_progress",
+					"value": "0"
+				},
+				{
+					"param": "round_best_share",
+					"value": "0"
+				},
+				{
+					"param": "round_start",
+					"value": time.time()
+				}
+			]
 		)
 
-		log.info("Updating worker checkin times")
-		for k, v in checkin_times.items():
-			log.debug("Setting worker %s last_checkin time to %s.  (total shares: %s) (total rejects: %s)" % (k, v["time"], v["shares"], v["rejects"]))
+	def import_rollups(self, data, round_height = None):
+		# Data layout (see ShareRollup)
+		# 0: worker_name,
+		# 1: interval_start,
+		# 2: block_height,
+		# 3: accepted_count,
+		# 4: accepted_diff,
+		# 5: rejected_count,
+		# 6: rejected_diff,
+		# 7: best_share,
+		# 8: last_share
+
+		log.debug("Importing Share Rollups")
+		checkin_times = {}
+		total_shares = 0
+		best_diff = 0
+
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		rows = []
+		for v in data:
+			if round_height is None or v[2] > round_height:
+				total_shares += v[4] + v[6]
+				best_diff = max(best_diff, v[7])
+
+			checkin = checkin_times.setdefault(v[0], {"time": 0, "shares": 0, "rejects": 0})
+			checkin["time"] = max(checkin["time"], v[8])
+			checkin["shares"] += v[4]
+			checkin["rejects"] += v[6]
+
+			rows.append((worker_ids.get(v[0], 0), v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8]))
+
+		self.begin()
+		try:
+			self.insert_rollups(rows)
+			self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Mysql.ROUND_STATS.add(total_shares, best_diff)
+
+	def insert_rollups(self, rows):
+		# Row layout: worker id, interval_start, block_num, accepted_count, accepted_diff, rejected_count, rejected_diff, best_share, last_share
+		for i in range(0, len(rows), settings.DB_LOADER_INSERT_CHUNK):
+			chunk = rows[i:i + settings.DB_LOADER_INSERT_CHUNK]
+
+			args = []
+			for row in chunk:
+				args.extend(row)
+
+			# A rollup flushed twice for the same interval (retries, restarts) is added up
 			self.execute(
 				"""
-				UPDATE `pool_worker`
-				SET `last_checkin` = FROM_UNIXTIME(%(time)s), 
-				  `total_shares` = `total_shares` + %(shares)s,
-				  `total_rejects` = `total_rejects` + %(rejects)s
-				WHERE `username` = %(uname)s
+				INSERT INTO `share_rollups`
+				(worker, interval_start, block_num, accepted_count, accepted_diff,
+				  rejected_count, rejected_diff, best_share, last_share)
+				VALUES
+				%s
+				ON DUPLICATE KEY UPDATE
+				  `accepted_count` = `accepted_count` + VALUES(`accepted_count`),
+				  `accepted_diff` = `accepted_diff` + VALUES(`accepted_diff`),
+				  `rejected_count` = `rejected_count` + VALUES(`rejected_count`),
+				  `rejected_diff` = `rejected_diff` + VALUES(`rejected_diff`),
+				  `best_share` = GREATEST(`best_share`, VALUES(`best_share`)),
+				  `last_share` = GREATEST(`last_share`, VALUES(`last_share`))
+				""" % ", ".join(["(%s, FROM_UNIXTIME(%s), %s, %s, %s, %s, %s, %s, FROM_UNIXTIME(%s))"] * len(chunk)),
+				args
+			)
+
+	def insert_block_share(self, data):
+		# Records a block candidate as its own share row, used when shares are not saved one by one
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				INSERT INTO `shares`
+				(time, rem_host, worker, our_result, upstream_result,
+				  reason, solution, block_num, prev_block_hash,
+				  useragent, difficulty)
+				VALUES
+				(FROM_UNIXTIME(%(time)s), %(host)s, %(worker)s, 1, %(result)s,
+				  '', %(solution)s, %(blocknum)s, %(hash)s, '', %(difficulty)s)
 				""",
 				{
-					"time": v["time"],
-					"shares": v["shares"],
-					"rejects": v["rejects"], 
-					"uname": k
+					"time": data[4],
+					"host": data[6],
+					"worker": worker_id,
+					"result": data[5],
+					"solution": data[2],
+					"blocknum": data[7],
+					"hash": data[8],
+					"difficulty": data[3]
 				}
 			)
 
-		log.info("Commiting Data")
-		self.MYSQL_CONNECTION.commit()
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
 
-	def found_block(self, data):
-		# Note: difficulty = -1 here
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Mysql.ROUND_STATS.reset()
+
+	def get_archive_boundary(self, cutoff):
+		# Returns the id of the first share at or after 'cutoff', everything before it may be archived
+		# None when there is nothing to archive
 		self.execute(
 			"""
-			UPDATE `shares`
-			SET `upstream_result` = %(result)s,
-			  `solution` = %(solution)s
-			WHERE `time` = FROM_UNIXTIME(%(time)s)
-			  AND `worker` = (
-				  SELECT `id` 
-				  FROM `pool_worker` 
-				  WHERE `username` = %(uname)s
-			  )
+			SELECT `id`
+			FROM `shares`
+			WHERE `time` >= FROM_UNIXTIME(%(cutoff)s)
+			ORDER BY `time`, `id`
 			LIMIT 1
 			""",
 			{
-				"result": data[5], 
-				"solution": data[2], 
-				"time": data[4], 
-				"uname": data[0]
+				"cutoff": cutoff
 			}
 		)
-		
-		if self.database_extend and data[5] == True:
+
+		data = self.MYSQL_CURSOR.fetchone()
+		if data is not None:
+			return data[0]
+
+		self.execute(
+			"""
+			SELECT MAX(`id`) + 1
+			FROM `shares`
+			"""
+		)
+
+		return self.MYSQL_CURSOR.fetchone()[0]
+
+	def get_archive_chunk(self, after_id, before_id, cutoff, limit):
+		# Next 'limit' shares to archive after 'after_id', columns as in ShareArchiver.COLUMNS
+		self.execute(
+			"""
+			SELECT `shares`.`id`, UNIX_TIMESTAMP(`shares`.`time`), `shares`.`rem_host`, `shares`.`worker`,
+			  `pool_worker`.`username`, `shares`.`our_result`, `shares`.`upstream_result`, `shares`.`reason`,
+			  `shares`.`solution`, `shares`.`block_num`, `shares`.`prev_block_hash`, `shares`.`useragent`,
+			  `shares`.`difficulty`
+			FROM `shares`
+			LEFT JOIN `pool_worker`
+			  ON `pool_worker`.`id` = `shares`.`worker`
+			WHERE `shares`.`id` > %(after)s
+			  AND `shares`.`id` < %(before)s
+			  AND `shares`.`time` < FROM_UNIXTIME(%(cutoff)s)
+			ORDER BY `shares`.`id`
+			LIMIT %(limit)s
+			""",
+			{
+				"after": after_id,
+				"before": before_id,
+				"cutoff": cutoff,
+				"limit": limit
+			}
+		)
+
+		return self.MYSQL_CURSOR.fetchall()
+
+	def archive_shares(self, after_id, before_id, cutoff, limit):
+		# Moves the next 'limit' shares after 'after_id' to shares_archive (and found blocks to shares_archive_found)
+		# Returns (last id, number of shares), last id is None when there was nothing left
+		self.execute(
+			"""
+			SELECT MAX(`id`), COUNT(*)
+			FROM (
+			  SELECT `id`
+			  FROM `shares`
+			  WHERE `id` > %(after)s
+			    AND `id` < %(before)s
+			    AND `time` < FROM_UNIXTIME(%(cutoff)s)
+			  ORDER BY `id`
+			  LIMIT %(limit)s
+			) AS `chunk`
+			""",
+			{
+				"after": after_id,
+				"before": before_id,
+				"cutoff": cutoff,
+				"limit": limit
+			}
+		)
+
+		(last_id, count) = self.MYSQL_CURSOR.fetchone()
+		if last_id is None:
+			return (None, 0)
+
+		args = {
+			"after": after_id,
+			"last": last_id,
+			"cutoff": cutoff
+		}
+
+		self.begin()
+		try:
+			for (table, condition) in [('shares_archive', ''), ('shares_archive_found', 'AND `shares`.`upstream_result` = 1')]:
+				# The archive tables still have the username column of the old shares layout
+				self.execute(
+					"""
+					INSERT IGNORE INTO `%s`
+					(`id`, `time`, `rem_host`, `username`, `our_result`, `upstream_result`, `reason`,
+					  `solution`, `block_num`, `prev_block_hash`, `useragent`, `difficulty`)
+					SELECT `shares`.`id`, `shares`.`time`, `shares`.`rem_host`, `pool_worker`.`username`,
+					  `shares`.`our_result`, `shares`.`upstream_result`, `shares`.`reason`, `shares`.`solution`,
+					  `shares`.`block_num`, `shares`.`prev_block_hash`, `shares`.`useragent`, `shares`.`difficulty`
+					FROM `shares`
+					LEFT JOIN `pool_worker`
+					  ON `pool_worker`.`id` = `shares`.`worker`
+					WHERE `shares`.`id` > %%(after)s
+					  AND `shares`.`id` <= %%(last)s
+					  AND `shares`.`time` < FROM_UNIXTIME(%%(cutoff)s)
+					  %s
+					""" % (table, condition),
+					args
+				)
+
 			self.execute(
 				"""
-				UPDATE `pool_worker`
-				SET `total_found` = `total_found` + 1
-				WHERE `username` = %(uname)s
+				DELETE FROM `shares`
+				WHERE `id` > %(after)s
+				  AND `id` <= %(last)s
+				  AND `time` < FROM_UNIXTIME(%(cutoff)s)
 				""",
-				{
-					"uname": data[0]
-				}
+				args
 			)
-			self.execute(
-				"""
-				SELECT `value`
-				FROM `pool`
-				WHERE `parameter` = 'pool_total_found'
-				"""
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		return (last_id, count)
+
+	def delete_shares(self, after_id, last_id, cutoff, limit):
+		# Deletes at most 'limit' archived shares, returns how many were deleted
+		self.execute(
+			"""
+			DELETE FROM `shares`
+			WHERE `id` > %(after)s
+			  AND `id` <= %(last)s
+			  AND `time` < FROM_UNIXTIME(%(cutoff)s)
+			ORDER BY `id`
+			LIMIT %(limit)s
+			""",
+			{
+				"after": after_id,
+				"last": last_id,
+				"cutoff": cutoff,
+				"limit": limit
+			}
+		)
+
+		return self.MYSQL_CURSOR.rowcount
+
+	def get_share_partitions(self):
+		# Returns the partitions of the shares table as (name, upper bound) tuples, the bound is None for MAXVALUE
+		# An empty list means the table is not partitioned
+		self.execute(
+			"""
+			SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION`
+			FROM INFORMATION_SCHEMA.PARTITIONS
+			WHERE `TABLE_SCHEMA` = %(schema)s
+			  AND `TABLE_NAME` = 'shares'
+			  AND `PARTITION_NAME` IS NOT NULL
+			ORDER BY `PARTITION_ORDINAL_POSITION`
+			""",
+			{
+				"schema": getattr(settings, 'DB_MYSQL_DBNAME')
+			}
+		)
+
+		return [(row[0], None if row[1] == 'MAXVALUE' else int(row[1])) for row in self.MYSQL_CURSOR.fetchall()]
+
+	def partition_definitions(self, start, until):
+		# One partition per DB_PARTITION_INTERVAL seconds from 'start' (a partition bound) until past 'until'
+		# Partitions are named after the first second they hold (UTC)
+		definitions = []
+		bound = start
+		while bound < until:
+			definitions.append("PARTITION p%s VALUES LESS THAN (%i)" % (time.strftime("%Y%m%d%H%M", time.gmtime(bound)), bound + settings.DB_PARTITION_INTERVAL))
+			bound += settings.DB_PARTITION_INTERVAL
+
+		return definitions
+
+	def partition_shares(self):
+		# Converts the shares table to RANGE partitions on time, everything before the current interval goes to p_old
+		now = time.time()
+		start = int(now // settings.DB_PARTITION_INTERVAL) * settings.DB_PARTITION_INTERVAL
+		definitions = ["PARTITION p_old VALUES LESS THAN (%i)" % start]
+		definitions += self.partition_definitions(start, now + settings.DB_PARTITION_AHEAD * settings.DB_PARTITION_INTERVAL)
+		# Shares past the last partition go here until maintain_partitions() splits it up
+		definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+		log.warning("Partitioning the shares table, this may take a while")
+		self.execute(
+			"""
+			ALTER TABLE `shares`
+			PARTITION BY RANGE (UNIX_TIMESTAMP(`time`)) (
+			  %s
 			)
-			total_found = int(self.MYSQL_CURSOR.fetchone()[0]) + 1
-			
-			self.executemany(
-				"""
-				UPDATE `pool`
-				SET `value` = %(value)s
-				WHERE `parameter` = %(param)s
-				""",
-				[
-					{
-						"param": "round_shares",
-						"value": "0"
-					},
-					{
-						"param": "round_progress",
-						"value": "0"
-					},
-					{
-						"param": "round_best_share",
-						"value": "0"
-					},
-					{
-						"param": "round_start",
-						"value": time.time()
-					},
+			""" % ",\n\t\t\t  ".join(definitions)
+		)
+
+	def maintain_partitions(self):
+		# Creates the partitions for the next DB_PARTITION_AHEAD intervals and expires those older than DB_PARTITION_RETENTION
+		partitions = self.get_share_partitions()
+		if not partitions:
+			self.partition_shares()
+			return
+
+		now = time.time()
+
+		last_bound = max([bound for (name, bound) in partitions if bound is not None])
+		until = now + settings.DB_PARTITION_AHEAD * settings.DB_PARTITION_INTERVAL
+		if last_bound < until:
+			definitions = self.partition_definitions(last_bound, until)
+			log.info("Adding %i share partition(s)" % len(definitions))
+
+			if partitions[-1][1] is None:
+				# Splitting the MAXVALUE partition only moves rows when shares came in past the last partition
+				self.execute(
+					"""
+					ALTER TABLE `shares`
+					REORGANIZE PARTITION `%s` INTO (
+					  %s,
+					  PARTITION `%s` VALUES LESS THAN MAXVALUE
+					)
+					""" % (partitions[-1][0], ",\n\t\t\t\t\t  ".join(definitions), partitions[-1][0])
+				)
+			else:
+				self.execute(
+					"""
+					ALTER TABLE `shares`
+					ADD PARTITION (
+					  %s
+					)
+					""" % ",\n\t\t\t\t\t  ".join(definitions)
+				)
+
+		# The last partition always stays
+		for (name, bound) in partitions[:-1]:
+			if bound is None or bound > now - settings.DB_PARTITION_RETENTION:
+				continue
+
+			if settings.DB_PARTITION_EXPIRE == 'exchange':
+				# The expired shares are kept in a table of their own, shares_<partition>
+				table = "shares_%s" % name
+				self.execute(
+					"""
+					SELECT COUNT(*)
+					FROM INFORMATION_SCHEMA.TABLES
+					WHERE `TABLE_SCHEMA` = %(schema)s
+					  AND `TABLE_NAME` = %(table)s
+					""",
 					{
-						"param": "pool_total_found",
-						"value": total_found
+						"schema": getattr(settings, 'DB_MYSQL_DBNAME'),
+						"table": table
 					}
-				]
-			)
+				)
 
-		self.MYSQL_CONNECTION.commit()
+				if self.MYSQL_CURSOR.fetchone()[0] > 0:
+					log.error("Can't expire share partition %s, table %s already exists" % (name, table))
+					continue
+
+				log.info("Moving expired share partition %s to table %s" % (name, table))
+				self.execute("CREATE TABLE `%s` LIKE `shares`" % table)
+				self.execute("ALTER TABLE `%s` REMOVE PARTITIONING" % table)
+				self.execute("ALTER TABLE `shares` EXCHANGE PARTITION `%s` WITH TABLE `%s`" % (name, table))
+			else:
+				log.info("Dropping expired share partition %s" % name)
+
+			self.execute("ALTER TABLE `shares` DROP PARTITION `%s`" % name)
 
 	def list_users(self):
 		result = self.executefetch(
@@ -445,6 +1254,38 @@ class DB_Mysql():
 		result.close()
 		return user
 
+	def get_workers(self, since = None):
+		# Returns (server time, rows) of pool_worker joined with its settings, changed since 'since' or all of them
+		if not self.database_extend:
+			raise ValueError("Loading the workers needs DATABASE_EXTEND")
+
+		# The time is taken first and a bit early, rows of transactions still running are fetched again next time
+		self.execute("SELECT NOW() - INTERVAL 10 SECOND")
+		server_time = self.MYSQL_CURSOR.fetchone()[0]
+
+		query = """
+			SELECT w.`id`, w.`username`, w.`password`, w.`difficulty`, w.`last_checkin`,
+			  COALESCE(s.`custom_diff_enable`, 0) AS `custom_diff_enable`
+			FROM `pool_worker` w
+			LEFT JOIN `pool_worker_settings` s ON s.`pool_worker_id` = w.`id`
+			"""
+
+		if since is None:
+			result = self.executefetch(query)
+		else:
+			# Two indexed lookups instead of an OR across the tables
+			result = self.executefetch(
+				query + "WHERE w.`last_update` >= %(since)s UNION " +
+				query + "WHERE s.`last_update` >= %(since)s",
+				{
+					"since": since
+				}
+			)
+
+		workers = list(result.fetchall())
+		result.close()
+		return (server_time, workers)
+
 	def get_user_settings(self, worker_id):
 		log.debug("Finding configuration with worker_id of %s", worker_id)
 
@@ -468,24 +1309,23 @@ class DB_Mysql():
 			raise Exception('You cannot delete that user')
 		
 		log.debug("Deleting user with id or username of %s", id_or_username)
-		
-		self.execute(
-			"""
-			UPDATE `shares`
-			SET `worker` = 0
-			WHERE `worker` = (
-				SELECT `id` 
-				FROM `pool_worker` 
-				WHERE `id` = %(id)s 
-				  OR `username` = %(uname)s
-				LIMIT 1
+
+		if id_or_username.isdigit():
+			worker_id = int(id_or_username)
+		else:
+			worker_id = self.get_worker_id(id_or_username)
+
+		if worker_id is not None:
+			self.execute(
+				"""
+				UPDATE `shares`
+				SET `worker` = 0
+				WHERE `worker` = %(id)s
+				""",
+				{
+					"id": worker_id
+				}
 			)
-			""",
-			{
-				"id": id_or_username if id_or_username.isdigit() else -1,
-				"uname": id_or_username
-			}
-		)
 
 		self.execute(
 			"""
@@ -500,6 +1340,7 @@ class DB_Mysql():
 		)
 
 		self.MYSQL_CONNECTION.commit()
+		self.invalidate_worker_id(id_or_username)
 
 	def insert_user(self, username, password):
 		log.debug("Adding new user %s", username)
@@ -518,6 +1359,7 @@ class DB_Mysql():
 		)
 
 		self.MYSQL_CONNECTION.commit()
+		self.invalidate_worker_id(username)
 
 		return str(username)
 
@@ -539,6 +1381,7 @@ class DB_Mysql():
 		)
 		
 		self.MYSQL_CONNECTION.commit()
+		self.invalidate_worker_id(id_or_username)
 
 	def update_worker_diff(self, username, diff):
 		log.debug("Setting difficulty for %s to %s", username, diff)
@@ -557,6 +1400,33 @@ class DB_Mysql():
 
 		self.MYSQL_CONNECTION.commit()
 
+	def update_worker_diffs(self, diffs):
+		# One UPDATE per DB_LOADER_INSERT_CHUNK workers, diffs: username -> difficulty
+		# Usernames are sorted so concurrent writers lock the rows in the same order
+		usernames = sorted(diffs.keys())
+		for i in range(0, len(usernames), settings.DB_LOADER_INSERT_CHUNK):
+			chunk = usernames[i:i + settings.DB_LOADER_INSERT_CHUNK]
+			log.debug("Setting difficulty of %i worker(s)" % len(chunk))
+
+			args = []
+			for username in chunk:
+				args.extend((username, diffs[username]))
+			args.extend(chunk)
+
+			self.execute(
+				"""
+				UPDATE `pool_worker`
+				SET `difficulty` = CASE `username` %s END
+				WHERE `username` IN (%s)
+				""" % (
+					" ".join(["WHEN %s THEN %s"] * len(chunk)),
+					", ".join(["%s"] * len(chunk))
+				),
+				args
+			)
+
+		self.MYSQL_CONNECTION.commit()
+
 	def clear_worker_diff(self):
 		if self.database_extend:
 			log.debug("Resetting difficulty for all workers")
@@ -637,7 +1507,7 @@ class DB_Mysql():
 
 	def update_tables(self):
 		version = 0
-		current_version = 10
+		current_version = 14
 
 		while version < current_version:
 			self.execute(
@@ -1138,4 +2008,118 @@ class DB_Mysql():
 			"""
 		)
 
-		self.MYSQL_CONNECTION.commit()
\ No newline at end of file
+		self.MYSQL_CONNECTION.commit()
+
+	def update_version_10(self):
+		# Add the share_rollups table used by the aggregated share accounting mode
+		log.info("running update 10")
+		self.execute(
+			"""
+			CREATE TABLE IF NOT EXISTS `share_rollups` (
+				`id` BIGINT(20) UNSIGNED NOT NULL AUTO_INCREMENT,
+				`worker` BIGINT(20) UNSIGNED NOT NULL DEFAULT '0',
+				`interval_start` DATETIME NOT NULL,
+				`block_num` INT(10) UNSIGNED NOT NULL DEFAULT '0',
+				`accepted_count` INT(10) UNSIGNED NOT NULL DEFAULT '0',
+				`accepted_diff` DOUBLE UNSIGNED NOT NULL DEFAULT '0',
+				`rejected_count` INT(10) UNSIGNED NOT NULL DEFAULT '0',
+				`rejected_diff` DOUBLE UNSIGNED NOT NULL DEFAULT '0',
+				`best_share` DOUBLE UNSIGNED NOT NULL DEFAULT '0',
+				`last_share` DATETIME NOT NULL,
+				PRIMARY KEY (`id`),
+				UNIQUE INDEX `share_rollups-worker_interval_block` (`worker`, `interval_start`, `block_num`),
+				INDEX `share_rollups-interval_start` (`interval_start`)
+			)
+			COLLATE='utf8_general_ci'
+			ENGINE=InnoDB
+			;
+			"""
+		)
+
+		self.execute(
+			"""
+			UPDATE `pool` 
+			SET `value` = 11
+			WHERE `parameter` = 'DB Version'
+			"""
+		)
+
+		self.MYSQL_CONNECTION.commit()
+
+	def update_version_11(self):
+		# The archive tables did not get the float difficulty of update 8
+		log.info("running update 11")
+		for table in ['shares_archive', 'shares_archive_found']:
+			self.execute(
+				"""
+				ALTER TABLE `%s`
+				CHANGE COLUMN `difficulty` `difficulty` 
+				FLOAT UNSIGNED NULL DEFAULT NULL;
+				""" % table
+			)
+
+		self.execute(
+			"""
+			UPDATE `pool` 
+			SET `value` = 12
+			WHERE `parameter` = 'DB Version'
+			"""
+		)
+
+		self.MYSQL_CONNECTION.commit()
+
+	def update_version_12(self):
+		# Prepare the shares table for RANGE partitioning on time:
+		# partitioned tables can't have foreign keys and every unique key must include the partitioning column.
+		# time no longer changes on UPDATE, a share must not move to another partition when found_block() updates it
+		log.info("running update 12")
+		self.execute(
+			"""
+			ALTER TABLE `shares`
+			DROP FOREIGN KEY `workerid`
+			"""
+		)
+
+		self.execute(
+			"""
+			ALTER TABLE `shares`
+			CHANGE COLUMN `time` `time` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+			DROP PRIMARY KEY,
+			ADD PRIMARY KEY (`id`, `time`)
+			"""
+		)
+
+		if settings.DB_PARTITION_SHARES:
+			self.partition_shares()
+
+		self.execute(
+			"""
+			UPDATE `pool` 
+			SET `value` = 13
+			WHERE `parameter` = 'DB Version'
+			"""
+		)
+
+		self.MYSQL_CONNECTION.commit()
+
+	def update_version_13(self):
+		# last_update columns for the incremental worker sync (get_workers())
+		log.info("running update 13")
+		for table in ['pool_worker', 'pool_worker_settings']:
+			self.execute(
+				"""
+				ALTER TABLE `%s`
+				ADD COLUMN `last_update` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+				ADD INDEX `%s_last_update` (`last_update`)
+				""" % (table, table)
+			)
+
+		self.execute(
+			"""
+			UPDATE `pool` 
+			SET `value` = 14
+			WHERE `parameter` = 'DB Version'
+			"""
+		)
+
+		self.MYSQL_CONNECTION.commit()
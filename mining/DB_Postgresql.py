@@ -0,0 +1,1246 @@
+import time
+import hashlib
+import threading
+import datetime
+import StringIO
+import csv
+import RoundStats
+import CircuitBreaker
+import lib.settings as settings
+import lib.logger
+log = lib.logger.get_logger('DB_Postgresql')
+
+import psycopg2
+import psycopg2.extras
+
+class DB_Postgresql():
+	'''
+		PostgreSQL storage driver, same method surface as DB_Mysql.
+
+		Share batches are streamed in with COPY ... FROM STDIN (CSV), round
+		stats and rollups are written with INSERT ... ON CONFLICT and worker
+		checkins with a single UPDATE ... FROM (VALUES ...) per batch.
+	'''
+
+	# username -> pool_worker.id, shared by every connection (import threads open their own)
+	WORKER_IDS = {}
+	WORKER_IDS_LOCK = threading.Lock()
+
+	# Totals of the current round published by this process, shared by every connection
+	ROUND_STATS = RoundStats.RoundStats()
+
+	# Connects of every connection go through the breaker, see reconnect()
+	BREAKER = CircuitBreaker.CircuitBreaker('PostgreSQL', settings.DB_RECONNECT_MIN_DELAY, settings.DB_RECONNECT_MAX_DELAY)
+
+	def __init__(self):
+		# DB Connection Handle
+		self.PGSQL_CONNECTION = None
+		# Shared Cursor
+		self.PGSQL_CURSOR = None
+
+		log.debug("PostgreSQL Database Initialization")
+
+		required_settings = ['PASSWORD_SALT', 'DB_PGSQL_HOST',
+							 'DB_PGSQL_USER', 'DB_PGSQL_PASS',
+							 'DB_PGSQL_DBNAME', 'DB_PGSQL_PORT',
+							 'DB_PGSQL_SCHEMA']
+
+		for setting_name in required_settings:
+			if not hasattr(settings, setting_name):
+				raise ValueError("%s isn't set, please set in config.py" % setting_name)
+
+		self.salt = getattr(settings, 'PASSWORD_SALT')
+		self.database_extend = hasattr(settings, 'DATABASE_EXTEND') and getattr(settings, 'DATABASE_EXTEND') is True
+
+		self.reconnect()
+
+# -------------------------- BEGIN PostgreSQL Operational Functions ---------------------------------------
+
+	def connect(self):
+		log.info("Attempting to connect PostgreSQL database server...")
+		self.PGSQL_CONNECTION = psycopg2.connect(
+			host = settings.DB_PGSQL_HOST,
+			port = settings.DB_PGSQL_PORT,
+			user = settings.DB_PGSQL_USER,
+			password = settings.DB_PGSQL_PASS,
+			database = settings.DB_PGSQL_DBNAME,
+			# Don't hang for the TCP timeout when the server is unreachable
+			connect_timeout = settings.DB_CONNECT_TIMEOUT
+		)
+
+		# Single statements commit right away, imports use begin()/commit()
+		self.PGSQL_CONNECTION.autocommit = True
+		self.PGSQL_CURSOR = self.PGSQL_CONNECTION.cursor()
+		self.PGSQL_CURSOR.execute("SET search_path TO %s", (settings.DB_PGSQL_SCHEMA,))
+		log.info("PostgreSQL database server Connected!")
+
+	def close(self):
+		log.info("Disconnecting PostgreSQL database server.")
+		try:
+			self.PGSQL_CURSOR.close()
+			self.PGSQL_CONNECTION.close()
+			self.PGSQL_CONNECTION = None
+			self.PGSQL_CURSOR = None
+		except:
+			# It may fail
+			log.debug("DB Connection Already Closed.")
+
+	def check_connection(self):
+		# A connection lost during the last statement is reopened before the next one
+		if self.PGSQL_CONNECTION is None or self.PGSQL_CONNECTION.closed:
+			log.warning("PostgreSQL connection lost, reconnecting.")
+			self.reconnect()
+
+	def reconnect(self):
+		# Makes one connect attempt if the circuit breaker allows it, raises CircuitOpenError or the connect error otherwise
+		DB_Postgresql.BREAKER.check()
+
+		try:
+			self.close()
+			self.connect()
+		except psycopg2.Error as e:
+			retry_at = DB_Postgresql.BREAKER.failure()
+			log.error("PostgreSQL database server connect failed: %s.  Next attempt in %.1f seconds" % (e, retry_at - time.time()))
+			raise
+
+		DB_Postgresql.BREAKER.success()
+
+	def execute(self, query, args = None):
+		log.debug("DB Query: %s" % query)
+		if not args == None:
+			log.debug("DB Values: %s" % (args,))
+
+		self.check_connection()
+		self.PGSQL_CURSOR.execute(query, args)
+
+	def executemany(self, query, args):
+		log.debug("Execute Many Operation")
+		self.check_connection()
+		self.PGSQL_CURSOR.executemany(query, args)
+
+	def executefetch(self, query, args = None):
+		# Returns the rows as dicts, like MySQLdb's DictCursor
+		self.check_connection()
+		cursor = self.PGSQL_CONNECTION.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+		cursor.execute(query, args)
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	def begin(self):
+		self.check_connection()
+		self.PGSQL_CURSOR.execute("BEGIN")
+
+	def commit(self):
+		self.PGSQL_CURSOR.execute("COMMIT")
+
+	def rollback(self):
+		try:
+			self.PGSQL_CURSOR.execute("ROLLBACK")
+		except psycopg2.Error:
+			# The connection may be gone, the server rolls back for us then
+			log.debug("Rollback failed, connection already closed.")
+
+# -------------------------- END PostgreSQL Operational Functions ---------------------------------------
+
+	def hash_pass(self, password):
+		m = hashlib.sha1()
+		m.update(password)
+		m.update(self.salt)
+
+		return m.hexdigest()
+
+	def timestamp(self, unix_time):
+		# COPY takes text, use an explicit UTC timestamp
+		return datetime.datetime.utcfromtimestamp(unix_time).strftime("%Y-%m-%d %H:%M:%S.%f+00")
+
+	def preload_worker_ids(self):
+		# Fills the username -> id map with every known worker
+		log.info("Preloading worker ids")
+
+		self.execute(
+			"""
+			SELECT id, username
+			FROM pool_worker
+			ORDER BY id
+			"""
+		)
+
+		worker_ids = {}
+		for row in self.PGSQL_CURSOR.fetchall():
+			worker_ids.setdefault(row[1], row[0])
+
+		with DB_Postgresql.WORKER_IDS_LOCK:
+			DB_Postgresql.WORKER_IDS.clear()
+			DB_Postgresql.WORKER_IDS.update(worker_ids)
+
+		log.info("Loaded %i worker ids" % len(worker_ids))
+
+	def invalidate_worker_id(self, id_or_username = None):
+		# Drops a single worker (by id or username) from the username -> id map, or all of them
+		with DB_Postgresql.WORKER_IDS_LOCK:
+			if id_or_username is None:
+				DB_Postgresql.WORKER_IDS.clear()
+				return
+
+			id_or_username = str(id_or_username)
+			DB_Postgresql.WORKER_IDS.pop(id_or_username, None)
+
+			if id_or_username.isdigit():
+				for username, worker_id in DB_Postgresql.WORKER_IDS.items():
+					if worker_id == int(id_or_username):
+						del DB_Postgresql.WORKER_IDS[username]
+
+	def get_worker_id(self, username):
+		# Returns the pool_worker id of a username, or None if it does not exist
+		return self.get_worker_ids([username]).get(username)
+
+	def get_worker_ids(self, usernames):
+		# Resolves a list of usernames to their pool_worker id, unknown usernames are not included
+		worker_ids = {}
+		missing = []
+
+		for username in set(usernames):
+			worker_id = DB_Postgresql.WORKER_IDS.get(username)
+			if worker_id is None:
+				missing.append(username)
+			else:
+				worker_ids[username] = worker_id
+
+		if missing:
+			self.execute(
+				"""
+				SELECT id, username
+				FROM pool_worker
+				WHERE username = ANY(%s)
+				ORDER BY id
+				""",
+				(missing,)
+			)
+
+			found = {}
+			for row in self.PGSQL_CURSOR.fetchall():
+				found.setdefault(row[1], row[0])
+
+			with DB_Postgresql.WORKER_IDS_LOCK:
+				DB_Postgresql.WORKER_IDS.update(found)
+
+			worker_ids.update(found)
+
+		return worker_ids
+
+	def import_block_candidate(self, data):
+		# Writes a block candidate share right away, returns its shares.id for found_block()
+		return self.import_shares([data], True)
+
+	def import_shares(self, data, keep_id = False, round_stats = True, round_height = None):
+		# Same data layout as DB_Mysql.import_shares
+		log.debug("Importing Shares")
+		checkin_times = {}
+		total_shares = 0
+		best_diff = 0
+
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		for username in set([v[0] for v in data]) - set(worker_ids.keys()):
+			log.warning("Worker '%s' not found, saving shares under worker id 0" % username)
+
+		rows = []
+		for v in data:
+			# Shares up to the height of the last found block are stored but left out of the round totals
+			if round_height is None or v[7] > round_height:
+				total_shares += v[3]
+				best_diff = max(best_diff, v[10])
+
+			checkin = checkin_times.setdefault(v[0], {"time": 0, "shares": 0, "rejects": 0})
+			checkin["time"] = max(checkin["time"], v[4])
+			if v[5] == True:
+				checkin["shares"] += v[3]
+			else:
+				checkin["rejects"] += v[3]
+
+			rows.append((self.timestamp(v[4]), v[6], worker_ids.get(v[0], 0), v[5], v[9], v[2], v[7], v[8], v[3]))
+
+		self.begin()
+		try:
+			share_id = None
+			if keep_id:
+				share_id = self.insert_share(rows[0])
+			else:
+				self.copy_shares(rows)
+
+			# Without round_stats the caller publishes the round totals (see StatsAggregator)
+			if round_stats:
+				self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if round_stats:
+			DB_Postgresql.ROUND_STATS.add(total_shares, best_diff)
+		return share_id
+
+	def copy_shares(self, rows):
+		# Streams share rows into the shares table with COPY
+		# Row layout: time, rem_host, worker id, our_result, reason, solution, block_num, prev_block_hash, difficulty
+		log.debug("Copying %i share rows" % len(rows))
+
+		buf = StringIO.StringIO()
+		writer = csv.writer(buf, lineterminator = '\n')
+		for row in rows:
+			writer.writerow([self.csv_value(value) for value in row])
+		buf.seek(0)
+
+		self.PGSQL_CURSOR.copy_expert(
+			"""
+			COPY shares
+			(time, rem_host, worker, our_result, reason, solution,
+			  block_num, prev_block_hash, difficulty)
+			FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (rem_host, reason, solution, prev_block_hash))
+			""",
+			buf
+		)
+
+	def csv_value(self, value):
+		# None becomes an unquoted empty field, which COPY reads as NULL (except for the FORCE_NOT_NULL text columns)
+		if value is None:
+			return ''
+
+		if isinstance(value, bool):
+			return 't' if value else 'f'
+
+		if isinstance(value, float):
+			return repr(value)
+
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+
+		return value
+
+	def insert_share(self, row):
+		# Writes a single share row (same layout as copy_shares) and returns its id
+		self.execute(
+			"""
+			INSERT INTO shares
+			(time, rem_host, worker, our_result, upstream_result,
+			  reason, solution, block_num, prev_block_hash,
+			  useragent, difficulty)
+			VALUES
+			(%s, %s, %s, %s, FALSE, %s, %s, %s, %s, '', %s)
+			RETURNING id
+			""",
+			row
+		)
+
+		return self.PGSQL_CURSOR.fetchone()[0]
+
+	def add_round_stats(self, total_shares, best_diff):
+		# Publishes round totals collected from several imports at once
+		self.begin()
+		try:
+			self.update_round_stats(total_shares, best_diff)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Postgresql.ROUND_STATS.add(total_shares, best_diff)
+
+	def update_round_stats(self, total_shares, best_diff):
+		# Adds total_shares (in difficulty) to the round and keeps the best share, both as atomic upserts
+		self.execute(
+			"""
+			INSERT INTO pool (parameter, value)
+			VALUES ('round_shares', %(shares)s)
+			ON CONFLICT (parameter) DO UPDATE
+			SET value = (COALESCE(NULLIF(pool.value, ''), '0')::DOUBLE PRECISION + EXCLUDED.value::DOUBLE PRECISION)::TEXT
+			""",
+			{
+				"shares": str(total_shares)
+			}
+		)
+
+		if best_diff > 0:
+			self.execute(
+				"""
+				INSERT INTO pool (parameter, value)
+				VALUES ('round_best_share', %(best)s)
+				ON CONFLICT (parameter) DO UPDATE
+				SET value = GREATEST(COALESCE(NULLIF(pool.value, ''), '0')::DOUBLE PRECISION, EXCLUDED.value::DOUBLE PRECISION)::TEXT
+				""",
+				{
+					"best": str(best_diff)
+				}
+			)
+
+		self.execute(
+			"""
+			UPDATE pool AS progress
+			SET value = (CASE WHEN COALESCE(NULLIF(difficulty.value, ''), '0')::DOUBLE PRECISION = 0 THEN 0
+			  ELSE COALESCE(NULLIF(shares.value, ''), '0')::DOUBLE PRECISION / difficulty.value::DOUBLE PRECISION * 100 END)::TEXT
+			FROM pool AS shares, pool AS difficulty
+			WHERE progress.parameter = 'round_progress'
+			  AND shares.parameter = 'round_shares'
+			  AND difficulty.parameter = 'bitcoin_difficulty'
+			"""
+		)
+
+	def update_worker_checkins(self, checkin_times, worker_ids):
+		# checkin_times: username -> {"time": last share time, "shares": accepted difficulty, "rejects": rejected difficulty}
+		# One UPDATE for the whole batch, an upsert could re-create a worker deleted in the meantime
+		# Ids are sorted so parallel imports lock the rows in the same order
+		checkins = sorted([(worker_ids[k], self.timestamp(v["time"]), v["shares"], v["rejects"]) for (k, v) in checkin_times.items() if k in worker_ids])
+		if not checkins:
+			return
+
+		psycopg2.extras.execute_values(
+			self.PGSQL_CURSOR,
+			"""
+			UPDATE pool_worker
+			SET last_checkin = checkin.time::TIMESTAMP WITH TIME ZONE,
+			  total_shares = pool_worker.total_shares + checkin.shares,
+			  total_rejects = pool_worker.total_rejects + checkin.rejects
+			FROM (VALUES %s) AS checkin (id, time, shares, rejects)
+			WHERE pool_worker.id = checkin.id
+			""",
+			checkins,
+			page_size = settings.DB_LOADER_INSERT_CHUNK
+		)
+
+	def flush_worker_checkins(self):
+		# Nothing is held back, checkins are written with every batch (DB_CHECKIN_INTERVAL only applies to MySQL)
+		pass
+
+	def found_block(self, data, share_id = None):
+		# share_id is the row written by import_block_candidate(), without it the share is looked up by time and worker
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			if share_id is not None:
+				self.execute(
+					"""
+					UPDATE shares
+					SET upstream_result = %(result)s,
+					  solution = %(solution)s
+					WHERE id = %(id)s
+					""",
+					{
+						"result": data[5],
+						"solution": data[2],
+						"id": share_id
+					}
+				)
+			else:
+				self.execute(
+					"""
+					UPDATE shares
+					SET upstream_result = %(result)s,
+					  solution = %(solution)s
+					WHERE id = (
+					  SELECT id
+					  FROM shares
+					  WHERE time = %(time)s
+					    AND worker = %(worker)s
+					  LIMIT 1
+					)
+					""",
+					{
+						"result": data[5],
+						"solution": data[2],
+						"time": self.timestamp(data[4]),
+						"worker": worker_id
+					}
+				)
+
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Postgresql.ROUND_STATS.reset()
+
+	def get_block_share_id(self, data):
+		# Returns the shares.id of the stored block candidate 'data', or None while it is not stored
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		shares = self.executefetch(
+			"""
+			SELECT id
+			FROM shares
+			WHERE time = %(time)s
+			  AND worker = %(worker)s
+			  AND solution = %(solution)s
+			LIMIT 1
+			""",
+			{
+				"time": self.timestamp(data[4]),
+				"worker": worker_id,
+				"solution": data[2]
+			}
+		)
+
+		return shares[0]['id'] if shares else None
+
+	def record_found_block(self, worker_id):
+		# Credits the worker with the block and starts a new round
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET total_found = total_found + 1
+			WHERE id = %(id)s
+			""",
+			{
+				"id": worker_id
+			}
+		)
+
+		self.execute(
+			"""
+			INSERT INTO pool (parameter, value)
+			VALUES ('pool_total_found', '1')
+			ON CONFLICT (parameter) DO UPDATE
+			SET value = (COALESCE(NULLIF(pool.value, ''), '0')::BIGINT + 1)::TEXT
+			"""
+		)
+
+		self.executemany(
+			"""
+			INSERT INTO pool (parameter, value)
+			VALUES (%(param)s, %(value)s)
+			ON CONFLICT (parameter) DO UPDATE
+			SET value = EXCLUDED.value
+			""",
+			[
+				{
+					"param": "round_shares",
+					"value": "0"
+				},
+				{
+					"param": "round_progress",
+					"value": "0"
+				},
+				{
+					"param": "round_best_share",
+					"value": "0"
+				},
+				{
+					"param": "round_start",
+					"value": str(time.time())
+				}
+			]
+		)
+
+	def import_rollups(self, data, round_height = None):
+		# Same data layout as DB_Mysql.import_rollups
+		log.debug("Importing Share Rollups")
+		checkin_times = {}
+		total_shares = 0
+		best_diff = 0
+
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		rows = []
+		for v in data:
+			if round_height is None or v[2] > round_height:
+				total_shares += v[4] + v[6]
+				best_diff = max(best_diff, v[7])
+
+			checkin = checkin_times.setdefault(v[0], {"time": 0, "shares": 0, "rejects": 0})
+			checkin["time"] = max(checkin["time"], v[8])
+			checkin["shares"] += v[4]
+			checkin["rejects"] += v[6]
+
+			rows.append((worker_ids.get(v[0], 0), self.timestamp(v[1]), v[2], v[3], v[4], v[5], v[6], v[7], self.timestamp(v[8])))
+
+		self.begin()
+		try:
+			# A rollup flushed twice for the same interval (retries, restarts) is added up
+			psycopg2.extras.execute_values(
+				self.PGSQL_CURSOR,
+				"""
+				INSERT INTO share_rollups
+				(worker, interval_start, block_num, accepted_count, accepted_diff,
+				  rejected_count, rejected_diff, best_share, last_share)
+				VALUES %s
+				ON CONFLICT (worker, interval_start, block_num) DO UPDATE
+				SET accepted_count = share_rollups.accepted_count + EXCLUDED.accepted_count,
+				  accepted_diff = share_rollups.accepted_diff + EXCLUDED.accepted_diff,
+				  rejected_count = share_rollups.rejected_count + EXCLUDED.rejected_count,
+				  rejected_diff = share_rollups.rejected_diff + EXCLUDED.rejected_diff,
+				  best_share = GREATEST(share_rollups.best_share, EXCLUDED.best_share),
+				  last_share = GREATEST(share_rollups.last_share, EXCLUDED.last_share)
+				""",
+				rows,
+				page_size = settings.DB_LOADER_INSERT_CHUNK
+			)
+
+			self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Postgresql.ROUND_STATS.add(total_shares, best_diff)
+
+	def insert_block_share(self, data):
+		# Records a block candidate as its own share row, used when shares are not saved one by one
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				INSERT INTO shares
+				(time, rem_host, worker, our_result, upstream_result,
+				  reason, solution, block_num, prev_block_hash,
+				  useragent, difficulty)
+				VALUES
+				(%(time)s, %(host)s, %(worker)s, TRUE, %(result)s,
+				  '', %(solution)s, %(blocknum)s, %(hash)s, '', %(difficulty)s)
+				""",
+				{
+					"time": self.timestamp(data[4]),
+					"host": data[6],
+					"worker": worker_id,
+					"result": data[5],
+					"solution": data[2],
+					"blocknum": data[7],
+					"hash": data[8],
+					"difficulty": data[3]
+				}
+			)
+
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Postgresql.ROUND_STATS.reset()
+
+	def get_archive_boundary(self, cutoff):
+		# Returns the id of the first share at or after 'cutoff', everything before it may be archived
+		# None when there is nothing to archive
+		self.execute(
+			"""
+			SELECT id
+			FROM shares
+			WHERE time >= TO_TIMESTAMP(%s)
+			ORDER BY time, id
+			LIMIT 1
+			""",
+			(cutoff,)
+		)
+
+		data = self.PGSQL_CURSOR.fetchone()
+		if data is not None:
+			return data[0]
+
+		self.execute(
+			"""
+			SELECT MAX(id) + 1
+			FROM shares
+			"""
+		)
+
+		return self.PGSQL_CURSOR.fetchone()[0]
+
+	def get_archive_chunk(self, after_id, before_id, cutoff, limit):
+		# Next 'limit' shares to archive after 'after_id', columns as in ShareArchiver.COLUMNS
+		self.execute(
+			"""
+			SELECT shares.id, EXTRACT(EPOCH FROM shares.time), shares.rem_host, shares.worker,
+			  pool_worker.username, shares.our_result, shares.upstream_result, shares.reason,
+			  shares.solution, shares.block_num, shares.prev_block_hash, shares.useragent,
+			  shares.difficulty
+			FROM shares
+			LEFT JOIN pool_worker
+			  ON pool_worker.id = shares.worker
+			WHERE shares.id > %s
+			  AND shares.id < %s
+			  AND shares.time < TO_TIMESTAMP(%s)
+			ORDER BY shares.id
+			LIMIT %s
+			""",
+			(after_id, before_id, cutoff, limit)
+		)
+
+		return self.PGSQL_CURSOR.fetchall()
+
+	def archive_shares(self, after_id, before_id, cutoff, limit):
+		# Moves the next 'limit' shares after 'after_id' to shares_archive (and found blocks to shares_archive_found)
+		# Returns (last id, number of shares), last id is None when there was nothing left
+		self.execute(
+			"""
+			SELECT MAX(id), COUNT(*)
+			FROM (
+			  SELECT id
+			  FROM shares
+			  WHERE id > %s
+			    AND id < %s
+			    AND time < TO_TIMESTAMP(%s)
+			  ORDER BY id
+			  LIMIT %s
+			) AS chunk
+			""",
+			(after_id, before_id, cutoff, limit)
+		)
+
+		(last_id, count) = self.PGSQL_CURSOR.fetchone()
+		if last_id is None:
+			return (None, 0)
+
+		self.begin()
+		try:
+			for (table, condition) in [('shares_archive', ''), ('shares_archive_found', 'AND upstream_result = TRUE')]:
+				self.execute(
+					"""
+					INSERT INTO %s
+					SELECT *
+					FROM shares
+					WHERE id > %%s
+					  AND id <= %%s
+					  AND time < TO_TIMESTAMP(%%s)
+					  %s
+					ON CONFLICT DO NOTHING
+					""" % (table, condition),
+					(after_id, last_id, cutoff)
+				)
+
+			self.execute(
+				"""
+				DELETE FROM shares
+				WHERE id > %s
+				  AND id <= %s
+				  AND time < TO_TIMESTAMP(%s)
+				""",
+				(after_id, last_id, cutoff)
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		return (last_id, count)
+
+	def delete_shares(self, after_id, last_id, cutoff, limit):
+		# Deletes at most 'limit' archived shares, returns how many were deleted
+		self.execute(
+			"""
+			DELETE FROM shares
+			WHERE id IN (
+			  SELECT id
+			  FROM shares
+			  WHERE id > %s
+			    AND id <= %s
+			    AND time < TO_TIMESTAMP(%s)
+			  ORDER BY id
+			  LIMIT %s
+			)
+			""",
+			(after_id, last_id, cutoff, limit)
+		)
+
+		return self.PGSQL_CURSOR.rowcount
+
+	def list_users(self):
+		for user in self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker
+			WHERE id > 0
+			"""
+		):
+			yield user
+
+	def get_user(self, id_or_username):
+		log.debug("Finding user with id or username of %s", id_or_username)
+
+		users = self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker
+			WHERE id = %(id)s
+			  OR username = %(uname)s
+			""",
+			{
+				"id": id_or_username if id_or_username.isdigit() else -1,
+				"uname": id_or_username
+			}
+		)
+
+		return users[0] if users else None
+
+	def get_workers(self, since = None):
+		# Returns (server time, rows) of pool_worker joined with its settings, changed since 'since' or all of them
+		# The time is taken first and a bit early, rows of transactions still running are fetched again next time
+		self.execute("SELECT now() - interval '10 seconds'")
+		server_time = self.PGSQL_CURSOR.fetchone()[0]
+
+		query = """
+			SELECT w.id, w.username, w.password, w.difficulty, w.last_checkin,
+			  COALESCE(s.custom_diff_enable, 0) AS custom_diff_enable
+			FROM pool_worker w
+			LEFT JOIN pool_worker_settings s ON s.pool_worker_id = w.id
+			"""
+
+		if since is None:
+			workers = self.executefetch(query)
+		else:
+			workers = self.executefetch(
+				query + "WHERE w.last_update >= %(since)s UNION " +
+				query + "WHERE s.last_update >= %(since)s",
+				{
+					"since": since
+				}
+			)
+
+		return (server_time, workers)
+
+	def get_user_settings(self, worker_id):
+		log.debug("Finding configuration with worker_id of %s", worker_id)
+
+		user_settings = self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker_settings
+			WHERE pool_worker_id = %(id)s
+			""",
+			{
+				"id": worker_id
+			}
+		)
+
+		return user_settings[0] if user_settings else None
+
+	def delete_user(self, id_or_username):
+		if id_or_username.isdigit() and id_or_username == '0':
+			raise Exception('You cannot delete that user')
+
+		log.debug("Deleting user with id or username of %s", id_or_username)
+
+		if id_or_username.isdigit():
+			worker_id = int(id_or_username)
+		else:
+			worker_id = self.get_worker_id(id_or_username)
+
+		self.begin()
+		try:
+			if worker_id is not None:
+				self.execute(
+					"""
+					UPDATE shares
+					SET worker = 0
+					WHERE worker = %(id)s
+					""",
+					{
+						"id": worker_id
+					}
+				)
+
+			self.execute(
+				"""
+				DELETE FROM pool_worker
+				WHERE id = %(id)s
+				  OR username = %(uname)s
+				""",
+				{
+					"id": id_or_username if id_or_username.isdigit() else -1,
+					"uname": id_or_username
+				}
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		self.invalidate_worker_id(id_or_username)
+
+	def insert_user(self, username, password):
+		log.debug("Adding new user %s", username)
+
+		self.execute(
+			"""
+			INSERT INTO pool_worker
+			(username, password)
+			VALUES
+			(%(uname)s, %(pass)s)
+			""",
+			{
+				"uname": username,
+				"pass": self.hash_pass(password)
+			}
+		)
+
+		self.invalidate_worker_id(username)
+
+		return str(username)
+
+	def update_user(self, id_or_username, password):
+		log.debug("Updating password for user %s", id_or_username);
+
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET password = %(pass)s
+			WHERE id = %(id)s
+			  OR username = %(uname)s
+			""",
+			{
+				"id": id_or_username if id_or_username.isdigit() else -1,
+				"uname": id_or_username,
+				"pass": self.hash_pass(password)
+			}
+		)
+
+		self.invalidate_worker_id(id_or_username)
+
+	def update_worker_diff(self, username, diff):
+		log.debug("Setting difficulty for %s to %s", username, diff)
+
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET difficulty = %(diff)s
+			WHERE username = %(uname)s
+			""",
+			{
+				"uname": username,
+				"diff": diff
+			}
+		)
+
+	def update_worker_diffs(self, diffs):
+		# diffs: username -> difficulty, one UPDATE per DB_LOADER_INSERT_CHUNK workers
+		# Usernames are sorted so concurrent writers lock the rows in the same order
+		log.debug("Setting difficulty of %i worker(s)" % len(diffs))
+
+		self.check_connection()
+		psycopg2.extras.execute_values(
+			self.PGSQL_CURSOR,
+			"""
+			UPDATE pool_worker
+			SET difficulty = diff.difficulty
+			FROM (VALUES %s) AS diff (username, difficulty)
+			WHERE pool_worker.username = diff.username
+			""",
+			sorted(diffs.items()),
+			page_size = settings.DB_LOADER_INSERT_CHUNK
+		)
+
+	def clear_worker_diff(self):
+		if self.database_extend:
+			log.debug("Resetting difficulty for all workers")
+
+			self.execute(
+				"""
+				UPDATE pool_worker
+				SET difficulty = 0
+				"""
+			)
+
+	def check_password(self, username, password):
+		log.debug("Checking username/password for %s", username)
+
+		self.execute(
+			"""
+			SELECT COUNT(*)
+			FROM pool_worker
+			WHERE username = %(uname)s
+			  AND password = %(pass)s
+			""",
+			{
+				"uname": username,
+				"pass": self.hash_pass(password)
+			}
+		)
+
+		data = self.PGSQL_CURSOR.fetchone()
+
+		if data[0] > 0:
+			return True
+
+		return False
+
+	def get_worker_diff(self, username):
+		# Defualt Value
+		worker_diff = settings.POOL_TARGET
+
+		self.execute("SELECT difficulty FROM pool_worker WHERE username = %s", (username,))
+		data = self.PGSQL_CURSOR.fetchone()
+
+		if data is not None and data[0] > 0:
+			worker_diff = data[0]
+
+		return worker_diff
+
+	def set_worker_diff(self, username, difficulty):
+		self.execute("UPDATE pool_worker SET difficulty = %s WHERE username = %s", (difficulty, username))
+
+	def check_tables(self):
+		log.debug("Checking Tables")
+
+		self.execute(
+			"""
+			SELECT COUNT(*)
+			FROM information_schema.tables
+			WHERE table_schema = %(schema)s
+			  AND table_name = 'shares'
+			""",
+			{
+				"schema": settings.DB_PGSQL_SCHEMA
+			}
+		)
+
+		data = self.PGSQL_CURSOR.fetchone()
+
+		if data[0] <= 0:
+			self.update_version_1()		# no, we don't, so create them
+
+		self.update_tables()
+
+	def update_tables(self):
+		version = 0
+		current_version = 12
+
+		while version < current_version:
+			self.execute(
+				"""
+				SELECT value
+				FROM pool
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			data = self.PGSQL_CURSOR.fetchone()
+			version = int(data[0])
+
+			if version < current_version:
+				log.info("Updating Database from %i to %i" % (version, version +1))
+				getattr(self, 'update_version_' + str(version) )()
+
+	def update_version_1(self):
+		# A new PostgreSQL database starts out with the layout MySQL has at version 10
+		log.info("Creating PostgreSQL tables")
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool
+				(
+					parameter VARCHAR(128) NOT NULL PRIMARY KEY,
+					value VARCHAR(512)
+				)
+				"""
+			)
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool_worker
+				(
+					id BIGSERIAL PRIMARY KEY,
+					username VARCHAR(512) NOT NULL UNIQUE,
+					password CHAR(40) NOT NULL,
+					speed INTEGER NOT NULL DEFAULT 0,
+					last_checkin TIMESTAMP WITH TIME ZONE,
+					total_shares DOUBLE PRECISION NOT NULL DEFAULT 0,
+					total_rejects DOUBLE PRECISION NOT NULL DEFAULT 0,
+					total_found INTEGER NOT NULL DEFAULT 0,
+					alive BOOLEAN NOT NULL DEFAULT FALSE,
+					difficulty REAL NOT NULL DEFAULT 0
+				)
+				"""
+			)
+
+			self.execute("CREATE INDEX IF NOT EXISTS pool_worker_alive ON pool_worker (alive)")
+
+			for table in ['shares', 'shares_archive', 'shares_archive_found']:
+				self.execute(
+					"""
+					CREATE TABLE IF NOT EXISTS %s
+					(
+						id BIGSERIAL PRIMARY KEY,
+						time TIMESTAMP WITH TIME ZONE,
+						rem_host TEXT,
+						worker BIGINT NOT NULL DEFAULT 0,
+						our_result BOOLEAN,
+						upstream_result BOOLEAN,
+						reason TEXT,
+						solution TEXT,
+						block_num INTEGER,
+						prev_block_hash TEXT,
+						useragent TEXT,
+						difficulty REAL
+					)
+					""" % table
+				)
+
+			self.execute("CREATE INDEX IF NOT EXISTS shares_time_worker ON shares (time, worker)")
+			self.execute("CREATE INDEX IF NOT EXISTS shares_worker ON shares (worker)")
+			self.execute("CREATE INDEX IF NOT EXISTS shares_upstreamresult ON shares (upstream_result)")
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS payments
+				(
+					id SERIAL PRIMARY KEY,
+					solution VARCHAR(80) NOT NULL UNIQUE,
+					pstatus VARCHAR(50) NOT NULL DEFAULT 'pending',
+					txid TEXT,
+					amount INTEGER NOT NULL DEFAULT 0,
+					last_update TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+				)
+				"""
+			)
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool_worker_settings
+				(
+					id SERIAL PRIMARY KEY,
+					pool_worker_id BIGINT NOT NULL DEFAULT 0 UNIQUE,
+					custom_diff_enable SMALLINT NOT NULL DEFAULT 0
+				)
+				"""
+			)
+
+			# Placeholder worker for shares of unknown workers
+			self.execute(
+				"""
+				INSERT INTO pool_worker
+				(id, username, password)
+				VALUES
+				(0, MD5(RANDOM()::TEXT), MD5(CLOCK_TIMESTAMP()::TEXT) || '00000000')
+				ON CONFLICT DO NOTHING
+				"""
+			)
+
+			self.executemany(
+				"""
+				INSERT INTO pool (parameter, value) VALUES (%s, %s)
+				ON CONFLICT DO NOTHING
+				""",
+				[
+					('DB Version', '10'),
+					('bitcoin_blocks', '0'),
+					('bitcoin_balance', '0'),
+					('bitcoin_connections', '0'),
+					('bitcoin_difficulty', '0'),
+					('bitcoin_infotime', '0'),
+					('pool_speed', '0'),
+					('pool_total_found', '0'),
+					('round_shares', '0'),
+					('round_progress', '0'),
+					('round_best_share', '0'),
+					('round_start', str(time.time()))
+				]
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+	def update_version_10(self):
+		# Add the share_rollups table used by the aggregated share accounting mode
+		log.info("running update 10")
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS share_rollups
+				(
+					id BIGSERIAL PRIMARY KEY,
+					worker BIGINT NOT NULL DEFAULT 0,
+					interval_start TIMESTAMP WITH TIME ZONE NOT NULL,
+					block_num INTEGER NOT NULL DEFAULT 0,
+					accepted_count INTEGER NOT NULL DEFAULT 0,
+					accepted_diff DOUBLE PRECISION NOT NULL DEFAULT 0,
+					rejected_count INTEGER NOT NULL DEFAULT 0,
+					rejected_diff DOUBLE PRECISION NOT NULL DEFAULT 0,
+					best_share DOUBLE PRECISION NOT NULL DEFAULT 0,
+					last_share TIMESTAMP WITH TIME ZONE NOT NULL,
+					UNIQUE (worker, interval_start, block_num)
+				)
+				"""
+			)
+
+			self.execute("CREATE INDEX IF NOT EXISTS share_rollups_interval_start ON share_rollups (interval_start)")
+
+			self.execute(
+				"""
+				UPDATE pool
+				SET value = '11'
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+	def update_version_11(self):
+		# last_update columns for the incremental worker sync (get_workers())
+		# Checkins don't touch it, only inserts and changes of the columns held by the worker sync do
+		log.info("running update 11")
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				CREATE OR REPLACE FUNCTION set_last_update() RETURNS trigger AS $$
+				BEGIN
+					NEW.last_update = clock_timestamp();
+					RETURN NEW;
+				END
+				$$ LANGUAGE plpgsql
+				"""
+			)
+
+			for (table, columns) in [('pool_worker', 'username, password, difficulty'),
+						('pool_worker_settings', 'pool_worker_id, custom_diff_enable')]:
+				self.execute("ALTER TABLE %s ADD COLUMN last_update TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP" % table)
+				self.execute("CREATE INDEX IF NOT EXISTS %s_last_update ON %s (last_update)" % (table, table))
+				self.execute(
+					"""
+					CREATE TRIGGER %s_updated
+					BEFORE UPDATE OF %s ON %s
+					FOR EACH ROW EXECUTE PROCEDURE set_last_update()
+					""" % (table, columns, table)
+				)
+
+			self.execute(
+				"""
+				UPDATE pool
+				SET value = '12'
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
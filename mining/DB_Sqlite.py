@@ -0,0 +1,1082 @@
+import time
+import hashlib
+import threading
+import sqlite3
+import RoundStats
+import lib.settings as settings
+import lib.logger
+log = lib.logger.get_logger('DB_Sqlite')
+
+class DB_Sqlite():
+	'''
+		SQLite storage driver, same method surface as DB_Mysql.
+
+		Meant for small single-node pools and for running the database
+		layer without a database server.  The file is opened in WAL mode so
+		readers do not block the writer, every import is a single
+		BEGIN IMMEDIATE ... COMMIT transaction and rows are written with
+		executemany() on cached (prepared) statements.
+	'''
+
+	# username -> pool_worker.id, shared by every connection (import threads open their own)
+	WORKER_IDS = {}
+	WORKER_IDS_LOCK = threading.Lock()
+
+	# Totals of the current round published by this process, shared by every connection
+	ROUND_STATS = RoundStats.RoundStats()
+
+	def __init__(self):
+		# DB Connection Handle
+		self.SQLITE_CONNECTION = None
+		# Shared Cursor
+		self.SQLITE_CURSOR = None
+
+		log.debug("SQLite Database Initialization")
+
+		required_settings = ['PASSWORD_SALT', 'DB_SQLITE_FILE']
+
+		for setting_name in required_settings:
+			if not hasattr(settings, setting_name):
+				raise ValueError("%s isn't set, please set in config.py" % setting_name)
+
+		self.salt = getattr(settings, 'PASSWORD_SALT')
+		self.database_extend = hasattr(settings, 'DATABASE_EXTEND') and getattr(settings, 'DATABASE_EXTEND') is True
+
+		self.connect()
+
+# -------------------------- BEGIN SQLite Operational Functions ---------------------------------------
+
+	def connect(self):
+		log.info("Opening SQLite database %s" % settings.DB_SQLITE_FILE)
+
+		# isolation_level None: no implicit transactions, imports use begin()/commit()
+		# Other connections of the pool may hold the write lock for a moment, wait for it instead of failing
+		self.SQLITE_CONNECTION = sqlite3.connect(settings.DB_SQLITE_FILE, timeout = 30,
+							isolation_level = None, cached_statements = 256)
+		self.SQLITE_CURSOR = self.SQLITE_CONNECTION.cursor()
+
+		self.SQLITE_CURSOR.execute("PRAGMA journal_mode = WAL")
+		# NORMAL is crash safe in WAL mode, only the last transactions may be lost on power failure
+		self.SQLITE_CURSOR.execute("PRAGMA synchronous = NORMAL")
+
+	def close(self):
+		log.info("Closing SQLite database.")
+		try:
+			self.SQLITE_CURSOR.close()
+			self.SQLITE_CONNECTION.close()
+			self.SQLITE_CONNECTION = None
+			self.SQLITE_CURSOR = None
+		except:
+			# It may fail
+			log.debug("DB Connection Already Closed.")
+
+	def execute(self, query, args = None):
+		log.debug("DB Query: %s" % query)
+		if not args == None:
+			log.debug("DB Values: %s" % (args,))
+			self.SQLITE_CURSOR.execute(query, args)
+		else:
+			self.SQLITE_CURSOR.execute(query)
+
+	def executemany(self, query, args):
+		log.debug("Execute Many Operation")
+		self.SQLITE_CURSOR.executemany(query, args)
+
+	def executefetch(self, query, args = None):
+		# Returns the rows as dicts, like MySQLdb's DictCursor
+		cursor = self.SQLITE_CONNECTION.cursor()
+		cursor.execute(query, args or ())
+		columns = [column[0] for column in cursor.description]
+		rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+		cursor.close()
+		return rows
+
+	def begin(self):
+		# Takes the write lock right away, a deferred transaction could fail to upgrade its lock later on
+		self.SQLITE_CURSOR.execute("BEGIN IMMEDIATE")
+
+	def commit(self):
+		self.SQLITE_CURSOR.execute("COMMIT")
+
+	def rollback(self):
+		try:
+			self.SQLITE_CURSOR.execute("ROLLBACK")
+		except sqlite3.Error:
+			log.debug("Rollback failed, no transaction active.")
+
+# -------------------------- END SQLite Operational Functions ---------------------------------------
+
+	def hash_pass(self, password):
+		m = hashlib.sha1()
+		m.update(password)
+		m.update(self.salt)
+
+		return m.hexdigest()
+
+	def preload_worker_ids(self):
+		# Fills the username -> id map with every known worker
+		log.info("Preloading worker ids")
+
+		self.execute(
+			"""
+			SELECT id, username
+			FROM pool_worker
+			ORDER BY id
+			"""
+		)
+
+		worker_ids = {}
+		for row in self.SQLITE_CURSOR.fetchall():
+			worker_ids.setdefault(row[1], row[0])
+
+		with DB_Sqlite.WORKER_IDS_LOCK:
+			DB_Sqlite.WORKER_IDS.clear()
+			DB_Sqlite.WORKER_IDS.update(worker_ids)
+
+		log.info("Loaded %i worker ids" % len(worker_ids))
+
+	def invalidate_worker_id(self, id_or_username = None):
+		# Drops a single worker (by id or username) from the username -> id map, or all of them
+		with DB_Sqlite.WORKER_IDS_LOCK:
+			if id_or_username is None:
+				DB_Sqlite.WORKER_IDS.clear()
+				return
+
+			id_or_username = str(id_or_username)
+			DB_Sqlite.WORKER_IDS.pop(id_or_username, None)
+
+			if id_or_username.isdigit():
+				for username, worker_id in DB_Sqlite.WORKER_IDS.items():
+					if worker_id == int(id_or_username):
+						del DB_Sqlite.WORKER_IDS[username]
+
+	def get_worker_id(self, username):
+		# Returns the pool_worker id of a username, or None if it does not exist
+		return self.get_worker_ids([username]).get(username)
+
+	def get_worker_ids(self, usernames):
+		# Resolves a list of usernames to their pool_worker id, unknown usernames are not included
+		worker_ids = {}
+		missing = []
+
+		for username in set(usernames):
+			worker_id = DB_Sqlite.WORKER_IDS.get(username)
+			if worker_id is None:
+				missing.append(username)
+			else:
+				worker_ids[username] = worker_id
+
+		# SQLite allows at most 999 host parameters per statement
+		chunk_size = min(settings.DB_LOADER_INSERT_CHUNK, 999)
+		for i in range(0, len(missing), chunk_size):
+			chunk = missing[i:i + chunk_size]
+			self.execute(
+				"""
+				SELECT id, username
+				FROM pool_worker
+				WHERE username IN (%s)
+				ORDER BY id
+				""" % ", ".join(["?"] * len(chunk)),
+				chunk
+			)
+
+			found = {}
+			for row in self.SQLITE_CURSOR.fetchall():
+				found.setdefault(row[1], row[0])
+
+			with DB_Sqlite.WORKER_IDS_LOCK:
+				DB_Sqlite.WORKER_IDS.update(found)
+
+			worker_ids.update(found)
+
+		return worker_ids
+
+	def import_block_candidate(self, data):
+		# Writes a block candidate share right away, returns its shares.id for found_block()
+		return self.import_shares([data], True)
+
+	def import_shares(self, data, keep_id = False, round_stats = True, round_height = None):
+		# Same data layout as DB_Mysql.import_shares
+		log.debug("Importing Shares")
+		checkin_times = {}
+		total_shares = 0
+		best_diff = 0
+
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		for username in set([v[0] for v in data]) - set(worker_ids.keys()):
+			log.warning("Worker '%s' not found, saving shares under worker id 0" % username)
+
+		rows = []
+		for v in data:
+			# Shares up to the height of the last found block are stored but left out of the round totals
+			if round_height is None or v[7] > round_height:
+				total_shares += v[3]
+				best_diff = max(best_diff, v[10])
+
+			checkin = checkin_times.setdefault(v[0], {"time": 0, "shares": 0, "rejects": 0})
+			checkin["time"] = max(checkin["time"], v[4])
+			if v[5] == True:
+				checkin["shares"] += v[3]
+			else:
+				checkin["rejects"] += v[3]
+
+			rows.append((v[4], v[6], worker_ids.get(v[0], 0), v[5], v[9], v[2], v[7], v[8], v[3]))
+
+		query = """
+			INSERT INTO shares
+			(time, rem_host, worker, our_result, upstream_result,
+			  reason, solution, block_num, prev_block_hash,
+			  useragent, difficulty)
+			VALUES
+			(datetime(?, 'unixepoch'), ?, ?, ?, 0, ?, ?, ?, ?, '', ?)
+			"""
+
+		self.begin()
+		try:
+			# lastrowid is only set by execute()
+			share_id = None
+			if keep_id:
+				self.execute(query, rows[0])
+				share_id = self.SQLITE_CURSOR.lastrowid
+			else:
+				self.executemany(query, rows)
+
+			# Without round_stats the caller publishes the round totals (see StatsAggregator)
+			if round_stats:
+				self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if round_stats:
+			DB_Sqlite.ROUND_STATS.add(total_shares, best_diff)
+		return share_id
+
+	def add_round_stats(self, total_shares, best_diff):
+		# Publishes round totals collected from several imports at once
+		self.begin()
+		try:
+			self.update_round_stats(total_shares, best_diff)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Sqlite.ROUND_STATS.add(total_shares, best_diff)
+
+	def update_round_stats(self, total_shares, best_diff):
+		# Adds total_shares (in difficulty) to the round and keeps the best share
+		self.execute(
+			"""
+			UPDATE pool
+			SET value = value + ?
+			WHERE parameter = 'round_shares'
+			""",
+			(total_shares,)
+		)
+
+		if best_diff > 0:
+			self.execute(
+				"""
+				UPDATE pool
+				SET value = max(value + 0, ?)
+				WHERE parameter = 'round_best_share'
+				""",
+				(best_diff,)
+			)
+
+		self.execute(
+			"""
+			UPDATE pool
+			SET value = (
+			  SELECT CASE WHEN difficulty.value + 0 = 0 THEN 0 ELSE (shares.value + 0) / (difficulty.value + 0) * 100 END
+			  FROM pool AS shares, pool AS difficulty
+			  WHERE shares.parameter = 'round_shares'
+			    AND difficulty.parameter = 'bitcoin_difficulty'
+			)
+			WHERE parameter = 'round_progress'
+			"""
+		)
+
+	def update_worker_checkins(self, checkin_times, worker_ids):
+		# checkin_times: username -> {"time": last share time, "shares": accepted difficulty, "rejects": rejected difficulty}
+		# Local writes are cheap, checkins are written with every batch (DB_CHECKIN_INTERVAL only applies to MySQL)
+		self.executemany(
+			"""
+			UPDATE pool_worker
+			SET last_checkin = datetime(?, 'unixepoch'),
+			  total_shares = total_shares + ?,
+			  total_rejects = total_rejects + ?
+			WHERE id = ?
+			""",
+			[(v["time"], v["shares"], v["rejects"], worker_ids[k]) for (k, v) in sorted(checkin_times.items()) if k in worker_ids]
+		)
+
+	def flush_worker_checkins(self):
+		# Nothing is held back, see update_worker_checkins()
+		pass
+
+	def found_block(self, data, share_id = None):
+		# share_id is the row written by import_block_candidate(), without it the share is looked up by time and worker
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			if share_id is not None:
+				self.execute(
+					"""
+					UPDATE shares
+					SET upstream_result = ?,
+					  solution = ?
+					WHERE id = ?
+					""",
+					(data[5], data[2], share_id)
+				)
+			else:
+				self.execute(
+					"""
+					UPDATE shares
+					SET upstream_result = ?,
+					  solution = ?
+					WHERE id = (
+					  SELECT id
+					  FROM shares
+					  WHERE time = datetime(?, 'unixepoch')
+					    AND worker = ?
+					  LIMIT 1
+					)
+					""",
+					(data[5], data[2], data[4], worker_id)
+				)
+
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Sqlite.ROUND_STATS.reset()
+
+	def get_block_share_id(self, data):
+		# Returns the shares.id of the stored block candidate 'data', or None while it is not stored
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		shares = self.executefetch(
+			"""
+			SELECT id
+			FROM shares
+			WHERE time = datetime(?, 'unixepoch')
+			  AND worker = ?
+			  AND solution = ?
+			LIMIT 1
+			""",
+			(data[4], worker_id, data[2])
+		)
+
+		return shares[0]['id'] if shares else None
+
+	def record_found_block(self, worker_id):
+		# Credits the worker with the block and starts a new round
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET total_found = total_found + 1
+			WHERE id = ?
+			""",
+			(worker_id,)
+		)
+
+		self.execute(
+			"""
+			UPDATE pool
+			SET value = value + 1
+			WHERE parameter = 'pool_total_found'
+			"""
+		)
+
+		self.executemany(
+			"""
+			UPDATE pool
+			SET value = ?
+			WHERE parameter = ?
+			""",
+			[
+				(0, 'round_shares'),
+				(0, 'round_progress'),
+				(0, 'round_best_share'),
+				(time.time(), 'round_start')
+			]
+		)
+
+	def import_rollups(self, data, round_height = None):
+		# Same data layout as DB_Mysql.import_rollups
+		log.debug("Importing Share Rollups")
+		checkin_times = {}
+		total_shares = 0
+		best_diff = 0
+
+		worker_ids = self.get_worker_ids([v[0] for v in data])
+
+		rows = []
+		for v in data:
+			if round_height is None or v[2] > round_height:
+				total_shares += v[4] + v[6]
+				best_diff = max(best_diff, v[7])
+
+			checkin = checkin_times.setdefault(v[0], {"time": 0, "shares": 0, "rejects": 0})
+			checkin["time"] = max(checkin["time"], v[8])
+			checkin["shares"] += v[4]
+			checkin["rejects"] += v[6]
+
+			rows.append((worker_ids.get(v[0], 0), v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8]))
+
+		self.begin()
+		try:
+			# Make sure every rollup row exists, then add to it
+			self.executemany(
+				"""
+				INSERT OR IGNORE INTO share_rollups
+				(worker, interval_start, block_num, last_share)
+				VALUES
+				(?, datetime(?, 'unixepoch'), ?, datetime(?, 'unixepoch'))
+				""",
+				[(row[0], row[1], row[2], row[8]) for row in rows]
+			)
+
+			self.executemany(
+				"""
+				UPDATE share_rollups
+				SET accepted_count = accepted_count + ?,
+				  accepted_diff = accepted_diff + ?,
+				  rejected_count = rejected_count + ?,
+				  rejected_diff = rejected_diff + ?,
+				  best_share = max(best_share, ?),
+				  last_share = max(last_share, datetime(?, 'unixepoch'))
+				WHERE worker = ?
+				  AND interval_start = datetime(?, 'unixepoch')
+				  AND block_num = ?
+				""",
+				[row[3:] + row[:3] for row in rows]
+			)
+
+			self.update_round_stats(total_shares, best_diff)
+			self.update_worker_checkins(checkin_times, worker_ids)
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		DB_Sqlite.ROUND_STATS.add(total_shares, best_diff)
+
+	def insert_block_share(self, data):
+		# Records a block candidate as its own share row, used when shares are not saved one by one
+		worker_id = self.get_worker_id(data[0])
+		if worker_id is None:
+			worker_id = 0
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				INSERT INTO shares
+				(time, rem_host, worker, our_result, upstream_result,
+				  reason, solution, block_num, prev_block_hash,
+				  useragent, difficulty)
+				VALUES
+				(datetime(?, 'unixepoch'), ?, ?, 1, ?, '', ?, ?, ?, '', ?)
+				""",
+				(data[4], data[6], worker_id, data[5], data[2], data[7], data[8], data[3])
+			)
+
+			if self.database_extend and data[5] == True:
+				self.record_found_block(worker_id)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		if self.database_extend and data[5] == True:
+			DB_Sqlite.ROUND_STATS.reset()
+
+	def get_archive_boundary(self, cutoff):
+		# Returns the id of the first share at or after 'cutoff', everything before it may be archived
+		# None when there is nothing to archive
+		self.execute(
+			"""
+			SELECT id
+			FROM shares
+			WHERE time >= datetime(?, 'unixepoch')
+			ORDER BY time, id
+			LIMIT 1
+			""",
+			(cutoff,)
+		)
+
+		data = self.SQLITE_CURSOR.fetchone()
+		if data is not None:
+			return data[0]
+
+		self.execute(
+			"""
+			SELECT MAX(id) + 1
+			FROM shares
+			"""
+		)
+
+		return self.SQLITE_CURSOR.fetchone()[0]
+
+	def get_archive_chunk(self, after_id, before_id, cutoff, limit):
+		# Next 'limit' shares to archive after 'after_id', columns as in ShareArchiver.COLUMNS
+		self.execute(
+			"""
+			SELECT shares.id, CAST(strftime('%s', shares.time) AS INTEGER), shares.rem_host, shares.worker,
+			  pool_worker.username, shares.our_result, shares.upstream_result, shares.reason,
+			  shares.solution, shares.block_num, shares.prev_block_hash, shares.useragent,
+			  shares.difficulty
+			FROM shares
+			LEFT JOIN pool_worker
+			  ON pool_worker.id = shares.worker
+			WHERE shares.id > ?
+			  AND shares.id < ?
+			  AND shares.time < datetime(?, 'unixepoch')
+			ORDER BY shares.id
+			LIMIT ?
+			""",
+			(after_id, before_id, cutoff, limit)
+		)
+
+		return self.SQLITE_CURSOR.fetchall()
+
+	def archive_shares(self, after_id, before_id, cutoff, limit):
+		# Moves the next 'limit' shares after 'after_id' to shares_archive (and found blocks to shares_archive_found)
+		# Returns (last id, number of shares), last id is None when there was nothing left
+		self.execute(
+			"""
+			SELECT MAX(id), COUNT(*)
+			FROM (
+			  SELECT id
+			  FROM shares
+			  WHERE id > ?
+			    AND id < ?
+			    AND time < datetime(?, 'unixepoch')
+			  ORDER BY id
+			  LIMIT ?
+			) AS chunk
+			""",
+			(after_id, before_id, cutoff, limit)
+		)
+
+		(last_id, count) = self.SQLITE_CURSOR.fetchone()
+		if last_id is None:
+			return (None, 0)
+
+		self.begin()
+		try:
+			for (table, condition) in [('shares_archive', ''), ('shares_archive_found', 'AND upstream_result = 1')]:
+				self.execute(
+					"""
+					INSERT OR IGNORE INTO %s
+					SELECT *
+					FROM shares
+					WHERE id > ?
+					  AND id <= ?
+					  AND time < datetime(?, 'unixepoch')
+					  %s
+					""" % (table, condition),
+					(after_id, last_id, cutoff)
+				)
+
+			self.execute(
+				"""
+				DELETE FROM shares
+				WHERE id > ?
+				  AND id <= ?
+				  AND time < datetime(?, 'unixepoch')
+				""",
+				(after_id, last_id, cutoff)
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		return (last_id, count)
+
+	def delete_shares(self, after_id, last_id, cutoff, limit):
+		# Deletes at most 'limit' archived shares, returns how many were deleted
+		self.execute(
+			"""
+			DELETE FROM shares
+			WHERE id IN (
+			  SELECT id
+			  FROM shares
+			  WHERE id > ?
+			    AND id <= ?
+			    AND time < datetime(?, 'unixepoch')
+			  ORDER BY id
+			  LIMIT ?
+			)
+			""",
+			(after_id, last_id, cutoff, limit)
+		)
+
+		return self.SQLITE_CURSOR.rowcount
+
+	def list_users(self):
+		for user in self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker
+			WHERE id > 0
+			"""
+		):
+			yield user
+
+	def get_user(self, id_or_username):
+		log.debug("Finding user with id or username of %s", id_or_username)
+
+		users = self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker
+			WHERE id = ?
+			  OR username = ?
+			""",
+			(id_or_username if id_or_username.isdigit() else -1, id_or_username)
+		)
+
+		return users[0] if users else None
+
+	def get_workers(self, since = None):
+		# Returns (server time, rows) of pool_worker joined with its settings, changed since 'since' or all of them
+		# The time is taken first and a bit early, rows of transactions still running are fetched again next time
+		self.execute("SELECT datetime('now', '-10 seconds')")
+		server_time = self.SQLITE_CURSOR.fetchone()[0]
+
+		query = """
+			SELECT w.id, w.username, w.password, w.difficulty, w.last_checkin,
+			  COALESCE(s.custom_diff_enable, 0) AS custom_diff_enable
+			FROM pool_worker w
+			LEFT JOIN pool_worker_settings s ON s.pool_worker_id = w.id
+			"""
+
+		if since is None:
+			workers = self.executefetch(query)
+		else:
+			workers = self.executefetch(query + "WHERE w.last_update >= ? UNION " + query + "WHERE s.last_update >= ?", (since, since))
+
+		return (server_time, workers)
+
+	def get_user_settings(self, worker_id):
+		log.debug("Finding configuration with worker_id of %s", worker_id)
+
+		user_settings = self.executefetch(
+			"""
+			SELECT *
+			FROM pool_worker_settings
+			WHERE pool_worker_id = ?
+			""",
+			(worker_id,)
+		)
+
+		return user_settings[0] if user_settings else None
+
+	def delete_user(self, id_or_username):
+		if id_or_username.isdigit() and id_or_username == '0':
+			raise Exception('You cannot delete that user')
+
+		log.debug("Deleting user with id or username of %s", id_or_username)
+
+		if id_or_username.isdigit():
+			worker_id = int(id_or_username)
+		else:
+			worker_id = self.get_worker_id(id_or_username)
+
+		self.begin()
+		try:
+			if worker_id is not None:
+				self.execute(
+					"""
+					UPDATE shares
+					SET worker = 0
+					WHERE worker = ?
+					""",
+					(worker_id,)
+				)
+
+			self.execute(
+				"""
+				DELETE FROM pool_worker
+				WHERE id = ?
+				  OR username = ?
+				""",
+				(id_or_username if id_or_username.isdigit() else -1, id_or_username)
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+		self.invalidate_worker_id(id_or_username)
+
+	def insert_user(self, username, password):
+		log.debug("Adding new user %s", username)
+
+		self.execute(
+			"""
+			INSERT INTO pool_worker
+			(username, password)
+			VALUES
+			(?, ?)
+			""",
+			(username, self.hash_pass(password))
+		)
+
+		self.invalidate_worker_id(username)
+
+		return str(username)
+
+	def update_user(self, id_or_username, password):
+		log.debug("Updating password for user %s", id_or_username);
+
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET password = ?
+			WHERE id = ?
+			  OR username = ?
+			""",
+			(self.hash_pass(password), id_or_username if id_or_username.isdigit() else -1, id_or_username)
+		)
+
+		self.invalidate_worker_id(id_or_username)
+
+	def update_worker_diff(self, username, diff):
+		log.debug("Setting difficulty for %s to %s", username, diff)
+
+		self.execute(
+			"""
+			UPDATE pool_worker
+			SET difficulty = ?
+			WHERE username = ?
+			""",
+			(diff, username)
+		)
+
+	def update_worker_diffs(self, diffs):
+		# diffs: username -> difficulty, written in one transaction
+		log.debug("Setting difficulty of %i worker(s)" % len(diffs))
+
+		self.begin()
+		try:
+			self.executemany(
+				"""
+				UPDATE pool_worker
+				SET difficulty = ?
+				WHERE username = ?
+				""",
+				[(diff, username) for (username, diff) in sorted(diffs.items())]
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+	def clear_worker_diff(self):
+		if self.database_extend:
+			log.debug("Resetting difficulty for all workers")
+
+			self.execute(
+				"""
+				UPDATE pool_worker
+				SET difficulty = 0
+				"""
+			)
+
+	def check_password(self, username, password):
+		log.debug("Checking username/password for %s", username)
+
+		self.execute(
+			"""
+			SELECT COUNT(*)
+			FROM pool_worker
+			WHERE username = ?
+			  AND password = ?
+			""",
+			(username, self.hash_pass(password))
+		)
+
+		data = self.SQLITE_CURSOR.fetchone()
+
+		if data[0] > 0:
+			return True
+
+		return False
+
+	def get_worker_diff(self, username):
+		# Defualt Value
+		worker_diff = settings.POOL_TARGET
+
+		self.execute("SELECT difficulty FROM pool_worker WHERE username = ?", (username,))
+		data = self.SQLITE_CURSOR.fetchone()
+
+		if data is not None and data[0] > 0:
+			worker_diff = data[0]
+
+		return worker_diff
+
+	def set_worker_diff(self, username, difficulty):
+		self.execute("UPDATE pool_worker SET difficulty = ? WHERE username = ?", (difficulty, username))
+
+	def check_tables(self):
+		log.debug("Checking Tables")
+
+		self.execute(
+			"""
+			SELECT COUNT(*)
+			FROM sqlite_master
+			WHERE type = 'table'
+			  AND name = 'shares'
+			"""
+		)
+
+		data = self.SQLITE_CURSOR.fetchone()
+
+		if data[0] <= 0:
+			self.update_version_1()		# no, we don't, so create them
+
+		self.update_tables()
+
+	def update_tables(self):
+		version = 0
+		current_version = 12
+
+		while version < current_version:
+			self.execute(
+				"""
+				SELECT value
+				FROM pool
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			data = self.SQLITE_CURSOR.fetchone()
+			version = int(data[0])
+
+			if version < current_version:
+				log.info("Updating Database from %i to %i" % (version, version +1))
+				getattr(self, 'update_version_' + str(version) )()
+
+	def update_version_1(self):
+		# A new SQLite database starts out with the layout MySQL has at version 10
+		log.info("Creating SQLite tables")
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool
+				(
+					parameter TEXT NOT NULL PRIMARY KEY,
+					value TEXT
+				)
+				"""
+			)
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool_worker
+				(
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					username TEXT NOT NULL UNIQUE,
+					password TEXT NOT NULL,
+					speed INTEGER NOT NULL DEFAULT 0,
+					last_checkin TIMESTAMP,
+					total_shares INTEGER NOT NULL DEFAULT 0,
+					total_rejects INTEGER NOT NULL DEFAULT 0,
+					total_found INTEGER NOT NULL DEFAULT 0,
+					alive INTEGER NOT NULL DEFAULT 0,
+					difficulty REAL NOT NULL DEFAULT 0
+				)
+				"""
+			)
+
+			self.execute("CREATE INDEX IF NOT EXISTS pool_worker_alive ON pool_worker(alive)")
+
+			for table in ['shares', 'shares_archive', 'shares_archive_found']:
+				self.execute(
+					"""
+					CREATE TABLE IF NOT EXISTS %s
+					(
+						id INTEGER PRIMARY KEY AUTOINCREMENT,
+						time TIMESTAMP,
+						rem_host TEXT,
+						worker INTEGER NOT NULL DEFAULT 0,
+						our_result INTEGER,
+						upstream_result INTEGER,
+						reason TEXT,
+						solution TEXT,
+						block_num INTEGER,
+						prev_block_hash TEXT,
+						useragent TEXT,
+						difficulty REAL
+					)
+					""" % table
+				)
+
+			self.execute("CREATE INDEX IF NOT EXISTS shares_time_worker ON shares(time, worker)")
+			self.execute("CREATE INDEX IF NOT EXISTS shares_worker ON shares(worker)")
+			self.execute("CREATE INDEX IF NOT EXISTS shares_upstreamresult ON shares(upstream_result)")
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS payments
+				(
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					solution TEXT NOT NULL UNIQUE,
+					pstatus TEXT NOT NULL DEFAULT 'pending',
+					txid TEXT,
+					amount INTEGER NOT NULL DEFAULT 0,
+					last_update TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+				)
+				"""
+			)
+
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS pool_worker_settings
+				(
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					pool_worker_id INTEGER NOT NULL DEFAULT 0 UNIQUE,
+					custom_diff_enable INTEGER NOT NULL DEFAULT 0
+				)
+				"""
+			)
+
+			# Placeholder worker for shares of unknown workers
+			self.execute(
+				"""
+				INSERT OR IGNORE INTO pool_worker
+				(id, username, password)
+				VALUES
+				(0, ?, ?)
+				""",
+				(hashlib.sha1(str(time.time())).hexdigest(), hashlib.sha1(self.salt + str(time.time())).hexdigest())
+			)
+
+			self.executemany(
+				"""
+				INSERT OR IGNORE INTO pool (parameter, value) VALUES (?, ?)
+				""",
+				[
+					('DB Version', 10),
+					('bitcoin_blocks', 0),
+					('bitcoin_balance', 0),
+					('bitcoin_connections', 0),
+					('bitcoin_difficulty', 0),
+					('bitcoin_infotime', 0),
+					('pool_speed', 0),
+					('pool_total_found', 0),
+					('round_shares', 0),
+					('round_progress', 0),
+					('round_best_share', 0),
+					('round_start', time.time())
+				]
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+	def update_version_10(self):
+		# Add the share_rollups table used by the aggregated share accounting mode
+		log.info("running update 10")
+
+		self.begin()
+		try:
+			self.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS share_rollups
+				(
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					worker INTEGER NOT NULL DEFAULT 0,
+					interval_start TIMESTAMP NOT NULL,
+					block_num INTEGER NOT NULL DEFAULT 0,
+					accepted_count INTEGER NOT NULL DEFAULT 0,
+					accepted_diff REAL NOT NULL DEFAULT 0,
+					rejected_count INTEGER NOT NULL DEFAULT 0,
+					rejected_diff REAL NOT NULL DEFAULT 0,
+					best_share REAL NOT NULL DEFAULT 0,
+					last_share TIMESTAMP NOT NULL,
+					UNIQUE (worker, interval_start, block_num)
+				)
+				"""
+			)
+
+			self.execute("CREATE INDEX IF NOT EXISTS share_rollups_interval_start ON share_rollups(interval_start)")
+
+			self.execute(
+				"""
+				UPDATE pool
+				SET value = 11
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
+
+	def update_version_11(self):
+		# last_update columns for the incremental worker sync (get_workers())
+		# Columns added by ALTER TABLE can't default to CURRENT_TIMESTAMP, triggers set it instead.
+		# Checkins don't touch it, only inserts and changes of the columns held by the worker sync do.
+		log.info("running update 11")
+
+		self.begin()
+		try:
+			for (table, columns) in [('pool_worker', 'username, password, difficulty'),
+						('pool_worker_settings', 'pool_worker_id, custom_diff_enable')]:
+				self.execute("ALTER TABLE %s ADD COLUMN last_update TIMESTAMP NOT NULL DEFAULT '1970-01-01 00:00:00'" % table)
+				self.execute("CREATE INDEX IF NOT EXISTS %s_last_update ON %s(last_update)" % (table, table))
+
+				for (name, event) in [('inserted', 'INSERT'), ('updated', 'UPDATE OF ' + columns)]:
+					self.execute(
+						"""
+						CREATE TRIGGER IF NOT EXISTS %s_%s
+						AFTER %s ON %s
+						BEGIN
+							UPDATE %s SET last_update = CURRENT_TIMESTAMP WHERE id = NEW.id;
+						END
+						""" % (table, name, event, table, table)
+					)
+
+			self.execute(
+				"""
+				UPDATE pool
+				SET value = 12
+				WHERE parameter = 'DB Version'
+				"""
+			)
+
+			self.commit()
+		except:
+			self.rollback()
+			raise
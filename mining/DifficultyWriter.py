@@ -0,0 +1,99 @@
+from twisted.internet import reactor, defer
+
+import lib.logger
+log = lib.logger.get_logger('DifficultyWriter')
+
+class DifficultyWriter(object):
+	'''
+		Write-behind of worker difficulties.
+
+		Vardiff changes the difficulty of every worker again and again,
+		only the latest one per worker is kept here and handed to the
+		writer (see update_worker_diffs() of the drivers) every 'interval'
+		seconds as one bulk update.
+	'''
+
+	def __init__(self, writer, interval):
+		self.writer = writer
+		self.interval = interval
+
+		# username -> difficulty not written yet
+		self.pending = {}
+		# username -> difficulty being written, still looked up by get() until the write is over
+		self.inflight = {}
+
+		self.writing = False
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+		# Metrics
+		self.changes = 0
+		self.writes = 0
+		self.rows = 0
+		self.failures = 0
+
+	def add(self, username, difficulty):
+		self.pending[username] = difficulty
+		self.changes += 1
+
+	def get(self, username, default = None):
+		if username in self.pending:
+			return self.pending[username]
+		return self.inflight.get(username, default)
+
+	def take(self):
+		diffs = self.pending
+		self.pending = {}
+		return diffs
+
+	def flush(self):
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+		# One write at a time
+		if self.writing or not self.pending:
+			return
+
+		self.writing = True
+		diffs = self.inflight = self.take()
+		d = defer.maybeDeferred(self.writer, diffs)
+		d.addCallbacks(self.written, self.failed, callbackArgs=(diffs,), errbackArgs=(diffs,))
+
+	def written(self, result, diffs):
+		self.writing = False
+		self.inflight = {}
+		self.writes += 1
+		self.rows += len(diffs)
+
+	def failed(self, failure, diffs):
+		self.writing = False
+		self.failures += 1
+		log.error("Writing %i worker difficulties failed, will retry with the next flush.  Error: %s" % (len(diffs), failure.getErrorMessage()))
+		self.restore(diffs)
+		self.inflight = {}
+
+	def restore(self, diffs):
+		# Difficulties changed since they were taken are newer
+		for (username, difficulty) in diffs.items():
+			self.pending.setdefault(username, difficulty)
+
+	def drain(self, writer):
+		# Synchronously writes the pending difficulties using 'writer', with a write still in flight as it may never finish
+		if not self.pending and not self.inflight:
+			return
+
+		diffs = dict(self.inflight)
+		diffs.update(self.take())
+		try:
+			writer(diffs)
+		except:
+			self.restore(diffs)
+			raise
+
+	def stats(self):
+		return {
+			'pending': len(self.pending),
+			'inflight': len(self.inflight),
+			'changes': self.changes,
+			'writes': self.writes,
+			'rows': self.rows,
+			'failures': self.failures
+		}
@@ -0,0 +1,93 @@
+import threading
+import re
+
+# Upper bounds of the latency buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Verb and first table of a statement: UPDATE x, INSERT INTO x, LOAD DATA ... INTO TABLE x, DELETE/SELECT ... FROM x
+KIND_RE = re.compile(r'(?:\bUPDATE|\bINTO(?:\s+TABLE)?|\bFROM|\bTABLE)\s+`?([\w.]+)', re.IGNORECASE)
+
+class QueryStats(object):
+	'''
+		Latency histograms and counters per kind of statement, shared by
+		every connection of a driver.
+
+		The kind is the verb and first table of the statement, e.g.
+		"INSERT shares" or "UPDATE pool_worker", so the imports can be
+		broken down into their shares, round stats and checkin parts.
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			# kind -> [count, errors, rows, total seconds, max seconds, bucket counts]
+			self.kinds = {}
+			self.connects = 0
+			self.connect_failures = 0
+			self.connections_lost = 0
+			self.slow_queries = 0
+
+	def kind(self, query):
+		words = query[:40].split(None, 1)
+		verb = words[0].upper() if words else ''
+		match = KIND_RE.search(query, 0, 500)
+		return "%s %s" % (verb, match.group(1)) if match is not None else verb
+
+	def record(self, query, seconds, rows, failed = False, slow = False):
+		kind = self.kind(query)
+		ms = seconds * 1000
+		bucket = 0
+		while bucket < len(BUCKETS) and ms > BUCKETS[bucket]:
+			bucket += 1
+
+		with self.lock:
+			stats = self.kinds.get(kind)
+			if stats is None:
+				stats = self.kinds[kind] = [0, 0, 0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)]
+
+			stats[0] += 1
+			if failed:
+				stats[1] += 1
+			stats[2] += max(rows, 0)
+			stats[3] += seconds
+			stats[4] = max(stats[4], seconds)
+			stats[5][bucket] += 1
+
+			if slow:
+				self.slow_queries += 1
+
+	def connected(self, failed = False):
+		with self.lock:
+			if failed:
+				self.connect_failures += 1
+			else:
+				self.connects += 1
+
+	def connection_lost(self):
+		with self.lock:
+			self.connections_lost += 1
+
+	def stats(self):
+		with self.lock:
+			statements = {}
+			for (kind, (count, errors, rows, total, slowest, buckets)) in self.kinds.items():
+				statements[kind] = {
+					'count': count,
+					'errors': errors,
+					'rows': rows,
+					'avg_ms': total * 1000 / count,
+					'max_ms': slowest * 1000,
+					# Statements taking up to N ms, 'inf' for the slower ones
+					'histogram': dict(zip([str(b) for b in BUCKETS] + ['inf'], buckets))
+				}
+
+			return {
+				'statements': statements,
+				'connects': self.connects,
+				'connect_failures': self.connect_failures,
+				'connections_lost': self.connections_lost,
+				'slow_queries': self.slow_queries
+			}
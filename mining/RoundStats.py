@@ -0,0 +1,38 @@
+import threading
+import time
+
+class RoundStats(object):
+	'''
+		Running totals of the current round, shared by every database
+		connection (import threads each have their own).
+
+		Batches only publish their own delta (added shares, best share) to
+		the pool table, these totals are what has been published since the
+		round started and are reset when a block is found.
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.round_start = time.time()
+			self.round_shares = 0
+			self.round_best_share = 0
+			self.batches = 0
+
+	def add(self, total_shares, best_diff):
+		with self.lock:
+			self.round_shares += total_shares
+			self.round_best_share = max(self.round_best_share, best_diff)
+			self.batches += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				'round_start': self.round_start,
+				'round_shares': self.round_shares,
+				'round_best_share': self.round_best_share,
+				'batches': self.batches
+			}
@@ -0,0 +1,174 @@
+from twisted.internet import reactor
+import time
+import os
+import csv
+import gzip
+import bz2
+
+import lib.settings as settings
+import lib.logger
+log = lib.logger.get_logger('ShareArchiver')
+
+class ShareArchiver(object):
+	'''
+		Moves shares older than ARCHIVE_DELAY out of the shares table.
+
+		Runs every ARCHIVE_INTERVAL seconds on a pooled connection.  Shares
+		are walked in id order (keyset pagination, ARCHIVE_CHUNK rows at a
+		time) up to the first share newer than ARCHIVE_DELAY.
+
+		ARCHIVE_MODE 'db' moves every chunk into shares_archive (found blocks
+		also into shares_archive_found) in one transaction.  ARCHIVE_MODE
+		'file' writes the shares to CSV files (optionally gzip or bzip2
+		compressed), a new file every ARCHIVE_FILE_ROWS shares; the shares
+		of a file are deleted, ARCHIVE_CHUNK rows at a time, once the file
+		is closed and synced.
+	'''
+
+	COLUMNS = ['id', 'time', 'rem_host', 'worker', 'username', 'our_result', 'upstream_result',
+		'reason', 'solution', 'block_num', 'prev_block_hash', 'useragent', 'difficulty']
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.running = False
+		self.clock = reactor.callLater(settings.ARCHIVE_INTERVAL, self.run)
+
+		# Totals since startup
+		self.archived = 0
+		self.runs = 0
+
+	def run(self):
+		self.clock = reactor.callLater(settings.ARCHIVE_INTERVAL, self.run)
+
+		# A run can take longer than the interval
+		if self.running:
+			return
+
+		self.running = True
+		d = self.pool.runInteraction(self.archive, time.time() - settings.ARCHIVE_DELAY)
+		d.addCallbacks(self.done, self.failed)
+
+	def done(self, archived):
+		self.running = False
+		self.runs += 1
+		self.archived += archived
+		log.info("Archived %i share(s)" % archived)
+
+	def failed(self, failure):
+		self.running = False
+		log.error("Archiving shares failed: %s" % failure.getErrorMessage())
+
+	def archive(self, database, cutoff):
+		# Runs in a pool thread, returns the number of archived shares
+		before_id = database.get_archive_boundary(cutoff)
+		if before_id is None:
+			return 0
+
+		if settings.ARCHIVE_MODE == 'db':
+			return self.archive_db(database, cutoff, before_id)
+
+		return self.archive_file(database, cutoff, before_id)
+
+	def archive_db(self, database, cutoff, before_id):
+		archived = 0
+		after_id = 0
+		while True:
+			(last_id, count) = database.archive_shares(after_id, before_id, cutoff, settings.ARCHIVE_CHUNK)
+			if last_id is None:
+				break
+
+			archived += count
+			after_id = last_id
+
+		return archived
+
+	def archive_file(self, database, cutoff, before_id):
+		archived = 0
+		after_id = 0
+		while True:
+			# One file per ARCHIVE_FILE_ROWS shares, its shares are deleted once it is on disk
+			(first_id, last_id, count) = self.write_file(database, after_id, before_id, cutoff)
+			if last_id is None:
+				break
+
+			while database.delete_shares(first_id, last_id, cutoff, settings.ARCHIVE_CHUNK) > 0:
+				pass
+
+			archived += count
+			after_id = last_id
+
+		return archived
+
+	def open_file(self):
+		compress = settings.ARCHIVE_FILE_COMPRESS
+		extension = {'gzip': '.gz', 'bzip2': '.bz2'}.get(compress, '')
+
+		path = settings.ARCHIVE_FILE
+		# bzip2 files can't be appended to
+		if settings.ARCHIVE_FILE_APPEND_TIME or compress == 'bzip2':
+			path += time.strftime("-%Y%m%d-%H%M%S")
+			# The same name may come up twice within a second
+			base = path
+			suffix = 0
+			while os.path.exists(path + '.csv' + extension):
+				suffix += 1
+				path = "%s-%i" % (base, suffix)
+		path += '.csv' + extension
+
+		if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+		new = not os.path.exists(path) or os.path.getsize(path) == 0
+
+		if compress == 'gzip':
+			f = gzip.open(path, 'ab')
+		elif compress == 'bzip2':
+			f = bz2.BZ2File(path, 'wb')
+		else:
+			f = open(path, 'ab')
+
+		log.info("Archiving shares to %s" % path)
+		return (path, f, new)
+
+	def write_file(self, database, after_id, before_id, cutoff):
+		# Writes up to ARCHIVE_FILE_ROWS shares, returns (first id, last id, count)
+		first_id = after_id
+		last_id = None
+		count = 0
+
+		(path, f) = (None, None)
+		try:
+			while count < settings.ARCHIVE_FILE_ROWS:
+				rows = database.get_archive_chunk(after_id, before_id, cutoff, min(settings.ARCHIVE_CHUNK, settings.ARCHIVE_FILE_ROWS - count))
+				if not rows:
+					break
+
+				if f is None:
+					(path, f, new) = self.open_file()
+					writer = csv.writer(f, lineterminator = '\n')
+					if new:
+						writer.writerow(self.COLUMNS)
+
+				writer.writerows([[value.encode('utf-8') if isinstance(value, unicode) else value for value in row] for row in rows])
+				count += len(rows)
+				after_id = last_id = rows[-1][0]
+		finally:
+			if f is not None:
+				f.close()
+
+		# Nothing is deleted before the file is on disk
+		if path is not None:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+
+		return (first_id, last_id, count)
+
+	def stats(self):
+		return {
+			'running': self.running,
+			'runs': self.runs,
+			'archived': self.archived
+		}
@@ -0,0 +1,298 @@
+from twisted.internet import reactor, defer
+import collections
+import time
+import zlib
+
+import lib.logger
+log = lib.logger.get_logger('ShareBatcher')
+
+def worker_partition(worker_name, partitions):
+	# Partition of the shares of 'worker_name', the same for every run with the same number of partitions
+	if isinstance(worker_name, unicode):
+		worker_name = worker_name.encode('utf-8')
+	return (zlib.crc32(worker_name) & 0xffffffff) % partitions
+
+class MemoryBuffer(object):
+	'''
+		Plain in-memory share buffer.
+
+		Items are taken in bulk by slicing the list, no per-item locking
+		is needed because everything runs on the reactor thread.
+	'''
+
+	def __init__(self):
+		self.items = []
+
+	def put(self, item):
+		self.items.append(item)
+
+	def take(self, count):
+		# Returns a (token, batch) tuple, the token is handed back to ack() once the batch is stored
+		batch = self.items[:count]
+		del self.items[:count]
+		return (None, batch)
+
+	def ack(self, token):
+		pass
+
+	def depth(self):
+		return len(self.items)
+
+	def close(self):
+		pass
+
+class ShareBatcher(object):
+	'''
+		Collects shares and hands them to a writer in batches.
+
+		A batch is flushed as soon as 'batch_size' shares are waiting or the
+		oldest waiting share is 'max_age' seconds old, whichever comes first.
+		The writer is called with a list of shares and may return a Deferred.
+		Batches that fail are retried first, after 'retry_time' seconds.
+		With a 'controller' (see BatchController) the batch size and number
+		of writers are adjusted after every stored batch.
+	'''
+
+	def __init__(self, writer, batch_size, max_age, max_writers = 1, retry_time = 5, buffer = None, controller = None):
+		self.writer = writer
+		self.batch_size = batch_size
+		self.max_age = max_age
+		self.max_writers = max(max_writers, 1)
+		self.retry_time = retry_time
+		self.buffer = buffer if buffer is not None else MemoryBuffer()
+
+		self.controller = controller
+		if self.controller is not None:
+			(self.batch_size, self.max_writers) = (self.controller.batch_size, self.controller.writers)
+
+		# Batches that failed, as (token, batch) tuples
+		self.retry = []
+		self.retry_after = 0
+
+		# Time the oldest waiting share was added
+		self.oldest = None
+		# [time, count] of the waiting shares, one entry per second of arrivals, oldest first
+		self.arrivals = collections.deque()
+		self.writers = 0
+		self.clock = None
+
+		# Metrics
+		self.flushes = 0
+		self.failures = 0
+		self.shares_written = 0
+		self.last_batch_size = 0
+		self.last_flush_latency = 0
+		self.total_flush_latency = 0
+
+		# Shares left over from the last run (spooled) are written right away
+		if self.buffer.depth() > 0:
+			self.arrivals.append([time.time() - self.max_age, self.buffer.depth()])
+			self.oldest = self.arrivals[0][0]
+			self.schedule()
+
+	def add(self, item):
+		self.buffer.put(item)
+		if self.controller is not None:
+			self.controller.arrived()
+
+		now = time.time()
+		if self.arrivals and now - self.arrivals[-1][0] < 1:
+			self.arrivals[-1][1] += 1
+		else:
+			self.arrivals.append([now, 1])
+		self.oldest = self.arrivals[0][0]
+
+		if self.buffer.depth() >= self.batch_size:
+			self.flush()
+		elif self.clock is None or not self.clock.active():
+			self.schedule()
+
+	def depth(self):
+		# Number of shares not yet stored
+		return self.buffer.depth() + sum([len(batch) for (token, batch) in self.retry])
+
+	def flush(self, force = False):
+		# Hands batches to the writer while a writer is available
+		while self.writers < self.max_writers:
+			if time.time() < self.retry_after:
+				break
+
+			if self.retry:
+				(token, batch) = self.retry.pop(0)
+			else:
+				depth = self.buffer.depth()
+				if depth == 0:
+					break
+
+				# Extra writers are only started for full batches
+				if depth < self.batch_size and (self.writers > 0 or not (force or self.expired())):
+					break
+
+				(token, batch) = self.buffer.take(self.batch_size)
+				self.taken(len(batch))
+
+				# The buffer had nothing readable left after all (see ShareSpool.take())
+				if not batch:
+					self.buffer.ack(token)
+					break
+
+			self.write(token, batch)
+
+		self.schedule()
+
+	def taken(self, count):
+		# The next waiting share is the oldest now
+		while count > 0 and self.arrivals:
+			if self.arrivals[0][1] > count:
+				self.arrivals[0][1] -= count
+				break
+			count -= self.arrivals.popleft()[1]
+
+		if self.buffer.depth() == 0:
+			self.arrivals.clear()
+		self.oldest = self.arrivals[0][0] if self.arrivals else None
+
+	def expired(self):
+		return self.oldest is not None and time.time() - self.oldest >= self.max_age
+
+	def schedule(self):
+		# (Re)arms the timer for the next deadline, either the retry time or the age of the oldest share
+		if self.clock is not None and self.clock.active():
+			self.clock.cancel()
+		self.clock = None
+
+		# Partial batches wait for the writers to finish, written() and failed() flush again
+		if self.retry and self.writers < self.max_writers:
+			when = self.retry_after
+		elif self.oldest is not None and self.writers == 0:
+			when = self.oldest + self.max_age
+		else:
+			return
+
+		self.clock = reactor.callLater(max(when - time.time(), 0), self.flush)
+
+	def write(self, token, batch):
+		self.writers += 1
+		start_time = time.time()
+		log.debug("Flushing %i share(s), %i share(s) remain queued" % (len(batch), self.depth()))
+
+		d = defer.maybeDeferred(self.writer, batch)
+		d.addCallbacks(self.written, self.failed, callbackArgs=(token, batch, start_time), errbackArgs=(token, batch, start_time))
+
+	def written(self, result, token, batch, start_time):
+		self.writers -= 1
+		self.buffer.ack(token)
+
+		latency = max(time.time() - start_time, 0)
+		self.flushes += 1
+		self.shares_written += len(batch)
+		self.last_batch_size = len(batch)
+		self.last_flush_latency = latency
+		self.total_flush_latency += latency
+		log.info("Stored %i share(s) in %.03f seconds, %i share(s) queued" % (len(batch), latency, self.depth()))
+
+		if self.controller is not None:
+			self.controller.record(len(batch), latency)
+			(self.batch_size, self.max_writers) = self.controller.decide(0 if self.oldest is None else time.time() - self.oldest)
+
+		# Keep going if there is a backlog
+		self.flush()
+
+	def failed(self, failure, token, batch, start_time):
+		self.writers -= 1
+		self.failures += 1
+		log.error("Storing %i share(s) failed, retrying in %i seconds.  Error: %s" % (len(batch), self.retry_time, failure.getErrorMessage()))
+
+		# Failed batches go back to the front of the line
+		self.retry.insert(0, (token, batch))
+		self.retry_after = time.time() + self.retry_time
+		self.schedule()
+
+	def drain(self, writer):
+		# Synchronously stores everything still waiting using 'writer'
+		while self.retry or self.buffer.depth() > 0:
+			if self.retry:
+				(token, batch) = self.retry.pop(0)
+			else:
+				(token, batch) = self.buffer.take(self.batch_size)
+				if not batch:
+					self.buffer.ack(token)
+					break
+
+			try:
+				writer(batch)
+			except:
+				self.retry.insert(0, (token, batch))
+				raise
+
+			self.buffer.ack(token)
+
+		self.arrivals.clear()
+		self.oldest = None
+
+	def close(self):
+		if self.clock is not None and self.clock.active():
+			self.clock.cancel()
+		self.buffer.close()
+
+	def stats(self):
+		stats = {
+			'queue_depth': self.depth(),
+			'oldest_age': 0 if self.oldest is None else time.time() - self.oldest,
+			'writers': self.writers,
+			'flushes': self.flushes,
+			'failures': self.failures,
+			'shares_written': self.shares_written,
+			'last_batch_size': self.last_batch_size,
+			'last_flush_latency': self.last_flush_latency,
+			'avg_flush_latency': 0 if self.flushes == 0 else self.total_flush_latency / self.flushes
+		}
+
+		if self.controller is not None:
+			stats['controller'] = self.controller.stats()
+
+		return stats
+
+class PartitionedBatcher(object):
+	'''
+		Spreads shares over several ShareBatchers by a hash of the worker
+		name, each with its own writer and at most one batch in flight.
+
+		All shares of a worker go to the same partition, so imports running
+		side by side never update the same worker rows.  Same interface as
+		ShareBatcher.
+	'''
+
+	def __init__(self, batchers):
+		self.batchers = batchers
+
+	def partition(self, worker_name):
+		return worker_partition(worker_name, len(self.batchers))
+
+	def add(self, item):
+		self.batchers[self.partition(item[0])].add(item)
+
+	def depth(self):
+		return sum([batcher.depth() for batcher in self.batchers])
+
+	def drain(self, writer):
+		for batcher in self.batchers:
+			batcher.drain(writer)
+
+	def close(self):
+		for batcher in self.batchers:
+			batcher.close()
+
+	def stats(self):
+		partitions = [batcher.stats() for batcher in self.batchers]
+		stats = {
+			'queue_depth': sum([p['queue_depth'] for p in partitions]),
+			'oldest_age': max([p['oldest_age'] for p in partitions]),
+			'writers': sum([p['writers'] for p in partitions]),
+			'flushes': sum([p['flushes'] for p in partitions]),
+			'failures': sum([p['failures'] for p in partitions]),
+			'shares_written': sum([p['shares_written'] for p in partitions]),
+			'partitions': partitions
+		}
+
+		return stats
@@ -0,0 +1,91 @@
+from twisted.internet import reactor, defer
+import time
+
+import lib.logger
+log = lib.logger.get_logger('ShareRollup')
+
+class ShareRollup(object):
+	'''
+		Aggregated share accounting, used instead of one database row per share.
+
+		Shares are folded into per-worker, per-interval, per-block-height
+		rollups holding the count and total difficulty of accepted and
+		rejected shares, the best share and the time of the last share.
+		Every 'interval' seconds the rollups are handed to the writer as a
+		list of rows (see DB_Mysql.import_rollups for the layout).
+	'''
+
+	def __init__(self, writer, interval):
+		self.writer = writer
+		self.interval = interval
+
+		# (worker_name, interval_start, block_height) -> [accepted_count, accepted_diff, rejected_count, rejected_diff, best_share, last_share]
+		self.rollups = {}
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+	def add(self, data):
+		# Same layout as the shares handed to DBInterface.queue_share
+		interval_start = int(data[4] // self.interval) * self.interval
+		key = (data[0], interval_start, data[7])
+
+		rollup = self.rollups.get(key)
+		if rollup is None:
+			rollup = self.rollups[key] = [0, 0, 0, 0, 0, 0]
+
+		if data[5] == True:
+			rollup[0] += 1
+			rollup[1] += data[3]
+		else:
+			rollup[2] += 1
+			rollup[3] += data[3]
+
+		rollup[4] = max(rollup[4], data[10])
+		rollup[5] = max(rollup[5], data[4])
+
+	def merge(self, rows):
+		# Puts rows that could not be stored back, they will be part of the next flush
+		for row in rows:
+			rollup = self.rollups.get((row[0], row[1], row[2]))
+			if rollup is None:
+				self.rollups[(row[0], row[1], row[2])] = list(row[3:])
+			else:
+				rollup[0] += row[3]
+				rollup[1] += row[4]
+				rollup[2] += row[5]
+				rollup[3] += row[6]
+				rollup[4] = max(rollup[4], row[7])
+				rollup[5] = max(rollup[5], row[8])
+
+	def take(self):
+		(rollups, self.rollups) = (self.rollups, {})
+		return [key + tuple(rollup) for (key, rollup) in rollups.items()]
+
+	def flush(self):
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+		rows = self.take()
+		if not rows:
+			return
+
+		start_time = time.time()
+		d = defer.maybeDeferred(self.writer, rows)
+		d.addCallbacks(self.written, self.failed, callbackArgs=(rows, start_time), errbackArgs=(rows,))
+
+	def written(self, result, rows, start_time):
+		log.info("Stored %i share rollup(s) in %.03f seconds" % (len(rows), time.time() - start_time))
+
+	def failed(self, failure, rows):
+		log.error("Storing %i share rollup(s) failed, will retry with the next flush.  Error: %s" % (len(rows), failure.getErrorMessage()))
+		self.merge(rows)
+
+	def drain(self, writer):
+		# Synchronously stores the current rollups using 'writer'
+		rows = self.take()
+		if not rows:
+			return
+
+		try:
+			writer(rows)
+		except:
+			self.merge(rows)
+			raise
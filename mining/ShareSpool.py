@@ -0,0 +1,318 @@
+from twisted.internet import reactor, threads
+import threading
+import io
+import os
+import json
+
+import lib.logger
+log = lib.logger.get_logger('ShareSpool')
+
+class ShareSpool(object):
+	'''
+		Append-only on-disk share buffer, used by ShareBatcher in place of
+		the in-memory buffer.
+
+		Shares are written as numbered records ("<seq>\\t<json>\\n") to
+		segment files named after their first record.  Records are fsync'ed
+		in batches, read back sequentially by take() and the number of the
+		last acknowledged record is kept in the 'ack' file.  Segments that
+		only hold acknowledged records are removed.  On startup everything
+		after the acknowledged record is replayed.
+
+		The reactor thread only appends, the fsyncs and the 'ack' file are
+		written together in a thread every 'fsync_time' seconds (or after
+		'fsync_records' records).  An acknowledgement lost in a crash
+		replays shares that were already written, never loses any.
+	'''
+
+	def __init__(self, path, segment_records, fsync_records, fsync_time):
+		self.path = path
+		self.segment_records = segment_records
+		self.fsync_records = fsync_records
+		self.fsync_time = fsync_time
+
+		# Sequence numbers: last written, last handed out, last acknowledged, last acknowledged in the 'ack' file
+		self.write_seq = 0
+		self.read_seq = 0
+		self.commit_seq = 0
+		self.stored_seq = 0
+
+		# Batches handed out but not yet acknowledged, token -> first sequence number
+		self.outstanding = {}
+
+		# Segment first sequence numbers, oldest first
+		self.segments = []
+
+		# Active segment we append to
+		self.writer = None
+		self.writer_records = 0
+		self.unsynced = 0
+		self.clock = None
+
+		# Duplicated descriptors of finished segments not fsync'ed yet
+		self.unsynced_fds = []
+		# One sync thread at a time, 'resync' when more was written meanwhile
+		self.syncing = False
+		self.resync = False
+		# The sync thread and sync() on close may write the 'ack' file at the same time
+		self.ack_lock = threading.Lock()
+
+		# Segment we read from
+		self.reader = None
+		self.reader_segment = None
+
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+
+		self.replay()
+
+	def segment_path(self, first_seq):
+		return os.path.join(self.path, "%020d.spool" % first_seq)
+
+	def ack_path(self):
+		return os.path.join(self.path, "ack")
+
+	def replay(self):
+		# Picks up where the last run left off
+		try:
+			with open(self.ack_path(), 'rb') as f:
+				self.commit_seq = int(f.read().strip() or 0)
+		except IOError:
+			self.commit_seq = 0
+		self.stored_seq = self.commit_seq
+
+		self.read_seq = self.commit_seq
+		self.write_seq = self.commit_seq
+
+		self.segments = sorted([int(name.split('.')[0]) for name in os.listdir(self.path) if name.endswith('.spool')])
+
+		# The last record of the newest segment tells us where to continue numbering
+		if self.segments:
+			self.write_seq = max(self.write_seq, self.segments[-1] - 1)
+			with io.open(self.segment_path(self.segments[-1]), 'rb') as f:
+				for line in f:
+					if line.endswith('\n'):
+						self.write_seq = max(self.write_seq, int(line.split('\t', 1)[0]))
+
+		self.purge()
+
+		# Skip the records that were already acknowledged
+		self.open_reader()
+		if self.reader is not None:
+			self.read_seq = min(self.read_seq, self.reader_segment - 1)
+		while self.reader is not None and self.read_seq < self.commit_seq:
+			if self.read_record() is None:
+				break
+
+		if self.depth() > 0:
+			log.warning("Replaying %i spooled share(s) from %s" % (self.depth(), self.path))
+
+	def put(self, item):
+		if self.writer is None or self.writer_records >= self.segment_records:
+			self.rotate()
+
+		self.write_seq += 1
+		self.writer.write("%d\t%s\n" % (self.write_seq, json.dumps(item)))
+		self.writer_records += 1
+		self.unsynced += 1
+
+		if self.unsynced >= self.fsync_records:
+			self.sync_in_thread()
+		else:
+			self.schedule_sync()
+
+	def rotate(self):
+		# Starts a new segment, the previous one becomes read-only and is fsync'ed with the next sync
+		if self.writer is not None:
+			self.writer.flush()
+			if self.unsynced > 0:
+				self.unsynced_fds.append(os.dup(self.writer.fileno()))
+				self.unsynced = 0
+			self.writer.close()
+
+		# An empty segment left over from the last run is simply reused
+		if not self.segments or self.segments[-1] != self.write_seq + 1:
+			self.segments.append(self.write_seq + 1)
+		self.writer = io.open(self.segment_path(self.write_seq + 1), 'ab')
+		self.writer_records = 0
+		log.debug("Started spool segment %s" % self.segment_path(self.write_seq + 1))
+
+	def schedule_sync(self):
+		if self.clock is None or not self.clock.active():
+			self.clock = reactor.callLater(self.fsync_time, self.sync_in_thread)
+
+	def cancel_sync(self):
+		if self.clock is not None and self.clock.active():
+			self.clock.cancel()
+		self.clock = None
+
+	def take_unsynced(self):
+		# Descriptors to fsync, the records appended so far are handed to the kernel first
+		fds = self.unsynced_fds
+		self.unsynced_fds = []
+		if self.writer is not None and self.unsynced > 0:
+			self.writer.flush()
+			fds.append(os.dup(self.writer.fileno()))
+			self.unsynced = 0
+		return fds
+
+	def sync_in_thread(self):
+		self.cancel_sync()
+
+		if self.syncing:
+			self.resync = True
+			return
+
+		fds = self.take_unsynced()
+		ack_seq = self.commit_seq if self.commit_seq > self.stored_seq else None
+		if not fds and ack_seq is None:
+			return
+
+		self.syncing = True
+		d = threads.deferToThread(self.write_out, fds, ack_seq)
+		d.addCallbacks(self.synced, self.sync_failed)
+
+	def synced(self, result):
+		self.syncing = False
+		self.purge()
+
+		if self.resync:
+			self.resync = False
+			self.sync_in_thread()
+
+	def sync_failed(self, failure):
+		self.syncing = False
+		self.resync = False
+		log.error("Syncing spool %s failed, will retry: %s" % (self.path, failure.getErrorMessage()))
+
+		# The records are with the kernel already, the next fsync of the active segment covers what it can
+		self.unsynced = max(self.unsynced, 1)
+		self.schedule_sync()
+
+	def sync(self):
+		# Synchronous sync on the calling thread, for close and for moving shares between spools
+		self.cancel_sync()
+		self.write_out(self.take_unsynced(), self.commit_seq if self.commit_seq > self.stored_seq else None)
+		self.purge()
+
+	def write_out(self, fds, ack_seq):
+		# May run in a thread, nothing here touches the reactor
+		try:
+			for fd in fds:
+				os.fsync(fd)
+		finally:
+			for fd in fds:
+				os.close(fd)
+
+		if ack_seq is not None:
+			self.write_ack(ack_seq)
+
+	def write_ack(self, ack_seq):
+		with self.ack_lock:
+			if ack_seq <= self.stored_seq:
+				return
+
+			with open(self.ack_path() + '.tmp', 'wb') as f:
+				f.write("%d\n" % ack_seq)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(self.ack_path() + '.tmp', self.ack_path())
+			self.stored_seq = ack_seq
+
+	def open_reader(self):
+		# Opens the oldest segment that still has records we have not read
+		if self.reader is not None:
+			self.reader.close()
+		self.reader = None
+		self.reader_segment = None
+
+		for first_seq in self.segments:
+			if self.next_segment(first_seq) is None or self.next_segment(first_seq) > self.read_seq + 1:
+				self.reader = io.open(self.segment_path(first_seq), 'rb')
+				self.reader_segment = first_seq
+				return
+
+	def next_segment(self, first_seq):
+		index = self.segments.index(first_seq)
+		if index + 1 < len(self.segments):
+			return self.segments[index + 1]
+		return None
+
+	def read_record(self):
+		# Returns the next record, moving on to the next segment at the end of a finished one
+		while self.reader is not None:
+			line = self.reader.readline()
+
+			if line.endswith('\n'):
+				(seq, data) = line.split('\t', 1)
+				self.read_seq = int(seq)
+				return json.loads(data)
+
+			if line:
+				# Torn write from a crash, nothing after it in this segment is usable
+				log.warning("Skipping incomplete record in spool segment %s" % self.segment_path(self.reader_segment))
+
+			if self.next_segment(self.reader_segment) is None:
+				return None
+
+			self.read_seq = max(self.read_seq, self.next_segment(self.reader_segment) - 1)
+			self.open_reader()
+
+		return None
+
+	def take(self, count):
+		# Makes sure everything written so far is visible to the reader
+		if self.writer is not None:
+			self.writer.flush()
+
+		if self.reader is None:
+			self.open_reader()
+
+		first_seq = self.read_seq + 1
+		batch = []
+		while len(batch) < count:
+			item = self.read_record()
+			if item is None:
+				# Everything written is readable by now, records still missing were lost (torn or removed segments)
+				if self.read_seq < self.write_seq:
+					log.warning("Skipping %i unreadable spooled share(s) in %s" % (self.write_seq - self.read_seq, self.path))
+					self.read_seq = self.write_seq
+				break
+			batch.append(item)
+
+		token = (first_seq, self.read_seq)
+		self.outstanding[token] = first_seq
+		return (token, batch)
+
+	def ack(self, token):
+		self.outstanding.pop(token, None)
+
+		# Everything before the oldest unacknowledged batch is stored
+		if self.outstanding:
+			commit_seq = min(self.outstanding.values()) - 1
+		else:
+			commit_seq = self.read_seq
+
+		if commit_seq <= self.commit_seq:
+			return
+
+		# Written to the 'ack' file with the next sync
+		self.commit_seq = commit_seq
+		self.schedule_sync()
+
+	def purge(self):
+		# Removes segments that only hold acknowledged records, never the active or the one being read
+		# Only acknowledgements in the 'ack' file count, a crash before it is written replays the segment
+		while len(self.segments) > 1 and self.segments[1] - 1 <= self.stored_seq and self.segments[0] != self.reader_segment:
+			log.debug("Removing spool segment %s" % self.segment_path(self.segments[0]))
+			os.remove(self.segment_path(self.segments.pop(0)))
+
+	def depth(self):
+		return self.write_seq - self.read_seq
+
+	def close(self):
+		self.sync()
+		if self.writer is not None:
+			self.writer.close()
+		if self.reader is not None:
+			self.reader.close()
@@ -0,0 +1,206 @@
+from twisted.internet import reactor, defer, protocol, stdio
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols import basic
+from zope.interface import implementer
+import json
+import os
+import sys
+
+import lib.logger
+log = lib.logger.get_logger('ShareWriter')
+
+# Driver methods the writer process may be asked to run
+METHODS = ('import_shares', 'import_rollups', 'flush_worker_checkins')
+
+# Descriptors of the request (parent to child) and reply (child to parent) pipes,
+# stdout and stderr of the writer stay free for logging
+REQUEST_FD = 3
+REPLY_FD = 4
+
+# Seconds the writer gets to finish when the stratum process stops
+SHUTDOWN_TIMEOUT = 30
+
+class ShareWriterError(Exception):
+	pass
+
+class ShareWriter(protocol.ProcessProtocol):
+	'''
+		Runs share imports in a separate writer process (share_writer.py).
+
+		Calls are sent to the writer as JSON lines, {"id", "method", "args"},
+		and answered with {"id", "result"} or {"id", "error"}.  call()
+		returns a Deferred firing with the result.  When the writer dies its
+		pending calls fail (the batcher retries them) and it is restarted
+		after 'retry_time' seconds.
+	'''
+
+	def __init__(self, script, config_file, retry_time):
+		self.script = script
+		self.config_file = config_file
+		self.retry_time = retry_time
+
+		# Request id -> Deferred
+		self.requests = {}
+		self.next_id = 0
+
+		# Incomplete lines per descriptor
+		self.buffers = {1: '', 2: '', REPLY_FD: ''}
+
+		self.running = False
+		self.closing = None
+		self.killclock = None
+		self.restarts = 0
+		self.start()
+
+	def start(self):
+		reactor.spawnProcess(self, sys.executable, [sys.executable, self.script, self.config_file],
+					env = os.environ, path = os.getcwd(),
+					childFDs = {0: 'w', 1: 'r', 2: 'r', REQUEST_FD: 'w', REPLY_FD: 'r'})
+
+	def connectionMade(self):
+		self.running = True
+		log.info("Share writer process started (pid %i)" % self.transport.pid)
+
+	def call(self, method, *args):
+		if not self.running:
+			return defer.fail(ShareWriterError("Share writer process is not running"))
+
+		self.next_id += 1
+		try:
+			line = json.dumps({'id': self.next_id, 'method': method, 'args': args})
+		except (TypeError, ValueError) as e:
+			return defer.fail(e)
+
+		d = self.requests[self.next_id] = defer.Deferred()
+		self.transport.writeToChild(REQUEST_FD, line + '\n')
+		return d
+
+	def childDataReceived(self, fd, data):
+		lines = (self.buffers.get(fd, '') + data).split('\n')
+		self.buffers[fd] = lines.pop()
+
+		for line in lines:
+			if fd == REPLY_FD:
+				self.reply(line)
+			elif line:
+				log.info("writer: %s" % line)
+
+	def reply(self, line):
+		reply = json.loads(line)
+		d = self.requests.pop(reply['id'], None)
+		if d is None:
+			return
+
+		if 'error' in reply:
+			d.errback(ShareWriterError(reply['error']))
+		else:
+			d.callback(reply['result'])
+
+	def processEnded(self, reason):
+		self.running = False
+
+		# Whatever was not answered has to be written again
+		(requests, self.requests) = (self.requests, {})
+		for d in requests.values():
+			d.errback(ShareWriterError("Share writer process ended"))
+
+		if self.closing is not None:
+			log.info("Share writer process stopped")
+			if self.killclock.active():
+				self.killclock.cancel()
+			self.closing.callback(None)
+			return
+
+		log.error("Share writer process ended: %s, restarting in %i seconds" % (reason.getErrorMessage(), self.retry_time))
+		self.restarts += 1
+		reactor.callLater(self.retry_time, self.start)
+
+	def close(self):
+		# Closing the request pipe makes the writer finish its calls, flush checkins and exit
+		if not self.running:
+			return None
+
+		log.info("Stopping share writer process")
+		self.closing = defer.Deferred()
+		self.transport.closeChildFD(REQUEST_FD)
+		self.killclock = reactor.callLater(SHUTDOWN_TIMEOUT, self.kill)
+		return self.closing
+
+	def kill(self):
+		log.error("Share writer process did not stop within %i seconds, killing it" % SHUTDOWN_TIMEOUT)
+		self.transport.signalProcess('KILL')
+
+	def stats(self):
+		return {
+			'running': self.running,
+			'pid': self.transport.pid if self.running else None,
+			'pending': len(self.requests),
+			'restarts': self.restarts
+		}
+
+@implementer(IHalfCloseableProtocol)
+class ShareWriterServer(basic.LineReceiver):
+	'''
+		The writer process end: runs the calls read from REQUEST_FD on its
+		own connection pool and answers on REPLY_FD.
+	'''
+
+	delimiter = '\n'
+	# A line holds a whole batch of shares
+	MAX_LENGTH = 64 * 1024 * 1024
+
+	def __init__(self, pool):
+		self.pool = pool
+
+		# Request id -> Deferred of the calls in progress
+		self.pending = {}
+
+	def lineReceived(self, line):
+		request = json.loads(line)
+
+		if request['method'] in METHODS:
+			d = self.pool.runMethod(request['method'], *request['args'])
+		else:
+			d = defer.fail(ShareWriterError("Unknown method '%s'" % request['method']))
+
+		self.pending[request['id']] = d
+		d.addCallbacks(self.done, self.failed, callbackArgs = (request['id'],), errbackArgs = (request['id'], request['method']))
+
+	def lineLengthExceeded(self, line):
+		log.error("Request of %i bytes is too long, stopping" % len(line))
+		self.transport.loseConnection()
+
+	def done(self, result, id):
+		del self.pending[id]
+		self.sendLine(json.dumps({'id': id, 'result': result}))
+
+	def failed(self, failure, id, method):
+		del self.pending[id]
+		log.error("%s failed: %s" % (method, failure.getErrorMessage()))
+		self.sendLine(json.dumps({'id': id, 'error': failure.getErrorMessage()}))
+
+	def readConnectionLost(self):
+		# The stratum process is stopping, answer what is in progress and write the held back checkins
+		d = defer.DeferredList(self.pending.values())
+		d.addCallback(lambda result: self.pool.runMethod('flush_worker_checkins'))
+		d.addErrback(lambda failure: log.error("Flushing worker checkins failed: %s" % failure.getErrorMessage()))
+		d.addBoth(lambda result: self.transport.loseConnection())
+
+	def writeConnectionLost(self):
+		log.warning("Reply pipe closed")
+
+	def connectionLost(self, reason):
+		reactor.stop()
+
+def serve():
+	# Entry point of the writer process, see share_writer.py
+	import lib.settings as settings
+	import DBInterface
+	import DBPool
+
+	dbi = DBInterface.DBInterface()
+	dbi.DATABASE.preload_worker_ids()
+	pool = DBPool.DBPool(dbi.driver, settings.DB_POOL_SIZE)
+
+	stdio.StandardIO(ShareWriterServer(pool), stdin = REQUEST_FD, stdout = REPLY_FD)
+	reactor.run()
@@ -0,0 +1,84 @@
+from twisted.internet import reactor, defer
+
+import lib.logger
+log = lib.logger.get_logger('StatsAggregator')
+
+class StatsAggregator(object):
+	'''
+		Merges the round totals of parallel share imports.
+
+		Imports of the worker partitions only write their shares and worker
+		checkins.  Their round totals (shares in difficulty, best share) are
+		added here and handed to the writer (see add_round_stats() of the
+		drivers) every 'interval' seconds by a single caller, so imports
+		never wait on the row locks of the pool table.
+	'''
+
+	def __init__(self, writer, interval):
+		self.writer = writer
+		self.interval = interval
+
+		# Totals not written yet
+		self.total_shares = 0
+		self.best_diff = 0
+		self.batches = 0
+
+		self.writing = False
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+		# Metrics
+		self.writes = 0
+		self.failures = 0
+
+	def add(self, total_shares, best_diff):
+		self.total_shares += total_shares
+		self.best_diff = max(self.best_diff, best_diff)
+		self.batches += 1
+
+	def take(self):
+		totals = (self.total_shares, self.best_diff)
+		(self.total_shares, self.best_diff, self.batches) = (0, 0, 0)
+		return totals
+
+	def flush(self):
+		self.clock = reactor.callLater(self.interval, self.flush)
+
+		# One write at a time
+		if self.writing or self.batches == 0:
+			return
+
+		self.writing = True
+		(total_shares, best_diff) = self.take()
+		d = defer.maybeDeferred(self.writer, total_shares, best_diff)
+		d.addCallbacks(self.written, self.failed, errbackArgs=(total_shares, best_diff))
+
+	def written(self, result):
+		self.writing = False
+		self.writes += 1
+
+	def failed(self, failure, total_shares, best_diff):
+		self.writing = False
+		self.failures += 1
+		log.error("Writing round stats failed, will retry with the next flush.  Error: %s" % failure.getErrorMessage())
+		self.add(total_shares, best_diff)
+
+	def drain(self, writer):
+		# Synchronously writes the current totals using 'writer'
+		if self.batches == 0:
+			return
+
+		(total_shares, best_diff) = self.take()
+		try:
+			writer(total_shares, best_diff)
+		except:
+			self.add(total_shares, best_diff)
+			raise
+
+	def stats(self):
+		return {
+			'pending_shares': self.total_shares,
+			'pending_best_share': self.best_diff,
+			'pending_batches': self.batches,
+			'writes': self.writes,
+			'failures': self.failures
+		}
@@ -0,0 +1,107 @@
+import collections
+import random
+import time
+
+class UserCache(object):
+	'''
+		Bounded cache of authorized workers, used from the reactor thread.
+
+		Every entry expires on its own, 'ttl' seconds after it was added
+		less up to 'jitter' of that, so entries added together don't all
+		expire (and get looked up again) at the same moment.  Beyond
+		'max_entries' the least recently used entry is evicted.  Entries are
+		filed by username so a single worker can be invalidated.
+
+		Invalidations also bump a generation number, per username and for
+		the whole cache on clear().  Authorizations held elsewhere (e.g. in
+		connection sessions) remember the generation they were looked up
+		at and are revoked when it changes.
+	'''
+
+	def __init__(self, ttl, max_entries, jitter = 0.2):
+		self.ttl = ttl
+		self.max_entries = max(max_entries, 1)
+		self.jitter = jitter
+
+		# key -> (username, expiry time), least recently used first
+		self.entries = collections.OrderedDict()
+		# username -> set of keys
+		self.usernames = {}
+
+		# Bumped by clear() and, per username, by invalidate()
+		self.epoch = 0
+		self.generations = {}
+
+		# Metrics
+		self.hits = 0
+		self.misses = 0
+		self.expirations = 0
+		self.evictions = 0
+		self.invalidations = 0
+
+	def get(self, key):
+		# True when 'key' is cached and not expired
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			return False
+
+		if entry[1] <= time.time():
+			self.forget(key, entry[0])
+			self.expirations += 1
+			self.misses += 1
+			return False
+
+		# Back to the most recently used end
+		self.entries[key] = entry
+		self.hits += 1
+		return True
+
+	def add(self, key, username):
+		if key in self.entries:
+			self.remove(key)
+
+		self.entries[key] = (username, time.time() + self.ttl * (1 - random.uniform(0, self.jitter)))
+		self.usernames.setdefault(username, set()).add(key)
+
+		while len(self.entries) > self.max_entries:
+			(old_key, (old_username, expiry)) = self.entries.popitem(last = False)
+			self.forget(old_key, old_username)
+			self.evictions += 1
+
+	def remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.forget(key, entry[0])
+
+	def forget(self, key, username):
+		# Drops 'key' from the username index, the entry itself is already gone
+		keys = self.usernames.get(username)
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self.usernames[username]
+
+	def invalidate(self, username):
+		self.generations[username] = self.generations.get(username, 0) + 1
+		for key in self.usernames.pop(username, set()):
+			self.entries.pop(key, None)
+			self.invalidations += 1
+
+	def clear(self):
+		self.epoch += 1
+		self.entries.clear()
+		self.usernames.clear()
+
+	def generation(self, username):
+		return (self.epoch, self.generations.get(username, 0))
+
+	def stats(self):
+		return {
+			'size': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'expirations': self.expirations,
+			'evictions': self.evictions,
+			'invalidations': self.invalidations
+		}
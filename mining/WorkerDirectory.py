@@ -0,0 +1,121 @@
+from twisted.internet import reactor
+import time
+
+import lib.logger
+log = lib.logger.get_logger('WorkerDirectory')
+
+class WorkerDirectory(object):
+	'''
+		pool_worker joined with pool_worker_settings, held in memory so
+		authorizations and difficulty lookups don't query the database.
+
+		Rows are dicts of id, username, password, difficulty, last_checkin
+		and custom_diff_enable, filed by username.  The table is loaded in
+		full at startup and every 'full_sync_time' seconds, which also
+		drops deleted workers.  In between, every 'sync_time' seconds only
+		the rows changed since the last sync are fetched, see get_workers()
+		of the drivers: the last_update columns change with passwords,
+		difficulties and settings but not with checkins.
+
+		last_checkin is as loaded, checkins don't update it here.
+	'''
+
+	def __init__(self, pool, sync_time, full_sync_time):
+		self.pool = pool
+		self.sync_time = sync_time
+		self.full_sync_time = full_sync_time
+
+		# username -> row
+		self.workers = {}
+		# Server time of the last sync, the next one fetches the rows changed since then
+		self.since = None
+		self.last_full_sync = 0
+
+		self.syncing = False
+		self.clock = None
+
+		# Metrics
+		self.hits = 0
+		self.misses = 0
+		self.syncs = 0
+		self.full_syncs = 0
+		self.rows = 0
+		self.failures = 0
+
+	def start(self, database):
+		# Loads the table on 'database' and starts syncing on the pool
+		self.apply(database.get_workers(), True)
+		log.info("Loaded %i workers" % len(self.workers))
+		self.clock = reactor.callLater(self.sync_time, self.sync)
+
+	def sync(self):
+		self.clock = reactor.callLater(self.sync_time, self.sync)
+
+		# One sync at a time
+		if self.syncing:
+			return
+
+		self.syncing = True
+		full = time.time() - self.last_full_sync >= self.full_sync_time
+		d = self.pool.runMethod('get_workers', None if full else self.since)
+		d.addCallbacks(self.synced, self.failed, callbackArgs=(full,))
+
+	def synced(self, result, full):
+		self.syncing = False
+		self.apply(result, full)
+
+	def failed(self, failure):
+		self.syncing = False
+		self.failures += 1
+		log.error("Worker sync failed, will retry with the next one.  Error: %s" % failure.getErrorMessage())
+
+	def apply(self, result, full):
+		(server_time, rows) = result
+		if full:
+			self.workers = dict([(row['username'], row) for row in rows])
+			self.last_full_sync = time.time()
+			self.full_syncs += 1
+		else:
+			for row in rows:
+				self.workers[row['username']] = row
+
+		self.since = server_time
+		self.rows += len(rows)
+		self.syncs += 1
+
+	def get(self, username):
+		worker = self.workers.get(username)
+		if worker is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return worker
+
+	def check_password(self, username, password_hash, check = True):
+		# True when the worker is known and, if 'check', 'password_hash' matches
+		worker = self.get(username)
+		return worker is not None and (not check or worker['password'] == password_hash)
+
+	def set_difficulty(self, username, difficulty):
+		worker = self.workers.get(username)
+		if worker is not None:
+			worker['difficulty'] = difficulty
+
+	def remove(self, username):
+		self.workers.pop(username, None)
+
+	def reload(self):
+		# The next sync loads the whole table
+		self.last_full_sync = 0
+
+	def stats(self):
+		return {
+			'size': len(self.workers),
+			'hits': self.hits,
+			'misses': self.misses,
+			'syncs': self.syncs,
+			'full_syncs': self.full_syncs,
+			'rows': self.rows,
+			'failures': self.failures,
+			'last_full_sync': self.last_full_sync
+		}
@@ -3,8 +3,8 @@ import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('BasicShareLimiter')
 
-import DBInterface
-dbi = DBInterface.DBInterface()
+# Share the database interface (and its connection pool) with the rest of the pool
+from mining.interfaces import dbi
 
 # Only clear worker difficulties in the database when external difficulty is disabled
 if not settings.ALLOW_EXTERNAL_DIFFICULTY:
@@ -116,13 +116,14 @@ class BasicShareLimiter(object):
 
 		# Init the stats for this worker if it isn't set.
 		if worker_name not in self.worker_stats or self.worker_stats[worker_name]['last_ts'] < timestamp - settings.DB_USERCACHE_TIME :
-			# Load the worker's difficult as set in the database
-			(use_vardiff, database_worker_difficulty) = Interfaces.worker_manager.get_user_difficulty(worker_name)
-			log.info("Database difficulty for %s Found as: %s.  Curent diff is: %s Using VARDIFF: %s" % (worker_name, database_worker_difficulty, current_difficulty, ('Yes' if use_vardiff else 'No')))
 			# Set it to current difficulty
 			dbi.update_worker_diff(worker_name, current_difficulty)
-			# Cache the information
-			self.worker_stats[worker_name] = {'last_rtc': (timestamp - self.retarget / 2), 'last_ts': timestamp, 'buffer': SpeedBuffer(self.buffersize), 'database_worker_difficulty': database_worker_difficulty, 'use_vardiff': use_vardiff}
+			# Cache the information, no retarget until the database settings are known
+			stats = {'last_rtc': (timestamp - self.retarget / 2), 'last_ts': timestamp, 'buffer': SpeedBuffer(self.buffersize), 'database_worker_difficulty': None, 'use_vardiff': False}
+			self.worker_stats[worker_name] = stats
+			# Load the worker's difficult as set in the database
+			d = Interfaces.worker_manager.get_user_difficulty(worker_name)
+			d.addCallback(self.database_difficulty, stats, worker_name, current_difficulty)
 			return
 
 		# Standard share update of data
@@ -205,3 +206,8 @@ class BasicShareLimiter(object):
 		log.info("Retarget for %s %i old: %i new: %i" % (worker_name, ddiff, current_difficulty, new_diff))
 		self.set_worker_difficulty(connection_ref, new_diff, worker_name)
 
+	def database_difficulty(self, difficulty, stats, worker_name, current_difficulty):
+		(use_vardiff, database_worker_difficulty) = difficulty
+		log.info("Database difficulty for %s Found as: %s.  Curent diff is: %s Using VARDIFF: %s" % (worker_name, database_worker_difficulty, current_difficulty, ('Yes' if use_vardiff else 'No')))
+		stats['database_worker_difficulty'] = database_worker_difficulty
+		stats['use_vardiff'] = use_vardiff
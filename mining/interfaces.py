@@ -27,28 +27,53 @@ class WorkerManagerInterface(object):
 
 	def authorize(self, worker_name, worker_password):
 		# Important NOTE: This is called on EVERY submitted share. So you'll need caching!!!
+		# Returns a Deferred, it has already fired when the worker is cached and fails when the lookup failed
 		return dbi.check_password(worker_name, worker_password)
+
+	# Connections remember the workers they authorized, so submits don't look them up again.
+	# A memo holds the generation the worker was looked up at (see UserCache) and is good for DB_USERCACHE_TIME seconds,
+	# delete_user/update_user bump the generation and revoke it at once.
+	def auth_generation(self, worker_name):
+		return dbi.auth_generation(worker_name)
+
+	def remember_authorization(self, session, worker_name, generation):
+		session.setdefault('auth_memo', {})[worker_name] = (generation, time.time() + settings.DB_USERCACHE_TIME)
+
+	def forget_authorization(self, session, worker_name):
+		session.get('auth_memo', {}).pop(worker_name, None)
+
+	def is_authorized(self, session, worker_name):
+		memo = session.get('auth_memo')
+		if memo is None or worker_name not in memo:
+			return False
+
+		(generation, expiry) = memo[worker_name]
+		return expiry > time.time() and generation == self.auth_generation(worker_name)
  
-	# Returns a tuple with 
+	# Returns a Deferred firing a tuple with 
 	# 	The difficulty as found the database
 	#	True or false stating if custom_diff_enable is set
 	# Uppon initial authorization, if the last checkin_time of this user from the database exceeds the threshold (in days), and they are using VARDIFF: 'reset' back to the pool default
 	# If the user is not found, we return the default pool difficultly and use vardiff (custom_diff_enable not set)
 	def get_user_difficulty(self, worker_name, is_initial_authorization = False, last_checkin_threshold = 0):
+		# Gets worker's initial difficulty and settings from database (if there is one) on a pooled connection, from memory with DB_WORKER_DIRECTORY
+		d = defer.maybeDeferred(dbi.get_worker, worker_name)
+		d.addCallbacks(self.worker_difficulty, self.worker_difficulty_failed,
+				callbackArgs=(worker_name, is_initial_authorization, last_checkin_threshold), errbackArgs=(worker_name,))
+		return d
+
+	def worker_difficulty_failed(self, failure, worker_name):
+		log.warning("An error occured during difficulty lookup for the user '%s'.  Using DIFF=%s VARDIFF=%s" % (worker_name, settings.POOL_TARGET, True))
+		return (True, settings.POOL_TARGET)
+
+	def worker_difficulty(self, worker_data, worker_name, is_initial_authorization, last_checkin_threshold):
 		# Initial values
 		use_vardiff = True
 		difficulty = settings.POOL_TARGET
 		is_old = False
 
-		# Gets worker's initial difficulty from database (if there is one)
-		try:
-			worker_data = dbi.get_user(worker_name)
-		except:
-			log.warning("An error occured during difficulty lookup for the user '%s'.  Using DIFF=%s VARDIFF=%s" % (worker_name, difficulty, use_vardiff))
-			worker_data = {}
-
 		# If there is no information found, then return the defaults
-		if len(worker_data) < 6: return (use_vardiff, difficulty)
+		if worker_data is None: return (use_vardiff, difficulty)
 
 		log.debug("Found worker: %s" % str(worker_name))
 		log.debug("Data: %s" % str(worker_data))
@@ -58,14 +83,8 @@ class WorkerManagerInterface(object):
 		if worker_data['difficulty'] != 0:
 			difficulty = worker_data['difficulty']
 
-		# Now attempt to lookup to see if we are using VARDIFF for this worker
-		try:
-			worker_settings = dbi.get_user_settings(worker_data['id'])
-		except:
-			# If for whatever reason something goes wrong, retur nthe defaults.
-			log.warning("VARDIFF state could not be determined for '%s'.  Using VARDIFF=%s" % (worker_name, use_vardiff))
-
-		if not worker_settings is None and worker_settings['custom_diff_enable'] == 1:
+		# See if we are using VARDIFF for this worker
+		if worker_data['custom_diff_enable'] == 1:
 			# Enable custom difficulty, turn off VARDIFF
 			log.debug("VARDIFF is Disabled")
 			use_vardiff = False
@@ -139,9 +158,13 @@ class ShareManagerInterface(object):
 		self.prev_hash = b58encode(int(prevhash, 16))
 		pass
 
-	def on_submit_share(self, worker_name, block_header, block_hash, difficulty, timestamp, is_valid, ip, invalid_reason, share_diff):
+	def on_submit_share(self, worker_name, block_header, block_hash, difficulty, timestamp, is_valid, ip, invalid_reason, share_diff, is_block_candidate = False):
 		log.debug("%s (%s) %s %s" % (block_hash, share_diff, 'valid' if is_valid else 'INVALID', worker_name))
-		dbi.queue_share([worker_name, block_header, block_hash, difficulty, timestamp, is_valid, ip, self.block_height, self.prev_hash, invalid_reason, share_diff ])
+		share = [worker_name, block_header, block_hash, difficulty, timestamp, is_valid, ip, self.block_height, self.prev_hash, invalid_reason, share_diff ]
+		if is_block_candidate:
+			dbi.queue_block_candidate(share)
+		else:
+			dbi.queue_share(share)
  
 	# The prev_hash, block_height need to be provided since the cached version may have changed to the next block by the time we get to this point
 	def on_submit_block(self, is_accepted, worker_name, block_header, block_hash, difficulty, prev_hash, block_height, timestamp, ip, share_diff):
@@ -4,7 +4,7 @@ from twisted.internet import defer
 import lib.settings as settings
 from lib.stratum.services import GenericService, admin
 from lib.stratum.pubsub import Pubsub
-from interfaces import Interfaces
+from interfaces import Interfaces, dbi
 from subscription import MiningSubscription
 from lib.exceptions import SubmitException
 import json
@@ -46,6 +46,12 @@ class MiningService(GenericService):
 		log.debug("Server stats request: %s" % serialized)
 		return '%s' % serialized
 
+	@admin
+	def get_db_stats(self):
+		'''Returns share queue and database statistics'''
+
+		return dbi.get_stats()
+
 	@admin
 	def update_block(self):
 		'''Connect this RPC call to 'coind -blocknotify' for 
@@ -64,7 +70,12 @@ class MiningService(GenericService):
 		log.info("Worker diff update request received")
 
 		# Load new difficulty from database
-		(use_vardiff, new_difficulty) = Interfaces.worker_manager.get_user_difficulty(worker_name)
+		d = Interfaces.worker_manager.get_user_difficulty(worker_name)
+		d.addCallback(self._update_worker_diff, worker_name)
+		return d
+
+	def _update_worker_diff(self, difficulty, worker_name):
+		(use_vardiff, new_difficulty) = difficulty
 		log.info("Loaded requested worker: %s for: difficulty %s" % (str(worker_name), new_difficulty))
 
 		if use_vardiff:
@@ -113,44 +124,81 @@ class MiningService(GenericService):
 	def authorize(self, worker_name, worker_password):
 		'''Let authorize worker on this connection.'''
 
+		# IPs which failed too often are rejected without looking the worker up
+		if dbi.auth_throttle is not None:
+			ip = self.connection_ref()._get_ip()
+			if not dbi.auth_throttle.allow(ip):
+				log.debug("Throttled worker authorization: IP %s" % str(ip))
+				return False
+
+		# Taken before the lookup, a revocation during it must still apply
+		generation = Interfaces.worker_manager.auth_generation(worker_name)
+		d = Interfaces.worker_manager.authorize(worker_name, worker_password)
+		d.addCallbacks(self._authorize, self._authorize_unavailable, callbackArgs=(worker_name, worker_password, generation), errbackArgs=(worker_name,))
+		return d
+
+	def _authorize_unavailable(self, failure, worker_name):
+		# The lookup failed (e.g. the database is down), the credentials may be fine: not charged to the IP's throttle
+		log.warning("Authorization of %s is unavailable: %s" % (worker_name, failure.getErrorMessage()))
+		return False
+
+	def _authorize(self, is_authorized, worker_name, worker_password, generation):
+		# The connection may have gone away while the worker was looked up
+		if self.connection_ref() is None:
+			return False
+
 		session = self.connection_ref().get_session()
 		session.setdefault('authorized', {})
 
-		if Interfaces.worker_manager.authorize(worker_name, worker_password):
+		if is_authorized:
 			session['authorized'][worker_name] = worker_password
+			Interfaces.worker_manager.remember_authorization(session, worker_name, generation)
 
 			# Find out the difficulty to setup for this worker and whether or not to enable to VARDIFF (automatic difficulty readajustment)
 			# If resuming VARDIFF, the worker must have last connected no more than 2 days ago. TODO: make this configurable
-			(vardiff_enabled, initial_difficulty) = Interfaces.worker_manager.get_user_difficulty(worker_name, True, 2)
-			log.debug("Session Difficulty: %s, Determined Difficulty: %s VARDIFF: %s" % (session['difficulty'], initial_difficulty, vardiff_enabled))
-
-			if vardiff_enabled:
-				log.info("Authorized worker %s is using VARDIFF, initial difficulty will be set to: %s" % (str(worker_name), initial_difficulty))
-			else:
-				log.info("Setting authorized worker %s to difficulty %s" % (str(worker_name), initial_difficulty))
-
-			# Upon authorization the difficulty will be set and the worker pushed an update
-			# Avoid overhead if the worker's initially subscribed diff (which should be the pool default) in session['difficulty'] is already being used
-			if not session['difficulty'] == initial_difficulty:
-				# This is key: It sets the worker's difficutly to the new a value
-				Interfaces.share_limiter.set_worker_difficulty(self.connection_ref, initial_difficulty, worker_name, True)
-
-				 # A nice information message stating that we have resumed VARDIFF
-				if vardiff_enabled:
-					log.info("VARDIFF resumed for '%s' at %s" % (worker_name, initial_difficulty))
-
-			# Log the action
-			Interfaces.worker_manager.worker_log['authorized'][worker_name] = (0, 0, False, initial_difficulty, vardiff_enabled, Interfaces.timestamper.time())
-			return True
+			d = Interfaces.worker_manager.get_user_difficulty(worker_name, True, 2)
+			d.addCallback(self._authorized, worker_name)
+			return d
 		else:
 			ip = self.connection_ref()._get_ip()
 			log.info("Failed worker authorization: IP %s" % str(ip))
+			if dbi.auth_throttle is not None:
+				dbi.auth_throttle.failed(ip)
 			if worker_name in session['authorized']:
 				del session['authorized'][worker_name]
+			Interfaces.worker_manager.forget_authorization(session, worker_name)
 			if worker_name in Interfaces.worker_manager.worker_log['authorized']:
 				del Interfaces.worker_manager.worker_log['authorized'][worker_name]
 			return False
 
+	def _authorized(self, difficulty, worker_name):
+		# The connection may have gone away while the difficulty was looked up
+		if self.connection_ref() is None:
+			return False
+
+		session = self.connection_ref().get_session()
+		(vardiff_enabled, initial_difficulty) = difficulty
+		log.debug("Session Difficulty: %s, Determined Difficulty: %s VARDIFF: %s" % (session['difficulty'], initial_difficulty, vardiff_enabled))
+
+		if vardiff_enabled:
+			log.info("Authorized worker %s is using VARDIFF, initial difficulty will be set to: %s" % (str(worker_name), initial_difficulty))
+		else:
+			log.info("Setting authorized worker %s to difficulty %s" % (str(worker_name), initial_difficulty))
+
+		# Upon authorization the difficulty will be set and the worker pushed an update
+		# Avoid overhead if the worker's initially subscribed diff (which should be the pool default) in session['difficulty'] is already being used
+		if not session['difficulty'] == initial_difficulty:
+			# This is key: It sets the worker's difficutly to the new a value
+			Interfaces.share_limiter.set_worker_difficulty(self.connection_ref, initial_difficulty, worker_name, True)
+
+			 # A nice information message stating that we have resumed VARDIFF
+			if vardiff_enabled:
+				log.info("VARDIFF resumed for '%s' at %s" % (worker_name, initial_difficulty))
+
+		# Log the action
+		Interfaces.worker_manager.worker_log['authorized'][worker_name] = (0, 0, False, initial_difficulty, vardiff_enabled, Interfaces.timestamper.time())
+		return True
+
 	def subscribe(self, *args):
 		'''Subscribe for receiving mining jobs. This will
 		return subscription details, extranonce1_hex and extranonce2_size'''
@@ -177,11 +225,39 @@ class MiningService(GenericService):
 		'''Try to solve block candidate using given parameters.'''
 
 		session = self.connection_ref().get_session()
+
+		# Workers authorized on this connection are not looked up again until their memo expires or is revoked
+		if Interfaces.worker_manager.is_authorized(session, worker_name):
+			return self._submit(True, worker_name, work_id, extranonce2, ntime, nonce)
+
 		session.setdefault('authorized', {})
 
 		# Check if worker is authorized to submit shares
+		generation = Interfaces.worker_manager.auth_generation(worker_name)
+		d = Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name))
+		d.addCallback(self._remember_authorization, worker_name, generation)
+		d.addCallbacks(self._submit, self._submit_unavailable, callbackArgs=(worker_name, work_id, extranonce2, ntime, nonce), errbackArgs=(worker_name,))
+		return d
+
+	def _submit_unavailable(self, failure, worker_name):
+		log.warning("Authorization of %s is unavailable: %s" % (worker_name, failure.getErrorMessage()))
+		raise SubmitException("Worker authorization is temporarily unavailable")
+
+	def _remember_authorization(self, is_authorized, worker_name, generation):
+		if is_authorized and self.connection_ref() is not None:
+			Interfaces.worker_manager.remember_authorization(self.connection_ref().get_session(), worker_name, generation)
+		return is_authorized
+
+	def _submit(self, is_authorized, worker_name, work_id, extranonce2, ntime, nonce):
+		# The connection may have gone away while the worker was looked up
+		if self.connection_ref() is None:
+			return False
+
+		session = self.connection_ref().get_session()
+		session.setdefault('authorized', {})
+
 		ip = self.connection_ref()._get_ip()
-		if not Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name)):
+		if not is_authorized:
 			log.info("Worker is not authorized: IP %s" % str(ip))
 			raise SubmitException("Worker is not authorized")
 
@@ -258,7 +334,7 @@ class MiningService(GenericService):
 		if block_header != None:
 			# If there is a block header, then the share is logged
 			Interfaces.share_manager.on_submit_share(worker_name, block_header,
-				block_hash, difficulty, submit_time, True, ip, '', share_diff)
+				block_hash, difficulty, submit_time, True, ip, '', share_diff, on_submit != None)
 
 		# if 'on_submit' is set, this means it was a potential block candidate as determined by 'template_registry.submit_share()'
 		if on_submit != None:
@@ -273,6 +349,9 @@ class MiningService(GenericService):
 	update_block.help_text = "Notify Stratum server about new block on the network."
 	update_block.params = [('password', 'string', 'Administrator password'), ]
 
+	get_db_stats.help_text = "Return share queue and database statistics."
+	get_db_stats.params = [('password', 'string', 'Administrator password'), ]
+
 	authorize.help_text = "Authorize worker for submitting shares on this connection."
 	authorize.params = [('worker_name', 'string', 'Name of the worker, usually in the form of user_login.worker_id.'),
 						('worker_password', 'string', 'Worker password'), ]
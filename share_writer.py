@@ -0,0 +1,18 @@
+'''
+Share writer process, started by DBInterface when DB_WRITER_PROCESS is enabled
+
+usage: share_writer.py <config file>
+'''
+import os
+import sys
+
+# Setup Config
+import conf.ConfigLoader as ConfigLoader
+ConfigLoader.CONFIG_FILE = sys.argv[1]
+import lib.settings as settings
+
+# The mining modules import each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mining'))
+import ShareWriter
+
+ShareWriter.serve()
@@ -0,0 +1,49 @@
+'''
+Tests of the pool, run from the top of the tree with:  trial tests
+
+The modules of mining/ import each other by name (see DBInterface), the
+tests import them the same way without setting up the whole service.
+
+lib.settings and lib.logger come with the stratum installation.  Where
+they are not available the settings are loaded from lib/config_default.py
+and logging goes through the standard logging module.
+'''
+import imp
+import logging
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, 'mining'), ROOT):
+	if path not in sys.path:
+		sys.path.insert(0, path)
+
+try:
+	import lib.settings
+	import lib.logger
+except ImportError:
+	lib = sys.modules.get('lib')
+	if lib is None:
+		lib = types.ModuleType('lib')
+		lib.__path__ = [os.path.join(ROOT, 'lib')]
+		sys.modules['lib'] = lib
+
+	if 'lib.settings' not in sys.modules:
+		lib.settings = imp.load_source('lib.settings', os.path.join(ROOT, 'lib', 'config_default.py'))
+
+	if 'lib.logger' not in sys.modules:
+		logger = types.ModuleType('lib.logger')
+		logger.get_logger = logging.getLogger
+		logging.getLogger().addHandler(logging.NullHandler())
+		lib.logger = sys.modules['lib.logger'] = logger
+
+def patch_settings(case, **values):
+	# Sets lib.settings for the duration of the test 'case', also the ones only conf/config.py defines
+	import lib.settings as settings
+	for (name, value) in values.items():
+		if hasattr(settings, name):
+			case.patch(settings, name, value)
+		else:
+			setattr(settings, name, value)
+			case.addCleanup(delattr, settings, name)
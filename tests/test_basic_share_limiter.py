@@ -0,0 +1,106 @@
+import sys
+import types
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import tests
+import lib.settings as settings
+
+class FakeDBInterface(object):
+	def __init__(self):
+		self.diffs = []
+
+	def clear_worker_diff(self):
+		pass
+
+	def update_worker_diff(self, username, diff):
+		self.diffs.append((username, diff))
+
+class FakeWorkerManager(object):
+	def __init__(self):
+		self.lookups = {}
+
+	def get_user_difficulty(self, worker_name):
+		self.lookups[worker_name] = defer.Deferred()
+		return self.lookups[worker_name]
+
+def load_limiter():
+	# basic_share_limiter takes the database interface and the worker manager from mining.interfaces
+	interfaces = types.ModuleType('mining.interfaces')
+	interfaces.dbi = FakeDBInterface()
+	interfaces.Interfaces = types.ModuleType('Interfaces')
+
+	saved = dict([(name, sys.modules.get(name)) for name in ('mining', 'mining.interfaces', 'basic_share_limiter')])
+	if sys.modules.get('mining') is None:
+		mining = types.ModuleType('mining')
+		mining.__path__ = []
+		sys.modules['mining'] = mining
+	sys.modules['mining.interfaces'] = interfaces
+	sys.modules.pop('basic_share_limiter', None)
+	settings.ALLOW_EXTERNAL_DIFFICULTY = True
+	try:
+		import basic_share_limiter
+	finally:
+		for (name, module) in saved.items():
+			if module is None:
+				sys.modules.pop(name, None)
+			else:
+				sys.modules[name] = module
+
+	return (basic_share_limiter, interfaces)
+
+(basic_share_limiter, interfaces) = load_limiter()
+
+class BasicShareLimiterTest(unittest.TestCase):
+	def setUp(self):
+		tests.patch_settings(self, VDIFF_FLOAT = False, VDIFF_X2_TYPE = False, USE_COINDAEMON_DIFF = False,
+					VDIFF_TARGET_TIME = 30, VDIFF_RETARGET_TIME = 120, VDIFF_VARIANCE_PERCENT = 20,
+					VDIFF_MIN_TARGET = 15, VDIFF_MAX_TARGET = 1000, VDIFF_MIN_CHANGE = 1, DB_USERCACHE_TIME = 600)
+
+		self.workers = FakeWorkerManager()
+		interfaces.Interfaces.worker_manager = self.workers
+		interfaces.dbi.diffs = []
+
+		self.limiter = basic_share_limiter.BasicShareLimiter()
+		self.retargets = []
+		self.limiter.set_worker_difficulty = lambda connection_ref, new_diff, worker_name, force_new = False: self.retargets.append((worker_name, new_diff))
+
+	def submit_shares(self, worker_name, first, count, interval = 1, difficulty = 16):
+		for n in range(count):
+			self.limiter.submit(None, 'job', difficulty, first + n * interval, worker_name)
+
+	def test_fast_worker_is_retargeted(self):
+		self.submit_shares('w', 1000, 1)
+		self.workers.lookups['w'].callback((True, 16))
+
+		# A share a second is far below the 30 s target, the first retarget is due half a retarget period after the first share
+		self.submit_shares('w', 1001, 60)
+		self.assertEqual(self.retargets, [('w', 480)])
+		self.assertEqual(self.limiter.worker_stats['w']['last_ts'], 1060)
+		self.assertEqual(self.limiter.worker_stats['w']['database_worker_difficulty'], 16)
+
+	def test_no_retarget_while_lookup_pending(self):
+		self.submit_shares('w', 1000, 80)
+		self.assertEqual(self.retargets, [])
+		self.assertEqual(self.limiter.worker_stats['w']['last_ts'], 1079)
+
+		# Shares seen meanwhile count once the worker turns out to use vardiff
+		self.workers.lookups['w'].callback((True, 16))
+		self.submit_shares('w', 1080, 1)
+		self.assertEqual(len(self.retargets), 1)
+
+	def test_custom_difficulty_is_kept(self):
+		self.submit_shares('w', 1000, 1)
+		self.workers.lookups['w'].callback((False, 64))
+		self.submit_shares('w', 1001, 200)
+		self.assertEqual(self.retargets, [])
+
+	def test_stale_worker_is_looked_up_again(self):
+		self.submit_shares('w', 1000, 1)
+		self.workers.lookups['w'].callback((True, 16))
+		first = self.workers.lookups['w']
+
+		self.submit_shares('w', 1000 + settings.DB_USERCACHE_TIME + 10, 1)
+		self.assertNotIdentical(self.workers.lookups['w'], first)
+		self.assertEqual(interfaces.dbi.diffs, [('w', 16), ('w', 16)])
@@ -0,0 +1,59 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import tests
+import DifficultyWriter
+
+class DifficultyWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = task.Clock()
+		self.patch(DifficultyWriter, 'reactor', self.clock)
+		self.pending = []
+		self.diffwriter = DifficultyWriter.DifficultyWriter(self.write, 10)
+
+	def write(self, diffs):
+		self.pending.append((dict(diffs), defer.Deferred()))
+		return self.pending[-1][1]
+
+	def test_visible_while_written(self):
+		self.diffwriter.add('worker', 64)
+		self.clock.advance(10)
+		self.assertEqual(self.pending[0][0], {'worker': 64})
+
+		# Handed to the writer but not stored yet, the new difficulty is still the one looked up
+		self.assertEqual(self.diffwriter.get('worker'), 64)
+		self.diffwriter.add('worker', 128)
+		self.assertEqual(self.diffwriter.get('worker'), 128)
+
+		self.pending[0][1].callback(None)
+		self.assertEqual(self.diffwriter.get('worker'), 128)
+		self.assertEqual(self.diffwriter.stats()['inflight'], 0)
+
+	def test_written_forgotten(self):
+		self.diffwriter.add('worker', 64)
+		self.clock.advance(10)
+		self.pending[0][1].callback(None)
+		self.assertIdentical(self.diffwriter.get('worker'), None)
+
+	def test_failed_write_kept(self):
+		self.diffwriter.add('worker', 64)
+		self.diffwriter.add('other', 32)
+		self.clock.advance(10)
+		self.diffwriter.add('worker', 128)
+		self.pending[0][1].errback(RuntimeError("database down"))
+
+		# The newer difficulty wins, the other one is written again with the next flush
+		self.assertEqual(self.diffwriter.get('worker'), 128)
+		self.assertEqual(self.diffwriter.get('other'), 32)
+		self.clock.advance(10)
+		self.assertEqual(self.pending[1][0], {'worker': 128, 'other': 32})
+
+	def test_drain_with_write_in_flight(self):
+		self.diffwriter.add('worker', 64)
+		self.diffwriter.add('other', 32)
+		self.clock.advance(10)
+		self.diffwriter.add('worker', 128)
+
+		drained = []
+		self.diffwriter.drain(drained.append)
+		self.assertEqual(drained, [{'worker': 128, 'other': 32}])
@@ -0,0 +1,45 @@
+from twisted.trial import unittest
+
+import tests
+import DB_Sqlite
+import RoundStats
+
+def share(height, difficulty, share_diff):
+	# Same layout as DB_Mysql.import_shares
+	return ['worker', 'header', 'hash', difficulty, 1000, True, '127.0.0.1', height, 'prevhash', None, share_diff]
+
+def rollup(height, accepted_diff, rejected_diff, best_share):
+	# Same layout as DB_Mysql.import_rollups
+	return ['worker', 960, height, 1, accepted_diff, 1, rejected_diff, best_share, 1000]
+
+class RoundTotalsTest(unittest.TestCase):
+	def setUp(self):
+		tests.patch_settings(self, DB_SQLITE_FILE = self.mktemp(), PASSWORD_SALT = 'salt', DATABASE_EXTEND = True)
+		self.patch(DB_Sqlite.DB_Sqlite, 'ROUND_STATS', RoundStats.RoundStats())
+		self.patch(DB_Sqlite.DB_Sqlite, 'WORKER_IDS', {})
+		self.db = DB_Sqlite.DB_Sqlite()
+		self.addCleanup(self.db.close)
+		self.db.check_tables()
+
+	def pool(self, parameter):
+		return float(self.db.executefetch("SELECT value FROM pool WHERE parameter = ?", (parameter,))[0]['value'])
+
+	def test_ended_round_left_out(self):
+		# Block 10 ended the round, its shares still queued are stored but don't count for the next one
+		self.db.import_shares([share(10, 8, 20), share(11, 4, 5), share(11, 2, 3)], False, True, 10)
+		self.assertEqual(self.pool('round_shares'), 6)
+		self.assertEqual(self.pool('round_best_share'), 5)
+		self.assertEqual(self.db.executefetch("SELECT COUNT(*) AS n FROM shares")[0]['n'], 3)
+
+		stats = DB_Sqlite.DB_Sqlite.ROUND_STATS.stats()
+		self.assertEqual((stats['round_shares'], stats['round_best_share']), (6, 5))
+
+	def test_no_found_block(self):
+		self.db.import_shares([share(10, 8, 20), share(11, 4, 5)])
+		self.assertEqual(self.pool('round_shares'), 12)
+		self.assertEqual(self.pool('round_best_share'), 20)
+
+	def test_ended_round_rollups_left_out(self):
+		self.db.import_rollups([rollup(10, 8, 1, 20), rollup(11, 4, 2, 5)], 10)
+		self.assertEqual(self.pool('round_shares'), 6)
+		self.assertEqual(self.pool('round_best_share'), 5)
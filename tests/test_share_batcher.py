@@ -0,0 +1,295 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import tests
+import ShareBatcher
+import BatchController
+
+class ClockTime(object):
+	# Stands in for the time module, time.time() follows 'clock'
+	def __init__(self, clock):
+		self.time = clock.seconds
+
+class Writer(object):
+	# Records the batches it is given, fails the ones listed in 'failures' (by call number)
+	def __init__(self, failures = ()):
+		self.batches = []
+		self.failures = set(failures)
+		self.calls = 0
+
+	def __call__(self, batch):
+		self.calls += 1
+		if self.calls in self.failures:
+			return defer.fail(RuntimeError("write failed"))
+		self.batches.append([item[0] for item in batch])
+
+def shares(*names):
+	return [(name, 1) for name in names]
+
+class ClockTestCase(unittest.TestCase):
+	def setUp(self):
+		self.clock = task.Clock()
+		self.clock.advance(1000)
+		self.patch(ShareBatcher, 'reactor', self.clock)
+		self.patch(ShareBatcher, 'time', ClockTime(self.clock))
+		self.patch(BatchController, 'time', ClockTime(self.clock))
+
+	def add(self, batcher, *names):
+		for item in shares(*names):
+			batcher.add(item)
+
+class ShareBatcherTest(ClockTestCase):
+	def test_size_flush(self):
+		writer = Writer()
+		batcher = ShareBatcher.ShareBatcher(writer, 3, 10)
+		self.add(batcher, 'a', 'b')
+		self.assertEqual(writer.batches, [])
+
+		self.add(batcher, 'c')
+		self.assertEqual(writer.batches, [['a', 'b', 'c']])
+		self.assertEqual(batcher.depth(), 0)
+		self.assertIdentical(batcher.oldest, None)
+
+	def test_age_flush(self):
+		writer = Writer()
+		batcher = ShareBatcher.ShareBatcher(writer, 50, 2)
+		self.add(batcher, 'a')
+		self.clock.advance(1)
+		self.add(batcher, 'b')
+
+		self.clock.advance(0.9)
+		self.assertEqual(writer.batches, [])
+
+		# Two seconds after the first share, not after the last one
+		self.clock.advance(0.1)
+		self.assertEqual(writer.batches, [['a', 'b']])
+		self.assertEqual(self.clock.getDelayedCalls(), [])
+
+	def test_age_of_remaining_share_after_partial_take(self):
+		writer = Writer()
+		batcher = ShareBatcher.ShareBatcher(writer, 2, 2)
+		self.add(batcher, 'a')
+		self.clock.advance(1.5)
+		self.add(batcher, 'b', 'c')
+		self.assertEqual(writer.batches, [['a', 'b']])
+
+		# 'c' is the oldest share now, its deadline is its own arrival + max_age
+		self.assertEqual(batcher.oldest, 1001.5)
+		self.clock.advance(1.9)
+		self.assertEqual(writer.batches, [['a', 'b']])
+		self.clock.advance(0.1)
+		self.assertEqual(writer.batches, [['a', 'b'], ['c']])
+
+	def test_retry_first(self):
+		writer = Writer(failures = (1,))
+		batcher = ShareBatcher.ShareBatcher(writer, 2, 10, retry_time = 5)
+		self.add(batcher, 'a', 'b')
+		self.assertEqual(batcher.failures, 1)
+		self.assertEqual(batcher.depth(), 2)
+
+		# Nothing is written before the retry time, not even full batches
+		self.add(batcher, 'c', 'd')
+		self.assertEqual(writer.batches, [])
+		self.assertEqual(batcher.depth(), 4)
+
+		self.clock.advance(5)
+		self.assertEqual(writer.batches, [['a', 'b'], ['c', 'd']])
+		self.assertEqual(batcher.depth(), 0)
+		self.assertEqual(batcher.stats()['shares_written'], 4)
+
+	def test_one_writer_at_a_time(self):
+		pending = []
+		def writer(batch):
+			pending.append(defer.Deferred())
+			return pending[-1]
+
+		batcher = ShareBatcher.ShareBatcher(writer, 2, 10, max_writers = 1)
+		self.add(batcher, 'a', 'b', 'c', 'd')
+		self.assertEqual(len(pending), 1)
+		self.assertEqual(batcher.stats()['writers'], 1)
+
+		# The backlog goes out as soon as the writer is done
+		pending[0].callback(None)
+		self.assertEqual(len(pending), 2)
+
+	def test_drain(self):
+		writer = Writer(failures = (1,))
+		batcher = ShareBatcher.ShareBatcher(writer, 2, 10)
+		self.add(batcher, 'a', 'b', 'c')
+
+		drained = []
+		batcher.drain(lambda batch: drained.append([item[0] for item in batch]))
+		self.assertEqual(drained, [['a', 'b'], ['c']])
+		self.assertEqual(batcher.depth(), 0)
+		self.assertIdentical(batcher.oldest, None)
+
+	def test_drain_keeps_failed_batch(self):
+		batcher = ShareBatcher.ShareBatcher(Writer(), 5, 10)
+		self.add(batcher, 'a', 'b')
+
+		def fail(batch):
+			raise RuntimeError("database down")
+		self.assertRaises(RuntimeError, batcher.drain, fail)
+		self.assertEqual(batcher.depth(), 2)
+
+	def test_leftover_shares_written_at_start(self):
+		buffer = ShareBatcher.MemoryBuffer()
+		for item in shares('a', 'b'):
+			buffer.put(item)
+
+		writer = Writer()
+		ShareBatcher.ShareBatcher(writer, 50, 10, buffer = buffer)
+		self.clock.advance(0)
+		self.assertEqual(writer.batches, [['a', 'b']])
+
+class FixedController(object):
+	# Hands out the (batch size, writers) decisions it was given, one per stored batch
+	def __init__(self, decisions):
+		(self.batch_size, self.writers) = (2, 1)
+		self.decisions = list(decisions)
+		self.records = []
+
+	def arrived(self):
+		pass
+
+	def record(self, rows, latency):
+		self.records.append(rows)
+
+	def decide(self, oldest_age):
+		if self.decisions:
+			(self.batch_size, self.writers) = self.decisions.pop(0)
+		return (self.batch_size, self.writers)
+
+	def stats(self):
+		return {}
+
+class ControllerTest(ClockTestCase):
+	def test_batcher_follows_controller(self):
+		writer = Writer()
+		controller = FixedController([(4, 1)])
+		batcher = ShareBatcher.ShareBatcher(writer, 50, 10, controller = controller)
+		self.assertEqual((batcher.batch_size, batcher.max_writers), (2, 1))
+
+		self.add(batcher, 'a', 'b')
+		self.assertEqual(writer.batches, [['a', 'b']])
+		self.assertEqual(controller.records, [2])
+		self.assertEqual(batcher.batch_size, 4)
+
+		self.add(batcher, 'c', 'd', 'e')
+		self.assertEqual(writer.batches, [['a', 'b']])
+		self.add(batcher, 'f')
+		self.assertEqual(writer.batches, [['a', 'b'], ['c', 'd', 'e', 'f']])
+
+	def test_more_writers_for_full_batches(self):
+		pending = []
+		def writer(batch):
+			pending.append(defer.Deferred())
+			return pending[-1]
+
+		controller = FixedController([])
+		(controller.batch_size, controller.writers) = (2, 3)
+		batcher = ShareBatcher.ShareBatcher(writer, 50, 10, 3, controller = controller)
+		self.add(batcher, 'a', 'b', 'c', 'd', 'e')
+		self.assertEqual(len(pending), 2)
+
+		# A partial batch waits for all writers to finish, even past its age, without a timer spinning meanwhile
+		self.clock.advance(10)
+		self.assertEqual(len(pending), 2)
+		self.assertEqual(self.clock.getDelayedCalls(), [])
+		pending[0].callback(None)
+		self.assertEqual(len(pending), 2)
+		pending[1].callback(None)
+		self.assertEqual(len(pending), 3)
+
+	def arrive(self, controller, count):
+		# 'count' shares over the next second
+		for n in range(count):
+			controller.arrived()
+		self.clock.advance(1)
+
+	def test_controller_grows(self):
+		controller = BatchController.BatchController(5, 10, 5000, 3)
+
+		# 1000 shares/s, batches cost 50ms plus 5ms per share: one writer can't keep up
+		self.arrive(controller, 1000)
+		controller.record(10, 0.1)
+		controller.record(20, 0.15)
+		self.assertEqual(controller.decide(0), (5000, 3))
+
+	def test_controller_settles_before_shrinking(self):
+		controller = BatchController.BatchController(5, 10, 5000, 3)
+		(controller.batch_size, controller.writers) = (5000, 3)
+		controller.record(10, 0.1)
+		controller.record(20, 0.15)
+
+		# 10 shares/s are easily stored by one writer in small batches, but only after SETTLE decisions in a row
+		for decision in range(controller.SETTLE - 1):
+			self.arrive(controller, 10)
+			self.assertEqual(controller.decide(0), (5000, 3))
+		self.arrive(controller, 10)
+		self.assertEqual(controller.decide(0), (10, 1))
+		self.assertEqual(controller.stats()['changes'], 1)
+
+	def test_controller_drains_old_queue(self):
+		controller = BatchController.BatchController(5, 10, 5000, 3)
+		self.clock.advance(1)
+		controller.record(10, 0.01)
+		self.assertEqual(controller.decide(6), (5000, 3))
+		self.assertTrue(controller.stats()['draining'])
+
+class PartitionedBatcherTest(ClockTestCase):
+	def test_routing(self):
+		writers = [Writer() for n in range(3)]
+		batchers = [ShareBatcher.ShareBatcher(writer, 50, 10) for writer in writers]
+		partitioned = ShareBatcher.PartitionedBatcher(batchers)
+
+		names = ['worker%i' % n for n in range(20)]
+		for name in names + names:
+			partitioned.add((name, 1))
+		self.assertEqual(partitioned.depth(), 40)
+
+		self.clock.advance(10)
+		for (index, writer) in enumerate(writers):
+			for batch in writer.batches:
+				for name in batch:
+					self.assertEqual(ShareBatcher.worker_partition(name, 3), index)
+
+		# Every share was written exactly once, by the writer of its partition
+		written = sorted(sum([sum(writer.batches, []) for writer in writers], []))
+		self.assertEqual(written, sorted(names + names))
+		self.assertEqual(partitioned.stats()['shares_written'], 40)
+
+	def test_partition_is_stable(self):
+		self.assertEqual(ShareBatcher.worker_partition('worker', 7), ShareBatcher.worker_partition(u'worker', 7))
+		self.assertEqual(ShareBatcher.worker_partition('worker', 1), 0)
+
+class ShortBuffer(ShareBatcher.MemoryBuffer):
+	# Claims more shares than it can hand out, like a spool with unreadable records
+	def __init__(self, missing):
+		ShareBatcher.MemoryBuffer.__init__(self)
+		self.missing = missing
+
+	def take(self, count):
+		(token, batch) = ShareBatcher.MemoryBuffer.take(self, count)
+		if not batch:
+			self.missing = 0
+		return (token, batch)
+
+	def depth(self):
+		return len(self.items) + self.missing
+
+class EmptyBatchTest(ClockTestCase):
+	def test_empty_batch_not_written(self):
+		writer = Writer()
+		batcher = ShareBatcher.ShareBatcher(writer, 2, 10, buffer = ShortBuffer(3))
+		self.add(batcher, 'a')
+		self.clock.advance(10)
+		self.assertEqual(writer.batches, [['a']])
+		self.assertEqual(writer.calls, 1)
+		self.assertEqual(batcher.depth(), 0)
+
+	def test_drain_stops_at_empty_batch(self):
+		batcher = ShareBatcher.ShareBatcher(Writer(), 2, 10, buffer = ShortBuffer(3))
+		drained = []
+		batcher.drain(drained.append)
+		self.assertEqual(drained, [])
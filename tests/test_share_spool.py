@@ -0,0 +1,195 @@
+import io
+import os
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import tests
+import ShareSpool
+
+class InlineThreads(object):
+	# Runs the sync "thread" at once, or queues it with 'hold' until run()
+	def __init__(self):
+		self.hold = False
+		self.jobs = []
+
+	def deferToThread(self, f, *args):
+		if not self.hold:
+			return defer.maybeDeferred(f, *args)
+
+		d = defer.Deferred()
+		self.jobs.append((d, f, args))
+		return d
+
+	def run(self):
+		# Jobs started by the callbacks wait for the next run()
+		(jobs, self.jobs) = (self.jobs, [])
+		for (d, f, args) in jobs:
+			defer.maybeDeferred(f, *args).chainDeferred(d)
+
+class ShareSpoolTest(unittest.TestCase):
+	def setUp(self):
+		self.path = self.mktemp()
+		self.clock = task.Clock()
+		self.threads = InlineThreads()
+		self.patch(ShareSpool, 'reactor', self.clock)
+		self.patch(ShareSpool, 'threads', self.threads)
+
+	def open(self, segment_records = 100, fsync_records = 1000):
+		return ShareSpool.ShareSpool(self.path, segment_records, fsync_records, 1)
+
+	def put(self, spool, first, last):
+		for n in range(first, last + 1):
+			spool.put(['worker', n])
+
+	def take(self, spool, count):
+		(token, batch) = spool.take(count)
+		return (token, [item[1] for item in batch])
+
+	def files(self):
+		return sorted(os.listdir(self.path))
+
+	def crash(self, spool):
+		# Whatever reached the kernel survives, nothing else is written
+		if spool.writer is not None:
+			spool.writer.flush()
+
+	def test_replay_after_out_of_order_acks(self):
+		spool = self.open()
+		self.put(spool, 1, 10)
+		(t1, b1) = self.take(spool, 3)
+		(t2, b2) = self.take(spool, 3)
+		(t3, b3) = self.take(spool, 4)
+		self.assertEqual((b1, b2, b3), ([1, 2, 3], [4, 5, 6], [7, 8, 9, 10]))
+
+		# The second batch is stored first, nothing before the first one is done
+		spool.ack(t2)
+		self.assertEqual(spool.commit_seq, 0)
+		spool.ack(t1)
+		self.assertEqual(spool.commit_seq, 6)
+
+		self.clock.advance(1)
+		self.assertEqual(open(os.path.join(self.path, 'ack')).read(), "6\n")
+
+		self.crash(spool)
+		spool = self.open()
+		self.assertEqual(spool.depth(), 4)
+		self.assertEqual(self.take(spool, 100)[1], [7, 8, 9, 10])
+
+	def test_unsynced_ack_replays_again(self):
+		spool = self.open()
+		self.put(spool, 1, 5)
+		(token, batch) = self.take(spool, 5)
+		spool.ack(token)
+
+		# Crashed before the ack was written: stored shares come back, none are lost
+		self.crash(spool)
+		spool = self.open()
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3, 4, 5])
+
+	def test_torn_last_record(self):
+		spool = self.open()
+		self.put(spool, 1, 5)
+		self.crash(spool)
+		with io.open(spool.segment_path(1), 'ab') as f:
+			f.write('6\t["worker", ')
+
+		spool = self.open()
+		self.assertEqual(spool.depth(), 5)
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3, 4, 5])
+
+		# Numbering continues after the last complete record, in a new segment
+		self.put(spool, 6, 7)
+		self.assertEqual(spool.segments, [1, 6])
+		self.assertEqual(self.take(spool, 100)[1], [6, 7])
+
+		self.crash(spool)
+		spool = self.open()
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3, 4, 5, 6, 7])
+
+	def test_purge_waits_for_stored_ack(self):
+		spool = self.open(segment_records = 2)
+		self.put(spool, 1, 6)
+		self.assertEqual(spool.segments, [1, 3, 5])
+
+		# The reader has moved on to segment 3, segment 1 only holds acknowledged records
+		(token, batch) = self.take(spool, 3)
+		spool.ack(token)
+		self.assertIn('00000000000000000001.spool', self.files())
+
+		self.clock.advance(1)
+		self.assertEqual(spool.segments, [3, 5])
+		self.assertNotIn('00000000000000000001.spool', self.files())
+
+	def test_purge_keeps_reader_segment(self):
+		spool = self.open(segment_records = 2)
+		self.put(spool, 1, 6)
+
+		# Records 3 and 4 are acknowledged but segment 3 is still being read
+		(token, batch) = self.take(spool, 4)
+		self.assertEqual(spool.reader_segment, 3)
+		spool.ack(token)
+		spool.sync()
+		self.assertEqual(spool.segments, [3, 5])
+
+		self.crash(spool)
+		spool = self.open(segment_records = 2)
+		self.assertEqual(self.take(spool, 100)[1], [5, 6])
+
+	def test_empty_leftover_segment_reused(self):
+		spool = self.open(segment_records = 2)
+		self.put(spool, 1, 2)
+		spool.close()
+
+		# Crashed right after starting the next segment
+		io.open(spool.segment_path(3), 'ab').close()
+
+		spool = self.open(segment_records = 2)
+		self.assertEqual(spool.segments, [1, 3])
+		self.assertEqual(spool.depth(), 2)
+		self.put(spool, 3, 3)
+		self.assertEqual(spool.segments, [1, 3])
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3])
+
+		self.crash(spool)
+		spool = self.open(segment_records = 2)
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3])
+
+	def test_fsync_off_the_reactor_thread(self):
+		self.threads.hold = True
+		spool = self.open(fsync_records = 3)
+		self.put(spool, 1, 3)
+
+		# One sync at a time, what is acknowledged meanwhile goes with the next one
+		self.assertEqual(len(self.threads.jobs), 1)
+		(token, batch) = self.take(spool, 3)
+		spool.ack(token)
+		self.put(spool, 4, 6)
+		self.assertEqual(len(self.threads.jobs), 1)
+		self.assertTrue(spool.resync)
+
+		self.threads.run()
+		self.assertFalse(os.path.exists(os.path.join(self.path, 'ack')))
+		self.threads.run()
+		self.assertEqual(open(os.path.join(self.path, 'ack')).read(), "3\n")
+		self.assertEqual(spool.unsynced_fds, [])
+
+	def test_close_writes_ack(self):
+		spool = self.open()
+		self.put(spool, 1, 4)
+		(token, batch) = self.take(spool, 2)
+		spool.ack(token)
+		spool.close()
+
+		spool = self.open()
+		self.assertEqual(self.take(spool, 100)[1], [3, 4])
+
+	def test_unreadable_records_skipped(self):
+		spool = self.open()
+		self.put(spool, 1, 3)
+
+		# Records the spool counted but can't read back must not keep the depth up
+		spool.write_seq += 2
+		self.assertEqual(self.take(spool, 100)[1], [1, 2, 3])
+		self.assertEqual(spool.depth(), 0)
+		self.assertEqual(self.take(spool, 100)[1], [])